@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自适应并发限制
+每次API调用前都要取得一个名额，名额上限按AIMD规则随服务端反馈实时调整：
+- 请求成功且延迟正常：每完成一整轮（上限个请求）上限加1（加性增）
+- 遇到限流(429)：上限乘以回退系数（乘性减），同一轮内的多个429只减一次
+- 近期延迟持续明显高于长期基线（服务端开始排队）：上限小幅下调
+  基线是慢速EWMA而不是历史最小值：视觉模型的延迟长尾明显，偶然一次很快的请求不会把基线永久压低
+线程版用于多线程引擎，异步版用于异步引擎，调整规则相同
+"""
+
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+from api_errors import classify_api_error
+
+OK = 'ok'
+RATE_LIMITED = 'rate_limited'
+FAILED = 'failed'
+
+LATENCY_SMOOTHING = 0.2  # 近期延迟EWMA的平滑系数
+BASELINE_SMOOTHING = 0.02  # 长期延迟基线(EWMA)的平滑系数，约反映最近几十次请求
+LATENCY_PATIENCE = 5  # 近期延迟连续这么多次超出基线的容忍倍数才下调，单次长尾不触发
+
+
+def classify_error(error: BaseException) -> str:
+    return RATE_LIMITED if classify_api_error(error).kind == RATE_LIMITED else FAILED
+
+
+class _AdaptiveLimit:
+    """并发上限的调整规则（调用方持有锁）"""
+
+    def __init__(self, max_limit: int, min_limit: int = 1, backoff: float = 0.5,
+                 latency_tolerance: float = 3.0):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.baseline_latency = None  # 长期延迟基线
+        self.ewma_latency = None
+        self.congested = 0  # 近期延迟连续超出基线的次数
+        self.last_decrease = 0.0
+        self.lowest = self.max_limit
+        self.rate_limit_decreases = 0
+        self.latency_decreases = 0
+
+    @property
+    def current(self) -> int:
+        """当前允许的并发数"""
+        return max(self.min_limit, int(self.limit))
+
+    def _decrease(self, factor: float, now: float) -> bool:
+        # 同一轮请求（一个平均延迟）内只下调一次，避免一批同时返回的429把上限压到最低
+        window = self.ewma_latency or 1.0
+        if now - self.last_decrease < window:
+            return False
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        self.last_decrease = now
+        self.lowest = min(self.lowest, self.current)
+        return True
+
+    def _update(self, latency: float, outcome: str):
+        now = time.monotonic()
+        if outcome == RATE_LIMITED:
+            if self._decrease(self.backoff, now):
+                self.rate_limit_decreases += 1
+            return
+        if outcome != OK:
+            # 其他错误与并发数无关，不调整
+            return
+
+        if self.ewma_latency is None:
+            self.ewma_latency = self.baseline_latency = latency
+        else:
+            self.ewma_latency += LATENCY_SMOOTHING * (latency - self.ewma_latency)
+            self.baseline_latency += BASELINE_SMOOTHING * (latency - self.baseline_latency)
+
+        if self.ewma_latency > self.baseline_latency * self.latency_tolerance:
+            self.congested += 1
+        else:
+            self.congested = 0
+        if self.congested >= LATENCY_PATIENCE:
+            # 延迟梯度持续变差，说明请求开始在服务端排队
+            if self._decrease(0.9, now):
+                self.latency_decreases += 1
+        elif not self.congested and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def describe_live(self) -> str:
+        """用于进度条显示"""
+        return f"{self.current}/{self.max_limit}"
+
+    def describe(self) -> str:
+        """用于最终统计"""
+        return (f"当前 {self.current}/{self.max_limit}，最低 {self.lowest}，"
+                f"限流降速 {self.rate_limit_decreases} 次，延迟降速 {self.latency_decreases} 次")
+
+
+class AdaptiveLimiter(_AdaptiveLimit):
+    """多线程版本"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cond = threading.Condition()
+
+    def acquire(self) -> float:
+        """等待空闲名额，返回开始时间"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start: float, outcome: str = OK):
+        with self.cond:
+            self.in_flight -= 1
+            self._update(time.monotonic() - start, outcome)
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """占用一个名额执行一次API调用，按调用结果调整上限"""
+        start = self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            self.release(start, classify_error(e))
+            raise
+        self.release(start, OK)
+
+
+class AsyncAdaptiveLimiter(_AdaptiveLimit):
+    """异步版本（只能在同一个事件循环中使用）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cond = None
+
+    def _condition(self) -> asyncio.Condition:
+        # 在事件循环中延迟创建，兼容Python 3.9
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        return self.cond
+
+    async def acquire(self) -> float:
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, start: float, outcome: str = OK):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            self._update(time.monotonic() - start, outcome)
+            cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        start = await self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            await self.release(start, classify_error(e))
+            raise
+        await self.release(start, OK)
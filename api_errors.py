@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API错误分类
+从OpenAI SDK、官方Gemini SDK(google.api_core)和 async_transport 的异常中读取结构化的
+HTTP状态码和 Retry-After / 限流响应头，不再依赖对 str(e) 的子串匹配
+安全拦截优先看Gemini SDK的拦截原因/结束原因和错误码；只有既没有状态码也没有结构化原因的旧式异常才按关键字判断，
+避免网关返回的 403 "request blocked" 之类的传输/鉴权错误被当成审查结论
+"""
+
+import re
+import json
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+RATE_LIMITED = 'rate_limited'  # 429，服务端要求降速
+UNAVAILABLE = 'unavailable'  # 5xx，服务端暂时不可用
+TIMEOUT = 'timeout'
+NETWORK = 'network'  # 连接失败、DNS错误等
+SAFETY = 'safety'  # 内容被安全过滤器拦截，本身就是审查结论
+OTHER = 'other'
+
+# 说明端点本身有问题的错误类型，计入熔断
+ENDPOINT_FAILURES = {UNAVAILABLE, TIMEOUT, NETWORK}
+
+_NETWORK_KEYWORDS = ('connection', 'network', 'dns', 'unreachable', 'refused')
+_SAFETY_KEYWORDS = ('SAFETY', 'BLOCKED', '安全')
+# 表示内容被安全策略拦截的结束原因(Gemini)和错误码(OpenAI/Azure)，统一按大写比较
+_SAFETY_REASONS = {'SAFETY', 'BLOCKLIST', 'PROHIBITED_CONTENT', 'SPII', 'IMAGE_SAFETY',
+                   'CONTENT_FILTER', 'CONTENT_POLICY_VIOLATION'}
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_RETRY_DELAY_TEXT = [
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)'),  # Gemini RetryInfo
+    re.compile(r'retry in (\d+(?:\.\d+)?)\s*s', re.IGNORECASE),
+]
+
+
+@dataclass
+class APIErrorInfo:
+    """一次失败调用的结构化信息"""
+    kind: str
+    status: Optional[int] = None
+    retry_after: Optional[float] = None  # 服务端建议的等待秒数
+
+    @property
+    def endpoint_failure(self) -> bool:
+        return self.kind in ENDPOINT_FAILURES
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """解析 Retry-After：秒数或HTTP日期"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_duration(value) -> Optional[float]:
+    """解析OpenAI限流头中的时长，如 1s、6m0s、20ms"""
+    if value is None:
+        return None
+    parts = _DURATION_PART.findall(str(value))
+    if not parts:
+        return parse_retry_after(value)
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def retry_after_from_headers(headers: Optional[Mapping]) -> Optional[float]:
+    """从响应头读取建议的等待时间"""
+    if not headers:
+        return None
+    # 统一为小写键，兼容普通dict
+    headers = {str(key).lower(): value for key, value in headers.items()}
+    if 'retry-after-ms' in headers:
+        try:
+            return max(0.0, float(headers['retry-after-ms']) / 1000)
+        except ValueError:
+            pass
+    retry_after = parse_retry_after(headers.get('retry-after'))
+    if retry_after is not None:
+        return retry_after
+    # 配额已用完时，等到对应的额度重置
+    delays = [
+        parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+        for kind in ('requests', 'tokens')
+        if str(headers.get(f'x-ratelimit-remaining-{kind}', '')).strip() == '0'
+    ]
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
+
+
+def _status_of(error: BaseException) -> Optional[int]:
+    for attr in ('status', 'status_code', 'code'):
+        value = getattr(error, attr, None)
+        # google.api_core 的 code 是 HTTPStatus，gRPC状态码等其他类型忽略
+        if isinstance(value, int) and 100 <= value < 600:
+            return int(value)
+    return None
+
+
+def _headers_of(error: BaseException) -> Optional[Mapping]:
+    headers = getattr(error, 'headers', None)
+    if headers is None:
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+    return headers
+
+
+def _retry_delay_of(error: BaseException) -> Optional[float]:
+    """Gemini在错误详情(RetryInfo)或错误信息中给出的等待时间"""
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return getattr(delay, 'seconds', 0) + getattr(delay, 'nanos', 0) / 1e9
+    text = str(error)
+    for pattern in _RETRY_DELAY_TEXT:
+        match = pattern.search(text)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def _error_code_of(error: BaseException) -> Optional[str]:
+    """OpenAI SDK 的 code 属性或响应体中的错误码（如 content_filter），数字状态码忽略"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, str):
+        return code
+    body = getattr(error, 'body', None)
+    if isinstance(body, (str, bytes)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return None
+    if isinstance(body, dict):
+        if isinstance(body.get('error'), dict):
+            body = body['error']
+        code = body.get('code')
+        if isinstance(code, str):
+            return code
+    return None
+
+
+def _blocked_by_safety(error: BaseException) -> Optional[bool]:
+    """按结构化的拦截原因判断是否为安全拦截，没有结构化信息时返回None"""
+    name = type(error).__name__
+    if name == 'BlockedPromptException':
+        # 请求本身（含图片）被拦截
+        return True
+    if name == 'StopCandidateException':
+        candidate = error.args[0] if error.args else None
+        reason = getattr(candidate, 'finish_reason', None)
+        if reason is None:
+            return True
+        # RECITATION 等其他结束原因不是安全拦截
+        return str(getattr(reason, 'name', reason)).upper() in _SAFETY_REASONS
+    code = _error_code_of(error)
+    if code is not None and code.upper() in _SAFETY_REASONS:
+        return True
+    return None
+
+
+def classify_api_error(error: BaseException) -> APIErrorInfo:
+    """把异常归类为限流/不可用/超时/网络/安全拦截/其他，并读取建议的等待时间"""
+    status = _status_of(error)
+    retry_after = retry_after_from_headers(_headers_of(error))
+    if retry_after is None:
+        retry_after = _retry_delay_of(error)
+    error_str = str(error)
+    name = type(error).__name__
+    blocked = _blocked_by_safety(error)
+
+    if status == 429 or name in ('RateLimitError', 'ResourceExhausted', 'TooManyRequests'):
+        kind = RATE_LIMITED
+    elif status is not None and status >= 500:
+        kind = UNAVAILABLE
+    elif blocked is not None:
+        kind = SAFETY if blocked else OTHER
+    elif status is None and any(keyword.lower() in error_str.lower() for keyword in _SAFETY_KEYWORDS):
+        # 没有状态码和结构化原因的旧式异常
+        kind = SAFETY
+    elif status is None and ("429" in error_str or "Too Many Requests" in error_str
+                             or "RESOURCE_EXHAUSTED" in error_str):
+        # 没有结构化状态码的旧式异常
+        kind = RATE_LIMITED
+    elif 'timeout' in name.lower() or 'timeout' in error_str.lower() or name == 'DeadlineExceeded':
+        kind = TIMEOUT
+    elif status is None and ('connect' in name.lower() or
+                             any(keyword in error_str.lower() for keyword in _NETWORK_KEYWORDS)):
+        kind = NETWORK
+    else:
+        kind = OTHER
+    return APIErrorInfo(kind, status, retry_after)
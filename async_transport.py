@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步API传输层
+基于aiohttp直接调用HTTP接口，请求期间不阻塞事件循环，并发数由调用方的信号量决定
+"""
+
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+import aiohttp
+
+
+class APIStatusError(Exception):
+    """接口返回非2xx状态码"""
+
+    def __init__(self, status: int, reason: str, body: str = '', headers: Optional[Dict] = None):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.headers = headers or {}  # 保留 Retry-After 等响应头
+        super().__init__(f"{status} {reason}: {body[:200]}")
+
+
+class APITimeoutError(Exception):
+    """请求超时"""
+
+
+class OpenAICompatibleClient:
+    """OpenAI兼容接口 (chat/completions) 的异步客户端
+
+    整个运行期间共用一个ClientSession，连接池大小与并发数一致并保持长连接，
+    每个请求单独设置超时；在事件循环中通过 async with 或 start()/close() 使用
+    """
+
+    def __init__(self, base_url: str, api_key: str, max_connections: int = 30,
+                 timeout: float = 60, connect_timeout: float = 10, keepalive_timeout: float = 60):
+        self.endpoint = base_url.rstrip('/') + '/chat/completions'
+        self.api_key = api_key
+        self.max_connections = max(1, max_connections)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """创建连接池（必须在事件循环中调用）"""
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout),
+            headers={'Authorization': f'Bearer {self.api_key}'}
+        )
+
+    async def close(self):
+        """关闭连接池"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def chat_completion(self, model: str, messages: List[Dict], timeout: float = None) -> str:
+        """发送请求并返回模型回复的文本"""
+        request_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.timeout, sock_connect=self.connect_timeout
+        )
+        try:
+            async with self.session.post(
+                self.endpoint,
+                json={'model': model, 'messages': messages},
+                timeout=request_timeout
+            ) as response:
+                text = await response.text()
+                if response.status >= 400:
+                    raise APIStatusError(response.status, response.reason or '', text, dict(response.headers))
+        except asyncio.TimeoutError:
+            raise APITimeoutError(f"request timeout after {timeout or self.timeout}s")
+        return self.extract_content(text)
+
+    @staticmethod
+    def extract_content(text: str) -> str:
+        """从响应中取出回复内容，非标准格式时返回原始文本"""
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            return text
+        if isinstance(parsed, dict) and parsed.get('choices'):
+            message = parsed['choices'][0].get('message') or {}
+            content = message.get('content')
+            if isinstance(content, str):
+                return content
+        return text
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多图批量审查
+把多张图片放进同一个请求，要求模型按编号返回JSON数组，请求数和提示词开销约降为原来的 1/N
+工作线程/协程把图片交给批处理器后等待结论：凑满一批或等待超时后，由最后加入（或等待超时）的调用方发送请求；
+编号缺失、结论不完整或回复无法解析的图片返回None，由调用方改为逐张审查（逐张审查负责重试）；
+整批请求被限流或端点故障时改为逐张请求只会成倍放大压力，此时向每个调用方抛出BatchRetry，交给退避重试
+"""
+
+import json
+import time
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from api_errors import RATE_LIMITED, APIErrorInfo, classify_api_error
+
+BATCH_MAX_REQUEST_MB = 20  # 单个批量请求中图片(Base64)的总大小上限
+
+BATCH_PROMPT = """
+下面按顺序给出 {count} 张图片，编号依次为 0 到 {last}。请分别审查每张图片是否适合16岁及以上青少年查看。
+
+重点检查：
+1. 是否包含性暗示、性行为或裸体内容
+2. 是否有过度暴露的服装（如比基尼、情趣内衣等）
+3. 是否有挑逗性姿势或表情
+4. 是否对未成年外观的角色进行性化描绘
+5. 整体是否存在不适宜青少年的内容
+
+请只返回一个JSON数组，每张图片一项，必须包含全部 {count} 个编号：
+[
+    {{"index": 0, "suitable_for_teens": true/false, "reason": "详细的判断理由", "confidence": 0.0-1.0}}
+]
+
+如果有任何疑虑，请判定为不适合。
+"""
+
+
+def build_batch_prompt(count: int) -> str:
+    return BATCH_PROMPT.format(count=count, last=count - 1)
+
+
+def fits_in_batch(base64_size: int, batch_size: int) -> bool:
+    """单张图片是否足够小，整批请求不会超过大小上限"""
+    return base64_size * batch_size <= BATCH_MAX_REQUEST_MB * 1024 * 1024
+
+
+def parse_batch_verdicts(content: str, count: int) -> Dict[int, dict]:
+    """解析批量结论，只返回编号有效且结论完整的项
+
+    同一编号出现多次且结论不一致时视为缺失，交给逐张审查
+    """
+    start = content.find('[')
+    end = content.rfind(']') + 1
+    if start < 0 or end <= start:
+        return {}
+    try:
+        items = json.loads(content[start:end])
+    except ValueError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    verdicts: Dict[int, dict] = {}
+    conflicts = set()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get('index')
+        if isinstance(index, bool) or not isinstance(index, int) or not 0 <= index < count:
+            continue
+        if not isinstance(item.get('suitable_for_teens'), bool):
+            continue
+        verdict = {key: value for key, value in item.items() if key != 'index'}
+        previous = verdicts.get(index)
+        if previous is not None and previous.get('suitable_for_teens') != verdict['suitable_for_teens']:
+            conflicts.add(index)
+        verdicts.setdefault(index, verdict)
+    for index in conflicts:
+        del verdicts[index]
+    return verdicts
+
+
+class BatchRetry(Exception):
+    """整批请求被限流或端点故障，调用方应按退避重试，而不是改为逐张请求"""
+
+    def __init__(self, error: APIErrorInfo):
+        super().__init__(f"批量审查失败({error.kind})，稍后重试")
+        self.error = error
+
+
+class _BatchSlot:
+    __slots__ = ('item', 'result', 'error', 'done', 'taken', 'future')
+
+    def __init__(self, item: Any):
+        self.item = item
+        self.result = None
+        self.error: Optional[APIErrorInfo] = None
+        self.done = False
+        self.taken = False
+        self.future = None
+
+
+class _BatchStats:
+    """批处理统计（调用方持有锁或在同一事件循环中）"""
+
+    def __init__(self, size: int, max_wait: float):
+        self.size = max(2, int(size))
+        self.max_wait = max_wait
+        self.pending: List[_BatchSlot] = []
+        self.requests = 0
+        self.answered = 0
+        self.fallbacks = 0
+        self.retried = 0
+
+    def _take(self) -> List[_BatchSlot]:
+        batch, self.pending = self.pending, []
+        for slot in batch:
+            slot.taken = True
+        return batch
+
+    def _failed(self, batch: List[_BatchSlot], error: Exception) -> Optional[APIErrorInfo]:
+        """按错误类型决定整批的去向：限流或端点故障时返回错误信息（整批重试），否则返回None（逐张审查）"""
+        info = classify_api_error(error)
+        if info.kind == RATE_LIMITED or info.endpoint_failure:
+            if self.logger:
+                self.logger.warning(f"批量审查被限流或端点故障，{len(batch)} 张图片稍后重试: {error}")
+            return info
+        if self.logger:
+            self.logger.warning(f"批量审查失败，{len(batch)} 张图片改为逐张审查: {error}")
+        return None
+
+    def _record(self, batch: List[_BatchSlot], results: Dict[int, dict], error: Optional[APIErrorInfo] = None):
+        if len(batch) > 1:
+            self.requests += 1
+        for index, slot in enumerate(batch):
+            slot.result = results.get(index)
+            slot.error = error
+            slot.done = True
+            if error is not None:
+                self.retried += 1
+            elif slot.result is None:
+                self.fallbacks += 1
+            else:
+                self.answered += 1
+
+    def describe(self) -> str:
+        average = self.answered / self.requests if self.requests else 0
+        return (f"每批最多 {self.size} 张，批量请求 {self.requests} 次，批量得出结论 {self.answered} 张"
+                f"（平均每次 {average:.1f} 张），逐张回退 {self.fallbacks} 张，整批重试 {self.retried} 张")
+
+
+class ReviewBatcher(_BatchStats):
+    """多线程版本：send(items) 在调用线程中发送一批请求，返回 {序号: 结论}"""
+
+    def __init__(self, size: int, max_wait: float, send: Callable[[List[Any]], Dict[int, dict]], logger=None):
+        super().__init__(size, max_wait)
+        self.send = send
+        self.logger = logger
+        self.cond = threading.Condition()
+
+    def review(self, item: Any) -> Optional[dict]:
+        """等待所在批次的结论，返回None表示需要逐张审查；整批被限流或端点故障时抛出BatchRetry"""
+        slot = _BatchSlot(item)
+        batch = None
+        with self.cond:
+            self.pending.append(slot)
+            if len(self.pending) >= self.size:
+                batch = self._take()
+            else:
+                deadline = time.monotonic() + self.max_wait
+                while not slot.taken:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # 等待超时，把已收集的图片作为一批发送
+                        batch = self._take()
+                        break
+                    self.cond.wait(remaining)
+                if batch is None:
+                    # 已被其他线程发送，等待结论
+                    while not slot.done:
+                        self.cond.wait()
+        if batch is not None:
+            self._run(batch)
+        if slot.error is not None:
+            raise BatchRetry(slot.error)
+        return slot.result
+
+    def _run(self, batch: List[_BatchSlot]):
+        results: Dict[int, dict] = {}
+        error = None
+        try:
+            # 只有一张时不使用批量提示词，直接逐张审查
+            if len(batch) > 1:
+                results = self.send([slot.item for slot in batch])
+        except Exception as e:
+            error = self._failed(batch, e)
+        finally:
+            with self.cond:
+                self._record(batch, results, error)
+                self.cond.notify_all()
+
+
+class AsyncReviewBatcher(_BatchStats):
+    """异步版本（只能在同一个事件循环中使用）"""
+
+    def __init__(self, size: int, max_wait: float, send: Callable[[List[Any]], Awaitable[Dict[int, dict]]],
+                 logger=None):
+        super().__init__(size, max_wait)
+        self.send = send
+        self.logger = logger
+
+    async def review(self, item: Any) -> Optional[dict]:
+        """等待所在批次的结论，返回None表示需要逐张审查；整批被限流或端点故障时抛出BatchRetry"""
+        slot = _BatchSlot(item)
+        slot.future = asyncio.get_running_loop().create_future()
+        self.pending.append(slot)
+        if len(self.pending) >= self.size:
+            await self._run(self._take())
+        else:
+            try:
+                await asyncio.wait_for(asyncio.shield(slot.future), self.max_wait)
+            except asyncio.TimeoutError:
+                if not slot.taken:
+                    await self._run(self._take())
+        result = await slot.future
+        if slot.error is not None:
+            raise BatchRetry(slot.error)
+        return result
+
+    async def _run(self, batch: List[_BatchSlot]):
+        results: Dict[int, dict] = {}
+        error = None
+        try:
+            if len(batch) > 1:
+                results = await self.send([slot.item for slot in batch])
+        except Exception as e:
+            error = self._failed(batch, e)
+        finally:
+            self._record(batch, results, error)
+            for slot in batch:
+                if not slot.future.done():
+                    slot.future.set_result(slot.result)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+解码缩放性能测试
+对比原有方法（完整解码 + LANCZOS缩放）与 image_payload.downscale
+（JPEG draft解码缩放 + reduce整数倍缩小 + LANCZOS）的耗时和峰值内存
+
+用法:
+    python benchmark_decode.py                  # 使用生成的 4000x3000 测试图片
+    python benchmark_decode.py --images 图片目录  # 使用指定目录中的图片
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+from PIL import Image
+
+from image_payload import MAX_DIMENSION, downscale
+from scan_manifest import IMAGE_EXTENSIONS
+
+TEST_FORMATS = [('JPEG', '.jpg'), ('PNG', '.png'), ('WEBP', '.webp'), ('GIF', '.gif')]
+
+
+def legacy_downscale(img: Image.Image, max_dimension: int = MAX_DIMENSION) -> Image.Image:
+    """原有方法：以原始分辨率完整解码后直接LANCZOS缩放"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    if img.width > max_dimension or img.height > max_dimension:
+        ratio = min(max_dimension / img.width, max_dimension / img.height)
+        img = img.resize((int(img.width * ratio), int(img.height * ratio)), Image.Resampling.LANCZOS)
+    return img
+
+
+METHODS = {'legacy': legacy_downscale, 'fast': downscale}
+
+
+def peak_rss_mb():
+    """当前进程的峰值内存(MB)，无法获取时返回None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux单位为KB，macOS为字节
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except Exception:
+        return None
+
+
+def measure(method: str, image_path: str, repeat: int):
+    """在独立进程中执行，返回(耗时中位数ms, 峰值内存增量MB)"""
+    func = METHODS[method]
+    baseline = peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with Image.open(image_path) as img:
+            func(img).load()
+        timings.append((time.perf_counter() - start) * 1000)
+    peak = peak_rss_mb()
+    growth = peak - baseline if peak is not None and baseline is not None else None
+    return statistics.median(timings), growth
+
+
+def run_isolated(func, *args):
+    """在全新进程中执行，峰值内存互不影响（主进程保持较小内存，避免子进程继承峰值）"""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def generate_images(folder: str, width: int, height: int):
+    """生成各格式的测试图片（渐变叠加噪声，接近照片的压缩难度）"""
+    base = Image.merge('RGB', [
+        Image.linear_gradient('L').resize((width, height)),
+        Image.radial_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 40),
+    ])
+    paths = []
+    for fmt, ext in TEST_FORMATS:
+        path = os.path.join(folder, f"test_{width}x{height}{ext}")
+        img = base.convert('P') if fmt == 'GIF' else base
+        img.save(path, fmt)
+        paths.append(path)
+    return paths
+
+
+def format_mb(value):
+    return f"{value:.0f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='解码缩放性能测试')
+    parser.add_argument('--images', help='测试图片目录（默认生成测试图片）')
+    parser.add_argument('--size', default='4000x3000', help='生成测试图片的尺寸，默认4000x3000')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数，默认3')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.images:
+            paths = sorted(
+                os.path.join(args.images, name) for name in os.listdir(args.images)
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            )
+        else:
+            width, height = (int(v) for v in args.size.lower().split('x'))
+            print(f"🖼️ 生成 {width}x{height} 测试图片...")
+            paths = run_isolated(generate_images, temp_dir, width, height)
+
+        print(f"{'文件':<28}{'尺寸':>12}{'原方法ms':>10}{'新方法ms':>10}{'加速':>7}{'原峰值MB':>10}{'新峰值MB':>10}")
+        for path in paths:
+            with Image.open(path) as img:
+                size = f"{img.width}x{img.height}"
+            legacy_ms, legacy_mb = run_isolated(measure, 'legacy', path, args.repeat)
+            fast_ms, fast_mb = run_isolated(measure, 'fast', path, args.repeat)
+            speedup = legacy_ms / fast_ms if fast_ms > 0 else 0
+            print(f"{os.path.basename(path)[:27]:<28}{size:>12}{legacy_ms:>10.0f}{fast_ms:>10.0f}"
+                  f"{speedup:>6.1f}x{format_mb(legacy_mb):>10}{format_mb(fast_mb):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上传格式性能测试
+对比 JPEG / WebP / AVIF 上传编码的数据大小（Base64）、编码耗时和端到端延迟
+端到端延迟默认按上行带宽估算（编码耗时 + 上传耗时 + 往返时间）；加上 --send 时按 filter_config.json
+向配置的端点实际发送审查请求并计时（会消耗API调用次数）
+
+用法:
+    python benchmark_upload.py                         # 使用生成的 4000x3000 测试图片
+    python benchmark_upload.py --images 图片目录         # 使用指定目录中的图片
+    python benchmark_upload.py --uplink-kbps 512       # 按512 kbit/s的上行带宽估算
+    python benchmark_upload.py --send                  # 实际发送请求测量端到端延迟
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+from PIL import Image
+
+from image_payload import UPLOAD_FORMATS, prepare_image, upload_format_available
+from scan_manifest import IMAGE_EXTENSIONS
+
+PROMPT = '这张图片是否适合16岁及以上青少年查看？只返回JSON：{"suitable_for_teens": true/false, "confidence": 0.0-1.0}'
+
+
+def generate_images(folder: str, width: int, height: int):
+    """生成测试图片（渐变叠加噪声，接近照片的压缩难度；另有一张平涂色块，接近插画/截图）"""
+    photo = Image.merge('RGB', [
+        Image.linear_gradient('L').resize((width, height)),
+        Image.radial_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 40),
+    ])
+    flat = Image.new('RGB', (width, height), (240, 240, 235))
+    for index in range(8):
+        flat.paste((40 * index, 200 - 20 * index, 120), (index * width // 8, height // 4, (index + 1) * width // 8,
+                                                         height * 3 // 4))
+    paths = []
+    for name, img in (('photo', photo), ('flat', flat)):
+        path = os.path.join(folder, f"{name}_{width}x{height}.png")
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def load_config(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def make_sender(config: dict):
+    """按配置创建发送函数，返回 send(prepared) -> 耗时秒数"""
+    base_url = config.get('api_base_url') or config.get('base_url') or ''
+    model_name = config.get('model_name', 'gemini-2.5-flash')
+    timeout = config.get('timeout', 60)
+    if base_url and config.get('use_proxy', True):
+        from openai import OpenAI
+        # 关闭SDK内置重试，避免把限流后的等待计入延迟
+        client = OpenAI(api_key=config.get('api_key'), base_url=base_url, max_retries=0)
+
+        def send(prepared):
+            start = time.perf_counter()
+            client.chat.completions.create(
+                model=model_name,
+                messages=[{"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": prepared.to_data_url()}},
+                    {"type": "text", "text": PROMPT},
+                ]}],
+                timeout=timeout
+            )
+            return time.perf_counter() - start
+    else:
+        import google.generativeai as genai
+        genai.configure(api_key=config.get('api_key'))
+        model = genai.GenerativeModel(model_name)
+
+        def send(prepared):
+            start = time.perf_counter()
+            model.generate_content([PROMPT, prepared.to_inline_blob()], request_options={'timeout': timeout, 'retry': None})
+            return time.perf_counter() - start
+    return send
+
+
+def measure(path: str, upload_format: str, budget_mb: float, repeat: int):
+    """返回(预处理结果, 编码耗时中位数ms)，编码耗时含解码缩放"""
+    timings = []
+    prepared = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        prepared = prepare_image(path, budget_mb, upload_format=upload_format)
+        timings.append((time.perf_counter() - start) * 1000)
+    return prepared, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='上传格式性能测试')
+    parser.add_argument('--images', help='测试图片目录（默认生成测试图片）')
+    parser.add_argument('--size', default='4000x3000', help='生成测试图片的尺寸，默认4000x3000')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数，默认3')
+    parser.add_argument('--budget-mb', type=float, default=8, help='图片Base64数据上限(MB)，默认8')
+    parser.add_argument('--uplink-kbps', type=float, default=1000, help='估算用的上行带宽(kbit/s)，默认1000')
+    parser.add_argument('--rtt-ms', type=float, default=300, help='估算用的往返时间(ms)，默认300')
+    parser.add_argument('--send', action='store_true', help='按配置文件实际发送请求测量端到端延迟')
+    parser.add_argument('--config', default='filter_config.json', help='--send 使用的配置文件')
+    args = parser.parse_args()
+
+    formats = [fmt for fmt in UPLOAD_FORMATS if upload_format_available(fmt)]
+    skipped = [fmt for fmt in UPLOAD_FORMATS if fmt not in formats]
+    if skipped:
+        print(f"⚠️ 当前Pillow不支持编码: {', '.join(skipped)}")
+    send = make_sender(load_config(args.config)) if args.send else None
+    latency_title = '实测延迟ms' if send else '估算延迟ms'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.images:
+            paths = sorted(
+                os.path.join(args.images, name) for name in os.listdir(args.images)
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            )
+        else:
+            width, height = (int(v) for v in args.size.lower().split('x'))
+            print(f"🖼️ 生成 {width}x{height} 测试图片...")
+            paths = generate_images(temp_dir, width, height)
+
+        print(f"{'文件':<28}{'格式':>6}{'质量':>6}{'Base64 KB':>11}{'编码ms':>9}{latency_title:>12}{'相对JPEG':>10}")
+        totals = {fmt: [0, 0.0, 0.0] for fmt in formats}  # 格式 -> [字节数, 编码ms, 延迟ms]
+        for path in paths:
+            baseline = None
+            for fmt in formats:
+                prepared, encode_ms = measure(path, fmt, args.budget_mb, args.repeat)
+                if prepared.error:
+                    print(f"{os.path.basename(path)[:27]:<28}{fmt:>6}  处理失败: {prepared.error}")
+                    continue
+                size = prepared.base64_size
+                if send:
+                    latency_ms = encode_ms + send(prepared) * 1000
+                else:
+                    latency_ms = encode_ms + size * 8 / args.uplink_kbps + args.rtt_ms
+                baseline = baseline or size
+                totals[fmt][0] += size
+                totals[fmt][1] += encode_ms
+                totals[fmt][2] += latency_ms
+                print(f"{os.path.basename(path)[:27]:<28}{fmt:>6}{prepared.quality:>6}{size / 1024:>11.0f}"
+                      f"{encode_ms:>9.0f}{latency_ms:>12.0f}{size / baseline:>9.0%}")
+
+        if len(paths) > 1:
+            print()
+            print(f"{'合计/平均':<28}{'格式':>6}{'':>6}{'Base64 KB':>11}{'编码ms':>9}{latency_title:>12}")
+            for fmt, (size, encode_ms, latency_ms) in totals.items():
+                print(f"{'':<28}{fmt:>6}{'':>6}{size / 1024:>11.0f}{encode_ms / len(paths):>9.0f}"
+                      f"{latency_ms / len(paths):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端点熔断器
+端点连续失败（超时、网络错误、5xx）达到阈值后熔断，冷却期内不再向该端点发送任何请求；
+冷却结束后只放行一个探测请求，成功则恢复，失败则加倍冷却时间
+服务端通过 Retry-After 要求等待时同样暂停该端点的全部请求
+所有操作都不阻塞，调用方拿到需要等待的秒数后自行安排重试（线程和协程通用）
+"""
+
+import time
+import threading
+from typing import Optional
+
+from api_errors import RATE_LIMITED, APIErrorInfo, classify_api_error
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+PROBE_WAIT = 1.0  # 探测请求进行中时，其他请求的等待时间
+MAX_COOLDOWN = 300.0
+
+_STATE_NAMES = {CLOSED: '正常', OPEN: '熔断', HALF_OPEN: '探测中'}
+
+
+class CircuitBreaker:
+    """单个端点的熔断器"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30.0, logger=None):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+        self.pauses = 0
+
+    def before_call(self) -> Optional[float]:
+        """请求前调用：允许发送返回None，否则返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                if now < self.open_until:
+                    # 服务端要求暂停（Retry-After）
+                    return self.open_until - now
+                return None
+            if self.state == OPEN:
+                if now < self.open_until:
+                    return self.open_until - now
+                self.state = HALF_OPEN
+                self.probing = False
+            # 半开状态只放行一个探测请求
+            if self.probing:
+                return PROBE_WAIT
+            self.probing = True
+            self._log(f"🔌 端点 {self.name} 冷却结束，发送探测请求")
+            return None
+
+    def available(self) -> bool:
+        """不改变状态地判断现在能否发送请求"""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                return not self.probing
+            return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                self._log(f"🔌 端点 {self.name} 探测成功，恢复请求")
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+
+    def abort_probe(self):
+        """请求被取消等未得出结果时调用：只清除探测标记，不计成功也不计失败，下一个请求重新探测"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self, info: APIErrorInfo):
+        """按错误类型更新状态，与端点健康无关的错误（如安全拦截）视为端点正常"""
+        if not info.endpoint_failure:
+            # 端点能正常响应（包括429），只是服务端要求等待时暂停发送
+            self.record_success()
+            if info.kind == RATE_LIMITED and info.retry_after:
+                self.pause(info.retry_after)
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                # 探测失败，加倍冷却
+                self.cooldown = min(MAX_COOLDOWN, self.cooldown * 2)
+                self._open(now)
+                return
+            self.failures += 1
+            if self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open(now)
+
+    def pause(self, seconds: float):
+        """按服务端要求暂停发送"""
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until > self.open_until:
+                self.open_until = until
+                self.pauses += 1
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.probing = False
+        self.open_until = now + self.cooldown
+        self.trips += 1
+        self._log(f"🔌 端点 {self.name} 连续失败 {self.failures} 次，熔断 {self.cooldown:.0f} 秒")
+
+    def _log(self, message: str):
+        if self.logger:
+            self.logger.warning(message)
+
+    def describe_live(self) -> str:
+        """用于进度条显示，正常时为空"""
+        with self.lock:
+            if self.state == CLOSED and time.monotonic() >= self.open_until:
+                return ''
+            return _STATE_NAMES[self.state] if self.state != CLOSED else '暂停'
+
+    def describe(self) -> str:
+        return f"{_STATE_NAMES[self.state]}，熔断 {self.trips} 次，按Retry-After暂停 {self.pauses} 次"
+
+    def track(self) -> '_CallTracker':
+        """包裹一次API调用，按结果更新状态（同时支持 with 和 async with）"""
+        return _CallTracker(self)
+
+
+class _CallTracker:
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.breaker.record_success()
+        elif isinstance(exc, Exception):
+            self.breaker.record_failure(classify_api_error(exc))
+        else:
+            # 任务被取消等，放弃本次探测，否则半开状态会一直等待一个不会结束的探测请求
+            self.breaker.abort_probe()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
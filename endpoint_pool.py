@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多端点/多密钥负载均衡
+每个端点（API地址 + 密钥）有自己的权重、自适应并发上限、RPM/TPM配额和熔断器
+每次请求按健康度选择端点：延迟EWMA越低、错误率越低、剩余配额越多、当前负载越轻得分越高，
+熔断或被要求暂停的端点不参与分发；某个密钥被限流或端点故障时，立即换到其他端点重试
+端点的客户端由各引擎按自己的SDK创建，本模块不依赖具体SDK
+"""
+
+import threading
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from adaptive_limiter import AdaptiveLimiter, AsyncAdaptiveLimiter
+from api_errors import APIErrorInfo, RATE_LIMITED, classify_api_error
+from circuit_breaker import CircuitBreaker
+from rate_limiter import RateLimiter
+
+ERROR_SMOOTHING = 0.1  # 错误率EWMA的平滑系数
+DEFAULT_LATENCY = 1.0  # 所有端点都还没有延迟数据时使用的延迟(秒)
+BUDGET_FLOOR = 0.1  # 配额耗尽的端点仍保留少量得分，排队等待配额恢复
+DEFAULT_IMAGE_FORMATS = ('jpeg', 'webp', 'png')  # 端点默认接受的图片格式（Gemini和OpenAI兼容接口都支持）
+
+# 端点配置中可以单独设置的字段，未设置时沿用顶层配置
+ENDPOINT_FIELDS = ('name', 'base_url', 'api_key', 'model_name', 'weight', 'max_concurrent',
+                   'min_concurrent', 'rpm_limit', 'tpm_limit',
+                   'circuit_failure_threshold', 'circuit_cooldown', 'image_formats')
+
+
+class Endpoint:
+    """单个API端点（地址 + 密钥）"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, model_name: str,
+                 weight: float = 1.0, max_concurrent: int = 20, min_concurrent: int = 1,
+                 rpm_limit: float = 0, tpm_limit: float = 0,
+                 circuit_failure_threshold: int = 5, circuit_cooldown: float = 30,
+                 image_formats: Sequence[str] = DEFAULT_IMAGE_FORMATS, logger=None, asynchronous: bool = False):
+        self.name = name
+        self.base_url = (base_url or '').strip()  # 为空表示使用官方Gemini SDK
+        self.api_key = api_key
+        self.model_name = model_name
+        self.weight = max(0.01, float(weight))
+        self.image_formats = tuple(fmt.lower() for fmt in image_formats)  # 接受的图片格式
+        limiter_class = AsyncAdaptiveLimiter if asynchronous else AdaptiveLimiter
+        self.limiter = limiter_class(max_concurrent, min_concurrent)
+        self.rate_limiter = RateLimiter(rpm_limit, tpm_limit)
+        self.breaker = CircuitBreaker(name, circuit_failure_threshold, circuit_cooldown, logger)
+        self.client = None  # 由引擎创建
+        self.lock = threading.Lock()
+        self.assigned = 0  # 已分发到该端点、尚未结束的请求数
+        self.dispatched = 0
+        self.errors = 0
+        self.error_rate = 0.0
+
+    @property
+    def uses_sdk(self) -> bool:
+        return not self.base_url
+
+    def score(self, default_latency: float) -> float:
+        """健康度得分，越高越优先"""
+        latency = self.limiter.ewma_latency or default_latency
+        load = self.assigned / self.limiter.current
+        budget = self.rate_limiter.headroom()
+        return self.weight * (1.0 - self.error_rate) * (BUDGET_FLOOR + budget) / (latency * (1.0 + load))
+
+    def record(self, error: Optional[APIErrorInfo]):
+        """记录一次调用结果，更新错误率和熔断状态"""
+        failed = error is not None and (error.kind == RATE_LIMITED or error.endpoint_failure)
+        self.release()
+        with self.lock:
+            if failed:
+                self.errors += 1
+            self.error_rate += ERROR_SMOOTHING * (float(failed) - self.error_rate)
+        if error is None:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure(error)
+
+    def release(self):
+        """请求结束（无论结果如何）"""
+        with self.lock:
+            self.assigned -= 1
+
+    def abandon(self):
+        """已分发但没有完成调用（任务被取消、配额不足改为稍后重试）：释放名额并放弃熔断器的探测，不计入健康状态"""
+        self.release()
+        self.breaker.abort_probe()
+
+    def track(self) -> '_EndpointCall':
+        """包裹一次API调用（同时支持 with 和 async with）"""
+        return _EndpointCall(self)
+
+    def describe(self) -> List[str]:
+        latency = f"{self.limiter.ewma_latency * 1000:.0f} ms" if self.limiter.ewma_latency else "无数据"
+        lines = [
+            f"端点 {self.name}: 权重 {self.weight:g}，分发 {self.dispatched} 次，"
+            f"失败 {self.errors} 次（近期错误率 {self.error_rate:.0%}），延迟 {latency}",
+            f"  并发上限: {self.limiter.describe()}",
+            f"  熔断器: {self.breaker.describe()}",
+        ]
+        if self.rate_limiter.enabled:
+            lines.append(f"  速率限制: {self.rate_limiter.describe()}")
+        return lines
+
+
+class _EndpointCall:
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        return self.endpoint
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.endpoint.record(None)
+        elif isinstance(exc, Exception):
+            self.endpoint.record(classify_api_error(exc))
+        else:
+            # 任务被取消等，不计入端点健康状态；放弃本次探测，否则熔断器会一直等待它结束
+            self.endpoint.abandon()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class EndpointPool:
+    """按健康度在多个端点之间分发请求"""
+
+    def __init__(self, endpoints: Sequence[Endpoint]):
+        if not endpoints:
+            raise ValueError("至少需要配置一个API端点")
+        sdk_keys = {endpoint.api_key for endpoint in endpoints if endpoint.uses_sdk}
+        if len(sdk_keys) > 1:
+            raise ValueError("官方Gemini SDK只能使用一个API密钥，多个密钥请配置OpenAI兼容地址(base_url)")
+        self.endpoints = list(endpoints)
+        self.lock = threading.Lock()
+        self.failovers = 0
+
+    def __iter__(self) -> Iterator[Endpoint]:
+        return iter(self.endpoints)
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    @property
+    def max_concurrency(self) -> int:
+        """所有端点并发上限之和"""
+        return sum(endpoint.limiter.max_limit for endpoint in self.endpoints)
+
+    @property
+    def rate_limited(self) -> bool:
+        """所有端点都配置了RPM/TPM配额"""
+        return all(endpoint.rate_limiter.enabled for endpoint in self.endpoints)
+
+    @property
+    def image_formats(self) -> Tuple[str, ...]:
+        """所有端点都接受的图片格式"""
+        return tuple(fmt for fmt in self.endpoints[0].image_formats
+                     if all(fmt in endpoint.image_formats for endpoint in self.endpoints))
+
+    @property
+    def model_key(self) -> str:
+        """审查缓存中记录结论所用的模型标识（未指定模型的请求由哪个端点处理，就用该端点的模型）
+
+        所有端点使用同一模型时就是该模型；端点各自指定了不同模型时为排序后以+连接的全部模型，
+        这些模型的结论共用同一组缓存，不会与只使用其中某一个模型时的缓存混用
+        """
+        return '+'.join(sorted({endpoint.model_name for endpoint in self.endpoints}))
+
+    def _default_latency(self) -> float:
+        # 还没有延迟数据的端点按当前最快端点估计，保证新端点能分到请求
+        latencies = [e.limiter.ewma_latency for e in self.endpoints if e.limiter.ewma_latency]
+        return min(latencies) if latencies else DEFAULT_LATENCY
+
+    def choose(self) -> Tuple[Optional[Endpoint], float]:
+        """选择一个端点，返回 (端点, 0)；所有端点都不可用时返回 (None, 需要等待的秒数)"""
+        with self.lock:
+            default_latency = self._default_latency()
+            # 有空闲并发名额的端点优先，其次按健康度
+            ranked = sorted(
+                self.endpoints,
+                key=lambda e: (e.assigned < e.limiter.current, e.score(default_latency)),
+                reverse=True
+            )
+            waits = []
+            for endpoint in ranked:
+                pause = endpoint.breaker.before_call()
+                if pause is None:
+                    with endpoint.lock:
+                        endpoint.assigned += 1
+                        endpoint.dispatched += 1
+                    return endpoint, 0.0
+                waits.append(pause)
+            return None, min(waits)
+
+    def can_fail_over(self, endpoint: Optional[Endpoint], error: APIErrorInfo, attempt: int) -> bool:
+        """限流或端点故障时，若还有其他可用端点则立即换端点重试
+
+        每张图片最多连续换端点 端点数-1 次，之后按正常退避等待，避免所有密钥都被限流时空转
+        """
+        if endpoint is None or len(self.endpoints) < 2 or attempt >= len(self.endpoints) - 1:
+            return False
+        if not (error.kind == RATE_LIMITED or error.endpoint_failure):
+            return False
+        if any(other is not endpoint and other.breaker.available() for other in self.endpoints):
+            with self.lock:
+                self.failovers += 1
+            return True
+        return False
+
+    def describe_live(self) -> str:
+        """用于进度条显示：总并发和异常端点的状态"""
+        current = sum(endpoint.limiter.current for endpoint in self.endpoints)
+        text = f"{current}/{self.max_concurrency}"
+        for endpoint in self.endpoints:
+            state = endpoint.breaker.describe_live()
+            if state:
+                text += f" {endpoint.name}:{state}" if len(self.endpoints) > 1 else f" {state}"
+        return text
+
+    def describe(self) -> List[str]:
+        """用于最终统计"""
+        lines = []
+        for endpoint in self.endpoints:
+            lines.extend(endpoint.describe())
+        if len(self.endpoints) > 1:
+            lines.append(f"端点切换: {self.failovers} 次")
+        return lines
+
+
+def _endpoint_name(base_url: str, index: int, count: int) -> str:
+    """未配置名称时用域名命名，多个端点时加上序号（不在日志中暴露密钥）"""
+    host = urlparse(base_url).netloc if base_url else 'Gemini'
+    return host if count == 1 else f"{host}#{index + 1}"
+
+
+def build_endpoint_pool(entries: Optional[Sequence[Mapping]], defaults: Dict,
+                        logger=None, asynchronous: bool = False) -> EndpointPool:
+    """按配置创建端点池
+
+    entries 为配置文件中的 endpoints 列表，每项的字段见 ENDPOINT_FIELDS，未设置的沿用 defaults
+    （由顶层的 base_url、api_key、max_concurrent、rpm_limit 等组成）；列表为空时只使用顶层配置的单个端点
+    """
+    entries = list(entries or []) or [{}]
+    endpoints = []
+    for index, entry in enumerate(entries):
+        merged = dict(defaults)
+        merged.update({key: value for key, value in entry.items() if key in ENDPOINT_FIELDS})
+        merged['name'] = entry.get('name') or _endpoint_name(merged.get('base_url'), index, len(entries))
+        merged['min_concurrent'] = min(merged.get('min_concurrent', 1), merged['max_concurrent'])
+        endpoints.append(Endpoint(logger=logger, asynchronous=asynchronous, **merged))
+    return EndpointPool(endpoints)
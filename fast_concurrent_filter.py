@@ -7,7 +7,6 @@
 
 import os
 import json
-import base64
 import shutil
 import re
 import logging
@@ -16,13 +15,27 @@ import hashlib
 import asyncio
 from pathlib import Path
 import google.generativeai as genai
-from openai import OpenAI
-from PIL import Image
-import tempfile
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List, Dict, Optional, Set
 import threading
 import sys
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from verdict_cache import VerdictCache, hash_file, compute_prompt_version, DEFAULT_CACHE_PATH
+from perceptual_index import PerceptualIndex
+from scan_manifest import open_manifest, DEFAULT_MANIFEST_PATH
+from pipeline import LoopLagMonitor, RetryLater, create_process_pool, run_bounded_async, aiter_in_background
+from image_payload import (PreparedImage, prepare_image, resolve_upload_format, DEFAULT_PAYLOAD_BUDGET_MB,
+                           DEFAULT_PASSTHROUGH_KB)
+from payload_profiles import profile_for_model, DEFAULT_MIN_DIMENSION
+from async_transport import OpenAICompatibleClient
+from rate_limiter import estimate_tokens
+from api_errors import classify_api_error, NETWORK, RATE_LIMITED, SAFETY, TIMEOUT
+from endpoint_pool import build_endpoint_pool, DEFAULT_IMAGE_FORMATS
+from batch_review import BatchRetry, AsyncReviewBatcher, build_batch_prompt, fits_in_batch, parse_batch_verdicts
+from review_cascade import ModelUsage, ProgressiveReview, ReviewCascade
+from tiled_review import TiledReview
 
 def get_terminal_height():
     """获取终端高度"""
@@ -91,6 +104,27 @@ def draw_fixed_bottom_progress(current, total, stats_info="", prefix="审查进
 
 # 注意：API配置现在从配置文件读取
 
+# 审查提示词
+REVIEW_PROMPT = """
+请仔细审查这张图片是否适合16岁及以上青少年查看。
+
+重点检查：
+1. 是否包含性暗示、性行为或裸体内容
+2. 是否有过度暴露的服装（如比基尼、情趣内衣等）
+3. 是否有挑逗性姿势或表情
+4. 是否对未成年外观的角色进行性化描绘
+5. 整体是否存在不适宜青少年的内容
+
+请以JSON格式返回结果：
+{
+    "suitable_for_teens": true/false,
+    "reason": "详细的判断理由",
+    "confidence": 0.0-1.0
+}
+
+如果有任何疑虑，请判定为不适合。
+"""
+
 @dataclass
 class FilterConfig:
     """过滤器配置"""
@@ -100,6 +134,36 @@ class FilterConfig:
     timeout: int = 60
     target_folder: str = "@色图"
     log_level: str = "INFO"
+    verdict_cache: bool = True
+    cache_path: str = DEFAULT_CACHE_PATH
+    phash_index: bool = True
+    phash_max_distance: int = 4
+    manifest_path: str = DEFAULT_MANIFEST_PATH
+    max_pending: int = 0  # 任务队列长度，0表示自动（并发数的2倍）
+    min_concurrent: int = 1  # 自适应并发的下限
+    rpm_limit: float = 0  # 每分钟请求数配额，0表示不限制（改用api_delay固定间隔）
+    tpm_limit: float = 0  # 每分钟token数配额，0表示不限制
+    payload_budget_mb: float = DEFAULT_PAYLOAD_BUDGET_MB  # 单张图片编码后(Base64)的大小上限
+    preprocess_workers: int = 0  # 预处理进程数，0表示按CPU核数
+    disk_workers: int = 4  # 文件移动/重命名/哈希/缓存读写的线程数
+    loop_lag_warn_ms: int = 100  # 事件循环阻塞超过该值时记录警告
+    circuit_failure_threshold: int = 5  # 端点连续失败多少次后熔断
+    circuit_cooldown: float = 30  # 熔断冷却时间(秒)，探测失败时加倍
+    endpoints: List[dict] = field(default_factory=list)  # 多个API地址/密钥，为空时只使用顶层配置
+    batch_size: int = 1  # 每个请求最多审查几张图片，1表示逐张审查
+    batch_wait_ms: int = 500  # 凑批的最长等待时间(毫秒)
+    cascade_model: str = ''  # 初审用的快速模型，留空不启用级联
+    cascade_confidence: float = 0.8  # 初审置信度低于该值时交给强模型复审
+    model_prices: Dict[str, float] = field(default_factory=dict)  # 模型 -> 每百万输入token的价格，用于估算费用
+    progressive_dimension: int = 0  # 渐进分辨率：先发送该边长的低分辨率版本（如512），0表示不启用
+    progressive_confidence: float = 0.8  # 低分辨率审查置信度低于该值（或回复格式异常）时发送原图
+    tile_min_aspect: float = 0  # 长短边之比达到该值的超长/超宽图片分块审查（如2.5），0表示不启用
+    tile_size: int = 0  # 分块边长，0表示按模型计费规则的图片块尺寸
+    payload_profile: str = 'auto'  # 图片计费规则: auto(按模型名称判断)/gemini/openai/none(固定1024px)
+    min_image_dimension: int = DEFAULT_MIN_DIMENSION  # 按计费规则选择尺寸时长边的下限
+    upload_format: str = 'jpeg'  # 上传编码格式: jpeg/webp/avif（需要Pillow支持且所有端点都接受）
+    image_formats: List[str] = field(default_factory=lambda: list(DEFAULT_IMAGE_FORMATS))  # 端点接受的图片格式
+    passthrough_max_kb: int = DEFAULT_PASSTHROUGH_KB  # 不超过该大小、尺寸和格式都符合要求的图片直接发送原文件，0表示不启用
 
 @dataclass
 class ProcessingStats:
@@ -111,16 +175,79 @@ class ProcessingStats:
     skipped: int = 0
     errors: int = 0
     skipped_ai_reject: int = 0
+    retries: int = 0
+    cache_hits: int = 0
+    phash_hits: int = 0
+    encoded: int = 0
+    encode_time: float = 0.0
+    encode_time_max: float = 0.0
+    image_tokens: int = 0  # 按计费规则估算的图片token数之和
+    passthrough: int = 0  # 直接发送原文件的图片
 
 class FastConcurrentImageFilter:
     def __init__(self, config: FilterConfig = None):
         self.config = config or self.load_config()
-        self.client = None  # 将在load_config后初始化
         self.stats = ProcessingStats()
         self.moved_images = []
         self.processed_files: Set[str] = set()
+        self.retry_attempts: Dict[str, int] = {}  # 每张图片已重试的次数
         self.lock = threading.Lock()
         self.setup_logging()
+        self.scan_manifest = open_manifest(self.config.manifest_path)
+        self.scan_done = False
+        
+        # 阻塞操作不在事件循环线程中执行：解码/编码用进程池，文件和数据库操作用磁盘线程池
+        self.cpu_executor = None
+        self.disk_executor = None
+        self.lag_monitor = LoopLagMonitor(self.config.loop_lag_warn_ms / 1000, logger=self.logger)
+        
+        # 每个端点（地址 + 密钥）有自己的自适应并发上限、RPM/TPM令牌桶和熔断器，每次调用按健康度选择端点
+        self.endpoints = self.create_endpoints()
+        # 直接传入配置对象时不经过load_config，记录结论和选择计费规则所用的模型以端点解析后的配置为准
+        if not getattr(self, 'model_name', ''):
+            self.model_name = next(iter(self.endpoints)).model_name
+        # 按模型统计调用次数、耗时和估算费用；级联模式下先用快速模型初审
+        self.usage = ModelUsage(self.config.model_prices)
+        self.cascade = None
+        if self.config.cascade_model:
+            self.cascade = ReviewCascade(self.config.cascade_model, self.config.cascade_confidence)
+        # 渐进分辨率：第一级审查先发送低分辨率版本
+        self.progressive = None
+        if self.config.progressive_dimension > 0:
+            self.progressive = ProgressiveReview(self.config.progressive_dimension, self.config.progressive_confidence)
+        # 按模型的图片计费规则选择送审尺寸
+        self.payload_profile = profile_for_model(self.model_name, self.config.payload_profile)
+        # 上传编码格式：Pillow不支持或有端点不接受时改用JPEG
+        self.upload_format, reason = resolve_upload_format(
+            self.config.upload_format, {endpoint.name: endpoint.image_formats for endpoint in self.endpoints})
+        if reason:
+            self.logger.warning(f"上传格式改用JPEG: {reason}")
+        elif self.upload_format != 'jpeg':
+            print(f"🖼️ 上传格式: {self.upload_format.upper()}")
+        # 分块审查：超长/超宽图片的各分块并发审查
+        self.tiling = TiledReview() if self.config.tile_min_aspect > 0 else None
+        # 批量模式：多张图片合并为一个请求，按编号返回结论
+        self.batcher = None
+        if self.config.batch_size > 1:
+            self.batcher = AsyncReviewBatcher(self.config.batch_size, self.config.batch_wait_ms / 1000,
+                                              self.check_image_batch, self.logger)
+        
+        # 审查结果缓存（按文件内容哈希 + 模型 + 提示词版本）
+        self.verdict_cache = None
+        self.prompt_version = compute_prompt_version(REVIEW_PROMPT)
+        if self.config.verdict_cache:
+            try:
+                self.verdict_cache = VerdictCache(self.config.cache_path)
+            except Exception as e:
+                self.logger.warning(f"审查缓存不可用，将直接调用API: {e}")
+        
+        # 感知哈希索引，重新编码或缩放过的相似图片继承已有结论
+        self.perceptual_index = None
+        if self.config.phash_index:
+            try:
+                self.perceptual_index = PerceptualIndex(self.config.cache_path, self.config.phash_max_distance)
+            except Exception as e:
+                self.logger.warning(f"相似图片索引不可用: {e}")
         
     def setup_logging(self):
         """设置日志"""
@@ -146,269 +273,318 @@ class FastConcurrentImageFilter:
             self.api_key = config_data.get('api_key', '')
             self.model_name = config_data.get('model_name', 'gemini-2.5-pro')
             
-            if self.use_proxy and self.base_url:
-                print(f"🌐 使用代理服务器: {self.base_url}")
-                self.client = OpenAI(
-                    api_key=self.api_key,
-                    base_url=self.base_url
-                )
-                print(f"✅ API 配置成功，模型: {self.model_name}")
-            else:
-                print("🔑 使用官方 Gemini API")
-                genai.configure(api_key=self.api_key)
-                self.model = genai.GenerativeModel(self.model_name)
-                print(f"✅ API 配置成功，模型: {self.model_name}")
-            
             return FilterConfig(
                 max_concurrent=config_data.get('max_concurrent', 30),
                 api_delay=config_data.get('api_delay', 1.5),
                 max_retries=config_data.get('max_retries', 3),
                 timeout=config_data.get('timeout', 60),
                 target_folder=config_data.get('target_folder', '@色图'),
-                log_level=config_data.get('log_level', 'INFO')
+                log_level=config_data.get('log_level', 'INFO'),
+                verdict_cache=config_data.get('verdict_cache', True),
+                cache_path=config_data.get('cache_path', DEFAULT_CACHE_PATH),
+                phash_index=config_data.get('phash_index', True),
+                phash_max_distance=config_data.get('phash_max_distance', 4),
+                manifest_path=config_data.get('manifest_path', DEFAULT_MANIFEST_PATH),
+                max_pending=config_data.get('max_pending', 0),
+                min_concurrent=config_data.get('min_concurrent', 1),
+                rpm_limit=config_data.get('rpm_limit', 0),
+                tpm_limit=config_data.get('tpm_limit', 0),
+                payload_budget_mb=config_data.get('payload_budget_mb', DEFAULT_PAYLOAD_BUDGET_MB),
+                preprocess_workers=config_data.get('preprocess_workers', 0),
+                disk_workers=config_data.get('disk_workers', 4),
+                loop_lag_warn_ms=config_data.get('loop_lag_warn_ms', 100),
+                circuit_failure_threshold=config_data.get('circuit_failure_threshold', 5),
+                circuit_cooldown=config_data.get('circuit_cooldown', 30),
+                endpoints=config_data.get('endpoints', []),
+                batch_size=config_data.get('batch_size', 1),
+                batch_wait_ms=config_data.get('batch_wait_ms', 500),
+                cascade_model=config_data.get('cascade_model', ''),
+                cascade_confidence=config_data.get('cascade_confidence', 0.8),
+                model_prices=config_data.get('model_prices', {}),
+                progressive_dimension=config_data.get('progressive_dimension', 0),
+                progressive_confidence=config_data.get('progressive_confidence', 0.8),
+                tile_min_aspect=config_data.get('tile_min_aspect', 0),
+                tile_size=config_data.get('tile_size', 0),
+                payload_profile=config_data.get('payload_profile', 'auto'),
+                min_image_dimension=config_data.get('min_image_dimension', DEFAULT_MIN_DIMENSION),
+                upload_format=config_data.get('upload_format', 'jpeg'),
+                image_formats=config_data.get('image_formats', list(DEFAULT_IMAGE_FORMATS)),
+                passthrough_max_kb=config_data.get('passthrough_max_kb', DEFAULT_PASSTHROUGH_KB)
             )
         except Exception as e:
             if hasattr(self, 'logger'):
                 self.logger.warning(f"加载配置失败，使用默认配置: {e}")
             # 使用默认配置
             self.use_proxy = False
-            genai.configure(api_key='')
-            self.model = genai.GenerativeModel('gemini-1.5-flash')
+            self.base_url = ''
+            self.api_key = ''
+            self.model_name = 'gemini-1.5-flash'
             return FilterConfig()
 
+    def create_endpoints(self):
+        """按配置创建端点池，未配置 endpoints 时只使用顶层的地址和密钥
+
+        官方Gemini SDK的模型在这里创建，代理端点的aiohttp客户端在run()中创建（需要事件循环）
+        """
+        use_proxy = getattr(self, 'use_proxy', False)
+        endpoints = build_endpoint_pool(self.config.endpoints, {
+            'base_url': getattr(self, 'base_url', '') if use_proxy else '',
+            'api_key': getattr(self, 'api_key', ''),
+            'model_name': getattr(self, 'model_name', 'gemini-1.5-flash'),
+            'max_concurrent': self.config.max_concurrent,
+            'min_concurrent': self.config.min_concurrent,
+            'rpm_limit': self.config.rpm_limit,
+            'tpm_limit': self.config.tpm_limit,
+            'circuit_failure_threshold': self.config.circuit_failure_threshold,
+            'circuit_cooldown': self.config.circuit_cooldown,
+            'image_formats': self.config.image_formats,
+        }, self.logger, asynchronous=True)
+        for endpoint in endpoints:
+            if endpoint.uses_sdk:
+                print(f"🔑 [{endpoint.name}] 使用官方 Gemini API")
+                genai.configure(api_key=endpoint.api_key)
+                endpoint.client = genai.GenerativeModel(endpoint.model_name)
+            else:
+                print(f"🌐 [{endpoint.name}] 使用代理服务器: {endpoint.base_url}")
+        print(f"✅ API 配置成功，端点: {len(endpoints)} 个")
+        return endpoints
+
     def check_filename_for_adult_content(self, filename: str) -> bool:
         """检查文件名是否包含成人内容标识符 - 已禁用"""
         # 根据用户要求，不再依据文件名判断
         return False
 
-    def get_all_images(self) -> List[str]:
-        """获取所有图片文件"""
-        image_extensions = {'.webp', '.jpg', '.jpeg', '.png', '.gif', '.bmp'}
-        images = []
-
-        for root, dirs, files in os.walk('.'):
-            if self.config.target_folder in root:
-                continue
+    def discover_images(self):
+        """边扫描边产出未审查的图片，已发现数量实时计入统计"""
+        try:
+            for image_path in self.scan_manifest.scan('.', self.config.target_folder, include_approved=False):
+                with self.lock:
+                    self.stats.total += 1
+                yield image_path
+        finally:
+            self.scan_done = True
 
-            for file in files:
-                if Path(file).suffix.lower() in image_extensions:
-                    if "_审查已经通过" in file:
-                        continue
-                    file_path = os.path.join(root, file)
-                    images.append(file_path)
+    def validate_and_resize_image(self, image_path: str) -> PreparedImage:
+        """验证并自适应压缩图片，编码结果保存在内存中"""
+        prepared = prepare_image(image_path, self.config.payload_budget_mb, self.config.progressive_dimension,
+                                 self.config.tile_size, self.config.tile_min_aspect,
+                                 self.payload_profile, self.config.min_image_dimension, self.upload_format,
+                                 **self.passthrough_options())
+        if prepared.error:
+            self.logger.warning(f"图片处理失败: {prepared.error}")
+        return prepared
 
-        return images
+    async def run_on_disk(self, func, *args):
+        """在磁盘线程池中执行阻塞的文件/数据库操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.disk_executor, partial(func, *args))
 
-    def validate_and_resize_image(self, image_path: str) -> str:
-        """验证并自适应压缩图片"""
+    async def prepare_image_async(self, image_path: str) -> PreparedImage:
+        """在预处理进程池中解码、缩放和编码图片，进程池不可用时改为线程内处理"""
+        loop = asyncio.get_running_loop()
         try:
-            with Image.open(image_path) as img:
-                # 转换为RGB模式
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                
-                # 自适应压缩策略
-                # 1. 先尝试压缩尺寸
-                max_dimension = 1024  # 最大边长
-                if img.width > max_dimension or img.height > max_dimension:
-                    ratio = min(max_dimension / img.width, max_dimension / img.height)
-                    new_width = int(img.width * ratio)
-                    new_height = int(img.height * ratio)
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # 2. 保存为JPEG并尝试不同质量等级
-                temp_fd, temp_path = tempfile.mkstemp(suffix='.jpg')
-                os.close(temp_fd)
-                
-                # 尝试不同的压缩质量，确保文件大小合适
-                for quality in [85, 70, 55, 40]:
-                    img.save(temp_path, 'JPEG', quality=quality, optimize=True)
-                    
-                    # 检查压缩后的文件大小
-                    with open(temp_path, 'rb') as f:
-                        data = f.read()
-                        base64_size_mb = len(base64.b64encode(data)) / (1024 * 1024)
-                    
-                    # 如果小于8MB，使用这个质量
-                    if base64_size_mb < 8:
-                        return temp_path
-                
-                # 如果仍然太大，进一步缩小尺寸
-                max_dimension = 512
-                ratio = min(max_dimension / img.width, max_dimension / img.height)
-                new_width = int(img.width * ratio)
-                new_height = int(img.height * ratio)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                img.save(temp_path, 'JPEG', quality=40, optimize=True)
-                
-                return temp_path
-                
+            prepared = await loop.run_in_executor(
+                self.cpu_executor,
+                partial(prepare_image, image_path, self.config.payload_budget_mb, self.config.progressive_dimension,
+                        self.config.tile_size, self.config.tile_min_aspect,
+                        self.payload_profile, self.config.min_image_dimension, self.upload_format,
+                        **self.passthrough_options())
+            )
         except Exception as e:
-            self.logger.warning(f"图片处理失败: {e}")
-            return image_path
+            self.logger.warning(f"预处理进程池不可用，改为线程内处理: {e}")
+            return await asyncio.to_thread(self.validate_and_resize_image, image_path)
+        if prepared.error:
+            self.logger.warning(f"图片处理失败: {prepared.error}")
+        return prepared
+
+    def schedule_retry(self, image_path: str, process_id: str, retry_after: float = None) -> RetryLater:
+        """无限重试机制 - 确保100%审查覆盖率
 
-    async def retry_with_backoff(self, image_path: str, process_id: str, temp_path: str = None, img_base64: str = None):
-        """无限重试机制 - 确保100%审查覆盖率"""
-        attempt = 0
+        按指数退避计算等待时间（服务端给出Retry-After时以其为准），到期后由事件循环的定时器把任务重新放回队列，
+        已编码的图片数据保留，等待期间不占用工作协程
+        """
         max_backoff_delay = 300  # 最大退避延迟5分钟
-        
-        while True:
-            attempt += 1
-            try:
-                # 指数退避延迟，但有最大限制
-                backoff_delay = min(max_backoff_delay, self.config.api_delay * (1.5 ** min(attempt-1, 10)))
-                self.logger.info(f"[{process_id}] 第 {attempt} 次重试，等待 {backoff_delay:.1f}秒")
-                await asyncio.sleep(backoff_delay)
-                
-                # 如果没有img_base64，重新处理图片
-                if img_base64 is None:
-                    processed_path = self.validate_and_resize_image(image_path)
-                    if processed_path != image_path:
-                        temp_path = processed_path
-                    
-                    with open(processed_path, 'rb') as img_file:
-                        img_data = img_file.read()
-                    img_base64 = base64.b64encode(img_data).decode('utf-8')
-                
-                prompt = """
-请仔细审查这张图片是否适合16岁及以上青少年查看。
+        with self.lock:
+            self.stats.retries += 1
+            attempt = self.retry_attempts.get(image_path, 0) + 1
+            self.retry_attempts[image_path] = attempt
 
-重点检查：
-1. 是否包含性暗示、性行为或裸体内容
-2. 是否有过度暴露的服装（如比基尼、情趣内衣等）
-3. 是否有挑逗性姿势或表情
-4. 是否对未成年外观的角色进行性化描绘
-5. 整体是否存在不适宜青少年的内容
+        # 指数退避延迟，但有最大限制
+        backoff_delay = min(max_backoff_delay, self.config.api_delay * (1.5 ** min(attempt-1, 10)))
+        if retry_after is not None:
+            backoff_delay = min(max_backoff_delay, retry_after)
+        self.logger.info(f"[{process_id}] 第 {attempt} 次重试，{backoff_delay:.1f}秒后重新排队")
+        return RetryLater(backoff_delay)
 
-请以JSON格式返回结果：
-{
-    "suitable_for_teens": true/false,
-    "reason": "详细的判断理由",
-    "confidence": 0.0-1.0
-}
+    def finish_retries(self, image_path: str, process_id: str):
+        """审查成功后清除重试计数"""
+        with self.lock:
+            attempt = self.retry_attempts.pop(image_path, 0)
+        if attempt:
+            self.logger.info(f"[{process_id}] 重试成功 (第 {attempt} 次)")
 
-如果有任何疑虑，请判定为不适合。
-"""
+    async def call_endpoint(self, endpoint, prompt: str, images: List[PreparedImage], model_name: str = None) -> str:
+        """向指定端点发送一次审查请求（一张或按顺序排列的多张图片），返回模型输出的文本
 
-                if self.use_proxy and hasattr(self, 'client'):
-                    # 使用代理服务器 (OpenAI兼容格式)
-                    response = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=[
+        model_name为空时使用端点配置的模型
+        """
+        model_name = model_name or endpoint.model_name
+        if not endpoint.uses_sdk:
+            # 使用代理服务器 (OpenAI兼容格式)，aiohttp异步请求不阻塞事件循环
+            return await endpoint.client.chat_completion(
+                model_name,
+                [
+                    {
+                        "role": "user",
+                        "content": [{"type": "text", "text": prompt}] + [
                             {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{img_base64}"
-                                        }
-                                    }
-                                ]
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": prepared.to_data_url()
+                                }
                             }
-                        ],
-                        timeout=self.config.timeout
-                    )
-                    
-                    # 处理不同类型的响应
-                    if hasattr(response, 'choices') and response.choices:
-                        content = response.choices[0].message.content
-                    elif hasattr(response, 'content'):
-                        content = response.content
-                    else:
-                        # 处理字符串响应的情况
-                        content = str(response)
-                        # 尝试解析JSON字符串
-                        try:
-                            import json as json_module
-                            if content.startswith('{') and content.endswith('}'):
-                                parsed = json_module.loads(content)
-                                if 'choices' in parsed and parsed['choices']:
-                                    content = parsed['choices'][0]['message']['content']
-                        except:
-                            pass
+                            for prepared in images
+                        ]
+                    }
+                ],
+                timeout=self.config.timeout
+            )
+        # 使用官方 Gemini API 的异步接口，直接以内联数据发送已编码的字节
+        model = endpoint.client if model_name == endpoint.model_name else genai.GenerativeModel(model_name)
+        response = await model.generate_content_async(
+            [prompt] + [prepared.to_inline_blob() for prepared in images],
+            # retry=None 关闭SDK对503的内置重试，错误交给引擎的重试机制
+            request_options={'timeout': self.config.timeout, 'retry': None}
+        )
+        return response.text
+
+    async def request_review(self, image_path: str, process_id: str, prepared: PreparedImage,
+                             model_name: str = None, escalate_malformed: bool = False):
+        """调用一次API并解析结果，需要重试时抛出RetryLater
+
+        escalate_malformed为True时（低分辨率审查），回复格式异常不重试而是返回None，由调用方改用原图审查
+        """
+        endpoint = None
+        try:
+            # 未配置RPM/TPM配额时，首次调用前固定延迟（重试的等待由调度器负责）
+            if not self.endpoints.rate_limited and image_path not in self.retry_attempts:
+                await asyncio.sleep(self.config.api_delay)
+
+            prompt = REVIEW_PROMPT
+
+            # 选择最健康的端点；所有端点都熔断或被要求暂停时不发送请求，到期后由定时器重新排队
+            endpoint, pause = self.endpoints.choose()
+            if endpoint is None:
+                raise RetryLater(pause)
+
+            # 调用结果计入端点的错误率和熔断状态
+            async with endpoint.track():
+                # 按该端点的RPM/TPM配额等待，等待期间不占用并发名额
+                tokens = estimate_tokens(prompt, len(prepared.data), image_tokens=prepared.image_tokens)
+                await endpoint.rate_limiter.wait_async(tokens)
+                # 每次调用都要取得该端点的自适应并发名额，限流时自动收缩
+                async with endpoint.limiter.slot():
+                    started = time.monotonic()
+                    content = await self.call_endpoint(endpoint, prompt, [prepared], model_name)
+                    self.usage.record(model_name or endpoint.model_name, time.monotonic() - started, tokens)
+
+            # 解析JSON结果
+            try:
+                if '{' in content and '}' in content:
+                    start = content.find('{')
+                    end = content.rfind('}') + 1
+                    json_str = content[start:end]
+                    result = json.loads(json_str)
+                    if escalate_malformed and not isinstance(result.get('suitable_for_teens'), bool):
+                        return None
+                    return result
+                elif escalate_malformed:
+                    return None
                 else:
-                    # 使用官方 Gemini API
-                    import io
-                    img_data_bytes = base64.b64decode(img_base64)
-                    pil_image = Image.open(io.BytesIO(img_data_bytes))
-                    
-                    response = self.model.generate_content([prompt, pil_image])
-                    content = response.text
-                
-                # 解析JSON结果
-                try:
-                    if '{' in content and '}' in content:
-                        start = content.find('{')
-                        end = content.rfind('}') + 1
-                        json_str = content[start:end]
-                        result = json.loads(json_str)
-                        self.logger.info(f"[{process_id}] 重试成功 (第 {attempt} 次)")
-                        return result, temp_path
+                    # 关键词判断
+                    if any(word in content.lower() for word in ['不适合', 'false', '不建议']):
+                        return {"suitable_for_teens": False, "reason": "AI判断不适合", "confidence": 0.8}
                     else:
-                        # 关键词判断
-                        if any(word in content.lower() for word in ['不适合', 'false', '不建议']):
-                            self.logger.info(f"[{process_id}] 重试成功 (第 {attempt} 次)")
-                            return {"suitable_for_teens": False, "reason": "AI判断不适合", "confidence": 0.8}, temp_path
-                        else:
-                            self.logger.info(f"[{process_id}] 重试成功 (第 {attempt} 次)")
-                            return {"suitable_for_teens": True, "reason": "AI判断适合", "confidence": 0.8}, temp_path
-                except Exception as parse_error:
-                    # JSON解析失败也不应该默认通过，而是重试
-                    self.logger.warning(f"[{process_id}] 第 {attempt} 次重试JSON解析失败，将继续重试: {parse_error}")
-                    continue
-                
-            except Exception as e:
-                error_str = str(e)
-                
-                if ("SAFETY" in error_str or "BLOCKED" in error_str or
-                    "安全" in error_str or "blocked" in error_str.lower() or
-                    "safety" in error_str.lower()):
-                    self.logger.info(f"[{process_id}] Gemini安全过滤器检测到不适合内容: {image_path}")
-                    with self.lock:
-                        self.stats.skipped_ai_reject += 1
-                    return {
-                        "suitable_for_teens": False,
-                        "reason": "Gemini安全过滤器检测到不适合16岁及以上青少年的内容",
-                        "confidence": 1.0
-                    }, temp_path
-                
-                # 如果是429错误，继续重试
-                elif "429" in error_str or "Too Many Requests" in error_str:
-                    self.logger.warning(f"[{process_id}] 第 {attempt} 次重试遇到429错误，将继续重试")
-                    continue
-                
-                # 如果是网络错误，继续重试
-                elif any(keyword in error_str.lower() for keyword in [
-                    'connection', 'timeout', 'network', 'dns', 'unreachable', 'refused'
-                ]):
-                    self.logger.warning(f"[{process_id}] 第 {attempt} 次重试遇到网络错误: {e}，将继续重试")
-                    continue
-                
-                # 如果是其他错误，记录但继续重试
-                else:
-                    self.logger.warning(f"[{process_id}] 第 {attempt} 次重试失败: {e}，将继续重试")
-                    continue
+                        return {"suitable_for_teens": True, "reason": "AI判断适合", "confidence": 0.8}
+            except Exception as parse_error:
+                if escalate_malformed:
+                    return None
+                # JSON解析失败也不应该默认通过，而是重试
+                self.logger.warning(f"[{process_id}] JSON解析失败，将重试: {parse_error}")
+                raise self.schedule_retry(image_path, process_id)
 
-    async def check_image_safety(self, image_path: str, process_id: str):
-        """检查图片安全性"""
-        temp_path = None
-        
-        try:
-            # 1. 验证图片格式并自适应压缩
-            processed_path = self.validate_and_resize_image(image_path)
-            if processed_path != image_path:
-                temp_path = processed_path
+        except RetryLater:
+            raise
+        except Exception as e:
+            # 按结构化的状态码和响应头分类，服务端给出Retry-After时按其等待
+            error = classify_api_error(e)
+            retry_after = error.retry_after
+            # 该密钥被限流或端点故障时，还有其他可用端点则立即换端点重试
+            if self.endpoints.can_fail_over(endpoint, error, self.retry_attempts.get(image_path, 0)):
+                self.logger.info(f"[{process_id}] 端点 {endpoint.name} 暂不可用，换其他端点重试")
+                retry_after = 0
+
+            if error.kind == SAFETY:
+                self.logger.info(f"[{process_id}] Gemini安全过滤器检测到不适合内容: {image_path}")
+                with self.lock:
+                    self.stats.skipped_ai_reject += 1
+                return {
+                    "suitable_for_teens": False,
+                    "reason": "Gemini安全过滤器检测到不适合16岁及以上青少年的内容",
+                    "confidence": 1.0
+                }
+            
+            # 如果是429错误，稍后重试
+            elif error.kind == RATE_LIMITED:
+                self.logger.warning(f"[{process_id}] API限流，将重试直到成功: {image_path}")
+            
+            # 如果是网络错误，稍后重试
+            elif error.kind in (NETWORK, TIMEOUT):
+                self.logger.warning(f"[{process_id}] 网络错误: {e}，将重试")
+            
+            # 如果是其他错误，记录并稍后重试
+            else:
+                self.logger.warning(f"[{process_id}] API调用失败: {e}，将重试")
+            raise self.schedule_retry(image_path, process_id, retry_after)
+
+    async def check_image_batch(self, items) -> dict:
+        """一次请求审查多张图片，items为 (图片路径, 任务ID, 预处理结果) 列表
 
-            # 2. 读取图片并转换为Base64
-            with open(processed_path, 'rb') as img_file:
-                img_data = img_file.read()
+        返回 {序号: 结论}，没有有效结论的序号由调用方逐张审查
+        """
+        images = [prepared for _, _, prepared in items]
+        prompt = build_batch_prompt(len(images))
+        # 级联模式下批量请求只用于初审
+        model_name = self.cascade.screening_model if self.cascade else None
+        endpoint, pause = self.endpoints.choose()
+        if endpoint is None:
+            return {}
+        async with endpoint.track():
+            tokens = estimate_tokens(prompt, sum(len(p.data) for p in images), len(images),
+                                     sum(p.image_tokens for p in images))
+            await endpoint.rate_limiter.wait_async(tokens)
+            async with endpoint.limiter.slot():
+                started = time.monotonic()
+                content = await self.call_endpoint(endpoint, prompt, images, model_name)
+                self.usage.record(model_name or endpoint.model_name, time.monotonic() - started, tokens, len(images))
+        verdicts = parse_batch_verdicts(content, len(images))
+        if len(verdicts) < len(images):
+            self.logger.warning(f"批量审查只返回了 {len(verdicts)}/{len(images)} 张图片的有效结论，其余逐张审查")
+        return verdicts
 
-            img_base64 = base64.b64encode(img_data).decode('utf-8')
+    async def check_image_safety(self, image_path: str, process_id: str, prepared: PreparedImage = None,
+                                 model_name: str = None, escalate_malformed: bool = False):
+        """检查图片安全性，需要重试时抛出RetryLater；model_name为空时使用端点配置的模型"""
+        try:
+            # 1. 验证图片格式并自适应压缩（已预处理则直接使用）
+            if prepared is None:
+                prepared = await self.prepare_image_async(image_path)
+            if prepared.data is None:
+                raise ValueError(f"无法读取图片: {prepared.error}")
+
+            # 2. 检查编码后的数据大小（按Base64长度计算，无需真正编码）
+            base64_size_mb = prepared.base64_size / (1024 * 1024)
 
-            # 检查文件大小
-            base64_size_mb = len(img_base64) / (1024 * 1024)
             if base64_size_mb > 10:
                 # 图片过大不应该跳过，而是拒绝（更安全的做法）
                 self.logger.warning(f"[{process_id}] 图片过大 ({base64_size_mb:.2f}MB)，出于安全考虑拒绝: {image_path}")
@@ -416,16 +592,18 @@ class FastConcurrentImageFilter:
                     "suitable_for_teens": False,
                     "reason": f"图片过大({base64_size_mb:.2f}MB)，出于安全考虑拒绝",
                     "confidence": 1.0
-                }, temp_path
+                }
 
-            # 3. 调用API（无限重试机制）
-            return await self.retry_with_backoff(image_path, process_id, temp_path, img_base64)
+            # 3. 调用API
+            return await self.request_review(image_path, process_id, prepared, model_name, escalate_malformed)
                 
+        except RetryLater:
+            raise
         except Exception as e:
             self.logger.error(f"[{process_id}] 检查图片时出错，将重试: {e}")
-            return await self.retry_with_backoff(image_path, process_id, temp_path, None)
+            raise self.schedule_retry(image_path, process_id)
 
-    def move_inappropriate_image(self, image_path: str, reason: str, temp_path: str = None):
+    def move_inappropriate_image(self, image_path: str, reason: str):
         """移动不适合的图片"""
         try:
             path_obj = Path(image_path)
@@ -447,10 +625,6 @@ class FastConcurrentImageFilter:
             
             shutil.move(str(path_obj), str(target_path))
             
-            # 清理临时文件
-            if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                os.unlink(temp_path)
-            
             return {
                 "success": True,
                 "new_path": str(target_path),
@@ -490,6 +664,231 @@ class FastConcurrentImageFilter:
             self.logger.error(f"重命名失败: {e}")
             return {"success": False, "error": str(e)}
 
+    def passthrough_options(self) -> dict:
+        """快速路径的预处理参数：所有端点都接受的格式才直接发送，未启用相似图片索引时不解码"""
+        return {
+            'passthrough_kb': self.config.passthrough_max_kb,
+            'passthrough_formats': self.endpoints.image_formats,
+            'need_phash': self.perceptual_index is not None,
+        }
+
+    def record_encode(self, process_id: str, prepared: PreparedImage):
+        """记录单张图片的编码质量与耗时"""
+        if prepared.passthrough:
+            self.logger.info(f"[{process_id}] 直接发送原文件: {prepared.mime_type}, {len(prepared.data) / 1024:.0f}KB")
+            with self.lock:
+                self.stats.passthrough += 1
+                self.stats.image_tokens += prepared.image_tokens
+            return
+        if not prepared.encode_count:
+            return
+        self.logger.info(
+            f"[{process_id}] 编码: 质量 {prepared.quality}, {len(prepared.data) / 1024:.0f}KB, "
+            f"{prepared.encode_count} 次编码, 耗时 {prepared.encode_seconds * 1000:.0f}ms"
+            + (f", 估算 {prepared.image_tokens} tokens" if prepared.image_tokens else "")
+        )
+        with self.lock:
+            self.stats.encoded += 1
+            self.stats.image_tokens += prepared.image_tokens
+            self.stats.encode_time += prepared.encode_seconds
+            self.stats.encode_time_max = max(self.stats.encode_time_max, prepared.encode_seconds)
+
+    async def lookup_cached_verdict(self, image_path: str, process_id: str):
+        """按内容哈希查询审查缓存，返回(缓存结论, 内容哈希)"""
+        content_hash = None
+        cached = None
+        if self.verdict_cache:
+            try:
+                content_hash = await self.run_on_disk(hash_file, image_path)
+                cached = await self.run_on_disk(self.verdict_cache.get, content_hash, self.verdict_model, self.prompt_version)
+            except Exception as e:
+                self.logger.warning(f"[{process_id}] 读取审查缓存失败: {e}")
+            if cached:
+                self.logger.info(f"[{process_id}] 命中审查缓存: {image_path}")
+                with self.lock:
+                    self.stats.cache_hits += 1
+        return cached, content_hash
+
+    @property
+    def verdict_model(self) -> str:
+        """缓存和相似图片索引中记录结论所用的模型标识，启用级联或渐进分辨率时包含对应配置"""
+        model_name = self.endpoints.model_key
+        if self.cascade:
+            model_name = self.cascade.cache_key(model_name)
+        if self.progressive:
+            model_name = self.progressive.cache_key(model_name)
+        return model_name
+
+    async def request_verdict(self, image_path: str, process_id: str, prepared: PreparedImage,
+                              model_name: str = None, batch: bool = False, escalate_malformed: bool = False) -> dict:
+        """用指定模型审查一张图片，batch为True且启用批量模式时先与其他任务的图片合并为一个请求"""
+        if prepared.tiles:
+            result = await self.review_tiles(image_path, process_id, prepared, model_name)
+            self.finish_retries(image_path, process_id)
+            return result
+        # 重试中的图片和过大的图片不参与批量审查
+        if (batch and self.batcher and image_path not in self.retry_attempts
+                and prepared.data is not None and fits_in_batch(prepared.base64_size, self.batcher.size)):
+            try:
+                result = await self.batcher.review((image_path, process_id, prepared))
+            except BatchRetry as e:
+                # 整批被限流或端点故障，逐张请求只会放大压力，按退避稍后重试
+                raise self.schedule_retry(image_path, process_id, e.error.retry_after)
+            if result is not None:
+                return result
+        result = await self.check_image_safety(image_path, process_id, prepared, model_name, escalate_malformed)
+        self.finish_retries(image_path, process_id)
+        return result
+
+    async def review_tiles(self, image_path: str, process_id: str, prepared: PreparedImage,
+                           model_name: str = None) -> dict:
+        """各分块并发调用API，任一块不适合即判定整张图片不适合；需要重试时抛出RetryLater，重试只发送没有结论的分块"""
+        tiles = prepared.tiles
+        pending = self.tiling.remaining(image_path, len(tiles))
+        if len(pending) == len(tiles):
+            self.logger.info(f"[{process_id}] 分 {len(tiles)} 块审查: {image_path}")
+        tasks = {
+            asyncio.ensure_future(
+                self.check_image_safety(image_path, f"{process_id}#{index + 1}", tiles[index], model_name)
+            ): index
+            for index in pending
+        }
+        retry = None
+        waiting = set(tasks)
+        try:
+            while waiting:
+                done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        verdict = task.result()
+                    except RetryLater as e:
+                        retry = retry or e
+                        continue
+                    if self.tiling.record(image_path, tasks[task], verdict):
+                        # 已有分块不适合，其余分块不再审查
+                        waiting = set()
+        finally:
+            for task in tasks:
+                task.cancel()
+        if retry is not None and not self.tiling.decided(image_path, len(tiles)):
+            raise retry
+        return self.tiling.finish(image_path, len(tiles))
+
+    async def review_progressively(self, image_path: str, process_id: str, prepared: PreparedImage,
+                                   model_name: str = None) -> dict:
+        """第一级审查；启用渐进分辨率时先发送低分辨率版本，置信度低或回复格式异常时再发送原图"""
+        if self.progressive is None or prepared.tiles:
+            return await self.request_verdict(image_path, process_id, prepared, model_name, batch=True)
+        if prepared.preview is None:
+            self.progressive.record_small()
+            return await self.request_verdict(image_path, process_id, prepared, model_name, batch=True)
+        # 原图审查需要重试时不再重复低分辨率审查
+        if not self.progressive.awaiting_full(image_path):
+            result = await self.request_verdict(image_path, process_id, prepared.preview, model_name, batch=True,
+                                                escalate_malformed=True)
+            if not self.progressive.escalate(image_path, result):
+                return result
+            reason = "回复格式异常" if result is None else f"置信度 {result.get('confidence')}"
+            self.logger.info(f"[{process_id}] 低分辨率审查不确定 ({reason})，改用原图审查: {image_path}")
+        result = await self.request_verdict(image_path, process_id, prepared, model_name)
+        self.progressive.finish(image_path)
+        return result
+
+    async def review_with_cascade(self, image_path: str, process_id: str, prepared: PreparedImage) -> dict:
+        """调用API审查；启用级联时先用快速模型初审，置信度低或判定不适合的图片再用强模型复审"""
+        if self.cascade is None:
+            return await self.review_progressively(image_path, process_id, prepared)
+        # 复审需要重试时沿用之前的初审结论
+        if self.cascade.screening_result(image_path) is None:
+            screening = await self.review_progressively(image_path, process_id, prepared, self.cascade.screening_model)
+            if not self.cascade.escalate(image_path, screening):
+                return screening
+            self.logger.info(f"[{process_id}] 初审需要复审 (置信度 {screening.get('confidence')}): {image_path}")
+        result = await self.request_verdict(image_path, process_id, prepared)
+        self.cascade.finish(image_path, result)
+        return result
+
+    async def review_prepared_image(self, image_path: str, process_id: str, prepared: PreparedImage, content_hash):
+        """对已预处理的图片查找相似图片结论或调用API，并写入缓存"""
+        phash = prepared.phash
+        result = None
+        
+        # 1. 用感知哈希查找相似图片
+        if self.perceptual_index and phash is not None:
+            try:
+                match = await self.run_on_disk(self.perceptual_index.lookup, phash, self.verdict_model, self.prompt_version)
+            except Exception as e:
+                match = None
+                self.logger.warning(f"[{process_id}] 查询相似图片索引失败: {e}")
+            if match:
+                result, distance = match
+                self.logger.info(f"[{process_id}] 命中相似图片 (距离 {distance}): {image_path}")
+                with self.lock:
+                    self.stats.phash_hits += 1
+
+        # 2. 调用API
+        if result is None:
+            result = await self.review_with_cascade(image_path, process_id, prepared)
+            if self.perceptual_index and phash is not None:
+                try:
+                    await self.run_on_disk(self.perceptual_index.add, phash, self.verdict_model, self.prompt_version, result)
+                except Exception as e:
+                    self.logger.warning(f"[{process_id}] 写入相似图片索引失败: {e}")
+
+        if content_hash:
+            try:
+                await self.run_on_disk(self.verdict_cache.put, content_hash, self.verdict_model, self.prompt_version, result)
+            except Exception as e:
+                self.logger.warning(f"[{process_id}] 写入审查缓存失败: {e}")
+
+        return result
+
+    async def apply_verdict(self, image_path: str, process_id: str, result: dict):
+        """根据审查结论移动或标记图片"""
+        if result.get("suitable_for_teens") is False:
+            self.logger.warning(f"[{process_id}] 不适合: {image_path} - {result.get('reason')}")
+            move_result = await self.run_on_disk(self.move_inappropriate_image, image_path, result.get('reason', '未知原因'))
+            if move_result["success"]:
+                with self.lock:
+                    self.stats.moved += 1
+                    self.moved_images.append(move_result)
+            else:
+                with self.lock:
+                    self.stats.errors += 1
+        elif result.get("suitable_for_teens") is True:
+            self.logger.info(f"[{process_id}] 通过: {image_path}")
+            rename_result = await self.run_on_disk(self.rename_approved_image, image_path)
+            if rename_result["success"]:
+                with self.lock:
+                    self.stats.approved += 1
+            else:
+                with self.lock:
+                    self.stats.errors += 1
+        else:
+            self.logger.warning(f"[{process_id}] 跳过: {image_path} - {result.get('reason')}")
+            with self.lock:
+                self.stats.skipped += 1
+
+        with self.lock:
+            self.stats.processed += 1
+
+    async def review_and_apply(self, image_path: str, process_id: str, prepared: PreparedImage, content_hash):
+        """审查并应用结论；需要重试时抛出RetryLater，到期后带着同一份编码数据从这里继续"""
+        try:
+            if prepared.data is None:
+                # 读取失败的图片每次重试都重新处理
+                prepared = await self.prepare_image_async(image_path)
+            result = await self.review_prepared_image(image_path, process_id, prepared, content_hash)
+        except RetryLater as retry:
+            retry.resume = partial(self.review_and_apply, image_path, process_id, prepared, content_hash)
+            raise
+        try:
+            await self.apply_verdict(image_path, process_id, result)
+        except Exception as e:
+            self.logger.error(f"[{process_id}] 处理图片出错: {image_path}, 错误: {e}")
+            with self.lock:
+                self.stats.errors += 1
+
     async def process_single_image(self, image_path: str, process_id: str, semaphore: asyncio.Semaphore):
         """处理单张图片 - 真正的并发版本"""
         async with semaphore:  # 控制并发数
@@ -502,50 +901,26 @@ class FastConcurrentImageFilter:
 
                 self.logger.info(f"[{process_id}] 开始处理: {image_path}")
 
-                result, temp_path = await self.check_image_safety(image_path, process_id)
-
-                if result.get("suitable_for_teens") is False:
-                    self.logger.warning(f"[{process_id}] 不适合: {image_path} - {result.get('reason')}")
-                    move_result = self.move_inappropriate_image(image_path, result.get('reason', '未知原因'), temp_path)
-                    if move_result["success"]:
-                        with self.lock:
-                            self.stats.moved += 1
-                            self.moved_images.append(move_result)
-                    else:
-                        with self.lock:
-                            self.stats.errors += 1
-                elif result.get("suitable_for_teens") is True:
-                    self.logger.info(f"[{process_id}] 通过: {image_path}")
-                    rename_result = self.rename_approved_image(image_path)
-                    if rename_result["success"]:
-                        with self.lock:
-                            self.stats.approved += 1
-                    else:
-                        with self.lock:
-                            self.stats.errors += 1
-
-                    # 清理临时文件
-                    if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                        os.unlink(temp_path)
+                # 1. 精确缓存，命中则无需预处理和调用API
+                cached, content_hash = await self.lookup_cached_verdict(image_path, process_id)
+                if cached:
+                    await self.apply_verdict(image_path, process_id, cached)
                 else:
-                    self.logger.warning(f"[{process_id}] 跳过: {image_path} - {result.get('reason')}")
-                    with self.lock:
-                        self.stats.skipped += 1
-
-                    # 清理临时文件
-                    if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                        os.unlink(temp_path)
-
-                with self.lock:
-                    self.stats.processed += 1
+                    # 2. 预处理后审查；需要重试时RetryLater交给任务队列，稍后从review_and_apply继续
+                    prepared = await self.prepare_image_async(image_path)
+                    self.record_encode(process_id, prepared)
+                    await self.review_and_apply(image_path, process_id, prepared, content_hash)
 
+            except RetryLater:
+                raise
             except Exception as e:
                 self.logger.error(f"[{process_id}] 处理图片出错: {image_path}, 错误: {e}")
                 with self.lock:
                     self.stats.errors += 1
 
-            # 添加延迟避免API限制
-            await asyncio.sleep(self.config.api_delay)
+            # 未配置RPM/TPM配额时，用固定延迟避免API限制
+            if not self.endpoints.rate_limited:
+                await asyncio.sleep(self.config.api_delay)
 
     async def run(self):
         """运行过滤器 - 真正的并发版本"""
@@ -553,36 +928,61 @@ class FastConcurrentImageFilter:
         print("📁 不适合的图片将移动到 @色图 文件夹")
         print("✅ 通过的图片将添加 _审查已经通过 标记")
         print("🔍 新增：文件名成人内容检查")
-        print(f"⚡ 真正并发处理：{self.config.max_concurrent} 个任务同时进行")
+        # 工作协程数为各端点并发上限之和
+        workers = self.endpoints.max_concurrency
+        print(f"⚡ 真正并发处理：{workers} 个任务同时进行，端点: {len(self.endpoints)} 个")
         print()
 
-        images = self.get_all_images()
-        self.stats.total = len(images)
-
-        print(f"找到 {len(images)} 张图片需要处理")
-        print(f"配置: 并发数{self.config.max_concurrent}, 延迟{self.config.api_delay}秒, 超时{self.config.timeout}秒")
+        print("🔎 边扫描边审查：发现的图片立即进入处理队列")
+        print(f"配置: 并发数{workers}, 延迟{self.config.api_delay}秒, 超时{self.config.timeout}秒")
+        cpu_workers = self.config.preprocess_workers or os.cpu_count() or 1
+        disk_workers = max(1, self.config.disk_workers)
+        print(f"⚙️ 预处理进程: {cpu_workers} 个，磁盘线程: {disk_workers} 个")
         print()
 
         start_time = time.time()
 
         # 创建信号量控制并发数
-        semaphore = asyncio.Semaphore(self.config.max_concurrent)
-
-        # 创建所有任务但不立即执行
-        tasks = []
-        for i, image_path in enumerate(images):
-            process_id = f"worker_{i:04d}"
-            task = self.process_single_image(image_path, process_id, semaphore)
-            tasks.append(task)
+        semaphore = asyncio.Semaphore(workers)
 
         # 启动进度监控任务
-        progress_task = asyncio.create_task(self.monitor_progress(len(images), start_time))
+        progress_task = asyncio.create_task(self.monitor_progress(start_time))
+        lag_task = asyncio.create_task(self.lag_monitor.run())
 
-        # 并发执行所有任务
+        # 解码/编码放到进程池，文件移动、哈希、缓存读写放到磁盘线程池，事件循环只负责调度和网络
+        self.cpu_executor = create_process_pool(cpu_workers)
+        self.disk_executor = ThreadPoolExecutor(max_workers=disk_workers, thread_name_prefix='disk')
+
+        # 代理端点各自使用aiohttp连接池，连接数与该端点的并发上限一致
+        http_clients = []
+        for endpoint in self.endpoints:
+            if not endpoint.uses_sdk:
+                endpoint.client = OpenAICompatibleClient(
+                    endpoint.base_url, endpoint.api_key,
+                    max_connections=endpoint.limiter.max_limit,
+                    timeout=self.config.timeout
+                )
+                http_clients.append(endpoint.client)
+
+        # 生产者/消费者流水线：固定数量的工作协程从有界队列取任务
+        max_pending = self.config.max_pending or workers * 2
         try:
-            await asyncio.gather(*tasks)
+            for client in http_clients:
+                await client.start()
+            await run_bounded_async(
+                lambda i, image_path: self.process_single_image(image_path, f"worker_{i:04d}", semaphore),
+                aiter_in_background(self.discover_images()),
+                workers,
+                max_pending,
+                self.logger
+            )
         finally:
             progress_task.cancel()
+            lag_task.cancel()
+            for client in http_clients:
+                await client.close()
+            self.cpu_executor.shutdown()
+            self.disk_executor.shutdown()
 
         elapsed_time = time.time() - start_time
 
@@ -595,23 +995,51 @@ class FastConcurrentImageFilter:
         print(f"   跳过: {self.stats.skipped} 张")
         print(f"   AI拒绝: {self.stats.skipped_ai_reject} 张")
         print(f"   错误: {self.stats.errors} 张")
+        print(f"   重试次数: {self.stats.retries} 次")
+        print(f"   缓存命中: {self.stats.cache_hits} 张")
+        print(f"   相似图片命中: {self.stats.phash_hits} 张")
+        if self.stats.encoded:
+            avg_encode_ms = self.stats.encode_time / self.stats.encoded * 1000
+            print(f"   编码耗时: 平均 {avg_encode_ms:.0f} ms/张，最长 {self.stats.encode_time_max * 1000:.0f} ms")
+        prepared_count = self.stats.encoded + self.stats.passthrough
+        if prepared_count and self.config.passthrough_max_kb > 0:
+            print(f"   直接发送原文件: {self.stats.passthrough} 张"
+                  f"（占 {self.stats.passthrough / prepared_count:.0%}，未解码和重新编码）")
+        if prepared_count and self.payload_profile:
+            print(f"   图片token估算: 平均 {self.stats.image_tokens / prepared_count:.0f} tokens/张 "
+                  f"({self.payload_profile.name} 计费规则)")
+        for line in self.endpoints.describe():
+            print(f"   {line}")
+        if self.batcher:
+            print(f"   批量审查: {self.batcher.describe()}")
+        if self.cascade:
+            print(f"   级联审查: {self.cascade.describe()}")
+        if self.progressive:
+            print(f"   渐进分辨率: {self.progressive.describe()}")
+        if self.tiling:
+            print(f"   超长/超宽图片: {self.tiling.describe()}")
+        for line in self.usage.describe():
+            print(f"   模型 {line}")
+        print(f"   事件循环: {self.lag_monitor.describe()}")
         print(f"   耗时: {elapsed_time:.1f} 秒")
         if elapsed_time > 0:
             print(f"   平均速度: {self.stats.processed / elapsed_time:.2f} 张/秒")
 
-    async def monitor_progress(self, total: int, start_time: float):
-        """监控处理进度"""
+    async def monitor_progress(self, start_time: float):
+        """监控处理进度 - 扫描未结束时总数为已发现数量"""
         try:
             while True:
                 await asyncio.sleep(2)  # 更频繁地更新进度条
 
                 with self.lock:
                     processed = self.stats.processed
+                    total = self.stats.total
                     moved = self.stats.moved
                     approved = self.stats.approved
                     errors = self.stats.errors
+                scanning = not self.scan_done
                 
-                if processed >= total:
+                if not scanning and processed >= total:
                     # 完成时显示完整进度条
                     draw_fixed_bottom_progress(total, total, 
                                              stats_info="处理完成！",
@@ -622,15 +1050,21 @@ class FastConcurrentImageFilter:
                 elapsed = time.time() - start_time
                 if processed > 0:
                     avg_speed = processed / elapsed
-                    eta = (total - processed) / avg_speed if avg_speed > 0 else 0
+                    if scanning:
+                        remaining = f"扫描中(已发现{total})"
+                    else:
+                        eta = (total - processed) / avg_speed if avg_speed > 0 else 0
+                        remaining = f"剩余: {eta/60:.1f}分钟"
                     
                     # 构建统计信息
+                    concurrency = self.endpoints.describe_live()
                     stats_line = (f"处理中: {processed}/{total} | "
                                  f"通过: {approved} | "
                                  f"移动: {moved} | "
                                  f"错误: {errors} | "
                                  f"速度: {avg_speed:.1f}/秒 | "
-                                 f"剩余: {eta/60:.1f}分钟")
+                                 f"并发: {concurrency} | "
+                                 f"{remaining}")
                     
                     # 显示固定底部进度条
                     draw_fixed_bottom_progress(processed, total, 
@@ -638,7 +1072,7 @@ class FastConcurrentImageFilter:
                                              prefix="审查进度")
                 else:
                     draw_fixed_bottom_progress(processed, total, 
-                                             stats_info="准备开始处理...",
+                                             stats_info=f"准备开始处理...已发现{total}",
                                              prefix="审查进度")
                     
         except asyncio.CancelledError:
@@ -650,4 +1084,5 @@ async def main():
     await filter_system.run()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     asyncio.run(main())
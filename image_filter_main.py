@@ -10,17 +10,30 @@ import os
 import json
 import sys
 import time
-import base64
 import shutil
 import re
 import logging
 import threading
-import tempfile
 from pathlib import Path
+from typing import List
 import google.generativeai as genai
 from openai import OpenAI
-from PIL import Image
+import multiprocessing
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from verdict_cache import VerdictCache, hash_file, compute_prompt_version, DEFAULT_CACHE_PATH
+from perceptual_index import PerceptualIndex
+from scan_manifest import open_manifest, DEFAULT_MANIFEST_PATH
+from pipeline import ImagePipeline, RetryLater, iter_in_background
+from functools import partial
+from image_payload import (PreparedImage, prepare_image, resolve_upload_format, DEFAULT_PAYLOAD_BUDGET_MB,
+                           DEFAULT_PASSTHROUGH_KB)
+from payload_profiles import profile_for_model, DEFAULT_MIN_DIMENSION
+from rate_limiter import estimate_tokens
+from api_errors import classify_api_error, RATE_LIMITED, SAFETY
+from endpoint_pool import build_endpoint_pool, DEFAULT_IMAGE_FORMATS
+from batch_review import BatchRetry, ReviewBatcher, build_batch_prompt, fits_in_batch, parse_batch_verdicts
+from review_cascade import ModelUsage, ProgressiveReview, ReviewCascade
+from tiled_review import TiledReview
 
 class SimpleProgressBar:
     """最简单的单行进度条"""
@@ -148,8 +161,8 @@ class BottomProgressBar:
                 self.last_line = ""
                 print()  # 换行
 
-    def update(self, processed, total, speed=None, eta=None):
-        """更新进度条"""
+    def update(self, processed, total, speed=None, eta=None, scanning=False, stage_info=None, concurrency=None):
+        """更新进度条 - 扫描未结束时total为已发现数量"""
         if not self.is_active:
             return
 
@@ -163,12 +176,21 @@ class BottomProgressBar:
             bar = "█" * filled + "░" * (bar_width - filled)
 
             # 构建进度信息
-            progress_info = f"审查进度: [{bar}] {percentage:.1f}% ({processed}/{total})"
+            if scanning:
+                progress_info = f"审查进度: [{bar}] {percentage:.1f}% ({processed}/已发现{total})"
+            else:
+                progress_info = f"审查进度: [{bar}] {percentage:.1f}% ({processed}/{total})"
 
             if speed is not None:
                 progress_info += f" | 速度: {speed:.2f}张/秒"
             if eta is not None:
                 progress_info += f" | 剩余: {eta:.1f}分钟"
+            if scanning:
+                progress_info += " | 扫描中..."
+            if stage_info:
+                progress_info += f" | 排队 {stage_info}"
+            if concurrency:
+                progress_info += f" | 并发 {concurrency}"
 
             # 清除上一行并打印新的进度条
             if self.last_line:
@@ -208,8 +230,36 @@ def load_config():
         'api_key': '',
         'model_name': 'gemini-1.5-flash',
         'max_concurrent': 20,
+        'min_concurrent': 1,  # 自适应并发的下限
+        'rpm_limit': 0,  # 每分钟请求数配额，0表示不限制
+        'tpm_limit': 0,  # 每分钟token数配额，0表示不限制
+        'circuit_failure_threshold': 5,  # 端点连续失败多少次后熔断
+        'circuit_cooldown': 30,  # 熔断冷却时间(秒)，探测失败时加倍
+        'endpoints': [],  # 多个API地址/密钥，为空时只使用上面的 api_base_url/api_key
+        'batch_size': 1,  # 每个请求最多审查几张图片，1表示逐张审查
+        'batch_wait_ms': 500,  # 凑批的最长等待时间(毫秒)
+        'cascade_model': '',  # 初审用的快速模型，留空表示不启用级联审查
+        'cascade_confidence': 0.8,  # 初审置信度低于该值（或判定不适合）时交给 model_name 复审
+        'model_prices': {},  # 模型 -> 每百万输入token的价格，用于估算费用
+        'progressive_dimension': 0,  # 渐进分辨率：先发送该边长的低分辨率版本（如512），0表示不启用
+        'progressive_confidence': 0.8,  # 低分辨率审查置信度低于该值（或回复格式异常）时发送原图
+        'tile_min_aspect': 0,  # 长短边之比达到该值的超长/超宽图片分块审查（如2.5），0表示不启用
+        'tile_size': 0,  # 分块边长，0表示按模型计费规则的图片块尺寸
+        'payload_profile': 'auto',  # 图片计费规则: auto(按模型名称判断)/gemini/openai/none(固定1024px)
+        'min_image_dimension': DEFAULT_MIN_DIMENSION,  # 按计费规则选择尺寸时长边的下限
+        'upload_format': 'jpeg',  # 上传编码格式: jpeg/webp/avif（需要Pillow支持且所有端点都接受）
+        'image_formats': list(DEFAULT_IMAGE_FORMATS),  # 端点接受的图片格式，可在 endpoints 中按端点设置
+        'passthrough_max_kb': DEFAULT_PASSTHROUGH_KB,  # 不超过该大小、尺寸和格式都符合要求的图片直接发送原文件，0表示不启用
         'timeout': 60,
-        'target_folder': '@色图'
+        'target_folder': '@色图',
+        'verdict_cache': True,
+        'cache_path': DEFAULT_CACHE_PATH,
+        'phash_index': True,
+        'phash_max_distance': 4,
+        'manifest_path': DEFAULT_MANIFEST_PATH,
+        'max_pending': 0,  # 在途任务窗口，0表示自动
+        'preprocess_workers': 0,  # 预处理进程数，0表示按CPU核数
+        'payload_budget_mb': DEFAULT_PAYLOAD_BUDGET_MB  # 单张图片编码后(Base64)的大小上限
     }
     
     if os.path.exists(config_file):
@@ -305,57 +355,109 @@ def interactive_config(config):
     
     return config
 
-def count_images(config):
-    """统计图片数量"""
-    image_extensions = {'.webp', '.jpg', '.jpeg', '.png', '.gif', '.bmp'}
-    
-    total_images = 0
-    unprocessed_images = 0
-    approved_images = 0
-    
-    for root, dirs, files in os.walk('.'):
-        if config['target_folder'] in root:
-            continue
-            
-        for file in files:
-            if Path(file).suffix.lower() in image_extensions:
-                total_images += 1
-                if "_审查已经通过" in file:
-                    approved_images += 1
-                else:
-                    unprocessed_images += 1
+def count_images(config, manifest=None, refresh=True):
+    """统计图片数量 - 基于增量扫描清单，未变化的目录不再重新遍历"""
+    if manifest is None:
+        manifest = open_manifest(config.get('manifest_path', DEFAULT_MANIFEST_PATH))
+    if refresh:
+        manifest.refresh('.', config['target_folder'])
     
-    return total_images, unprocessed_images, approved_images
+    # 返回 (总图片数, 未处理数, 已审查数)
+    return manifest.counts()
 
 # ==================== 图片过滤功能 ====================
 
+# 审查提示词
+REVIEW_PROMPT = """
+请仔细审查这张图片是否适合16岁及以上青少年查看。
+
+重点检查：
+1. 是否包含性暗示、性行为或裸体内容
+2. 是否有过度暴露的服装（如比基尼、情趣内衣等）
+3. 是否有挑逗性姿势或表情
+4. 是否对未成年外观的角色进行性化描绘
+5. 整体是否存在不适宜青少年的内容
+
+请以JSON格式返回结果：
+{
+    "suitable_for_teens": true/false,
+    "reason": "详细的判断理由",
+    "confidence": 0.0-1.0
+}
+
+如果有任何疑虑，请判定为不适合。
+"""
+
 class UltraFastImageFilter:
     def __init__(self, config):
         self.config = config
-        self.original_max_workers = config['max_concurrent']
-        self.current_workers = config['max_concurrent']
-        
-        # 配置API客户端
+        # 配置API客户端：每个端点（地址 + 密钥）有自己的自适应并发上限、RPM/TPM令牌桶和熔断器，
+        # 每次调用按健康度选择端点
         try:
-            if config.get('api_base_url') and config['api_base_url'].strip():
-                # 使用代理服务器（OpenAI兼容格式）
-                print(f"🌐 使用代理服务器: {config['api_base_url']}")
-                self.client = OpenAI(
-                    api_key=config['api_key'],
-                    base_url=config['api_base_url']
-                )
-                self.use_proxy = True
-            else:
-                # 使用官方Gemini API
-                print("🌐 使用官方Gemini服务器")
-                genai.configure(api_key=config['api_key'])
-                self.model = genai.GenerativeModel(config['model_name'])
-                self.use_proxy = False
+            self.endpoints = build_endpoint_pool(config.get('endpoints'), {
+                'base_url': config.get('api_base_url', ''),
+                'api_key': config['api_key'],
+                'model_name': config['model_name'],
+                'max_concurrent': config['max_concurrent'],
+                'min_concurrent': config.get('min_concurrent', 1),
+                'rpm_limit': config.get('rpm_limit', 0),
+                'tpm_limit': config.get('tpm_limit', 0),
+                'circuit_failure_threshold': config.get('circuit_failure_threshold', 5),
+                'circuit_cooldown': config.get('circuit_cooldown', 30),
+                'image_formats': config.get('image_formats', DEFAULT_IMAGE_FORMATS),
+            }, logging.getLogger(__name__))
+            for endpoint in self.endpoints:
+                if endpoint.uses_sdk:
+                    # 使用官方Gemini API
+                    print(f"🌐 [{endpoint.name}] 使用官方Gemini服务器")
+                    genai.configure(api_key=endpoint.api_key)
+                    endpoint.client = genai.GenerativeModel(endpoint.model_name)
+                else:
+                    # 使用代理服务器（OpenAI兼容格式）
+                    print(f"🌐 [{endpoint.name}] 使用代理服务器: {endpoint.base_url}")
+                    # 关闭SDK内置重试：429/5xx交给错误分类、熔断器、自适应并发和重试调度器统一处理，
+                    # 否则SDK会在工作线程中自行等待重试，这些错误不会被统计
+                    endpoint.client = OpenAI(api_key=endpoint.api_key, base_url=endpoint.base_url, max_retries=0)
                 
-            print(f"✅ API 配置成功，模型: {config['model_name']}")
+            print(f"✅ API 配置成功，模型: {config['model_name']}，端点: {len(self.endpoints)} 个")
         except Exception as e:
             print(f"❌ API 配置失败: {e}")
             raise
+
+        # 按模型统计调用次数、耗时和估算费用；级联模式下先用快速模型初审
+        self.usage = ModelUsage(config.get('model_prices'))
+        self.cascade = None
+        if config.get('cascade_model'):
+            self.cascade = ReviewCascade(config['cascade_model'], config.get('cascade_confidence', 0.8))
+        # 渐进分辨率：第一级审查先发送低分辨率版本
+        self.progressive = None
+        if config.get('progressive_dimension', 0) > 0:
+            self.progressive = ProgressiveReview(config['progressive_dimension'],
+                                                 config.get('progressive_confidence', 0.8))
+        # 按模型的图片计费规则选择送审尺寸
+        self.payload_profile = profile_for_model(config['model_name'], config.get('payload_profile', 'auto'))
+        # 上传编码格式：Pillow不支持或有端点不接受时改用JPEG
+        self.upload_format, reason = resolve_upload_format(
+            config.get('upload_format', 'jpeg'), {endpoint.name: endpoint.image_formats for endpoint in self.endpoints})
+        if reason:
+            print(f"⚠️ 上传格式改用JPEG: {reason}")
+        elif self.upload_format != 'jpeg':
+            print(f"🖼️ 上传格式: {self.upload_format.upper()}")
+        # 分块审查：超长/超宽图片的各分块在单独的线程池中并发审查，工作线程等待合并后的结论
+        self.tiling = None
+        self.tile_executor = None
+        if config.get('tile_min_aspect', 0) > 0:
+            self.tiling = TiledReview()
+            self.tile_executor = ThreadPoolExecutor(max_workers=self.endpoints.max_concurrency,
+                                                    thread_name_prefix='tile')
+
+        # 批量模式：多张图片合并为一个请求，按编号返回结论
+        self.batcher = None
+        if config.get('batch_size', 1) > 1:
+            self.batcher = ReviewBatcher(
+                config['batch_size'], config.get('batch_wait_ms', 500) / 1000,
+                self.check_image_batch, logging.getLogger(__name__)
+            )
             
         self.stats = {
             'total': 0,
@@ -366,18 +468,49 @@ class UltraFastImageFilter:
             'errors': 0,
             'ai_reject': 0,
             'rate_limit_errors': 0,
-            'retries': 0
+            'retries': 0,
+            'cache_hits': 0,
+            'phash_hits': 0,
+            'encoded': 0,
+            'encode_time': 0.0,
+            'encode_time_max': 0.0,
+            'image_tokens': 0,  # 按计费规则估算的图片token数之和
+            'passthrough': 0  # 直接发送原文件的图片
         }
         self.stats_lock = threading.Lock()
         self.processed_files = set()
         self.processed_lock = threading.Lock()
         self.progress_bar = BottomProgressBar()
+        self.scan_manifest = open_manifest(config.get('manifest_path', DEFAULT_MANIFEST_PATH))
+        self.scan_done = False
+        self.pipeline = None
+        
+        # 审查结果缓存（按文件内容哈希 + 模型 + 提示词版本）
+        self.verdict_cache = None
+        self.prompt_version = compute_prompt_version(REVIEW_PROMPT)
+        if config.get('verdict_cache', True):
+            try:
+                self.verdict_cache = VerdictCache(config.get('cache_path', DEFAULT_CACHE_PATH))
+            except Exception as e:
+                print(f"⚠️ 审查缓存不可用，将直接调用API: {e}")
+        
+        # 感知哈希索引，重新编码或缩放过的相似图片继承已有结论
+        self.perceptual_index = None
+        if config.get('phash_index', True):
+            try:
+                self.perceptual_index = PerceptualIndex(
+                    config.get('cache_path', DEFAULT_CACHE_PATH),
+                    config.get('phash_max_distance', 4)
+                )
+            except Exception as e:
+                print(f"⚠️ 相似图片索引不可用: {e}")
         
         # 智能异常处理相关
         self.rate_limit_count = 0
         self.rate_limit_lock = threading.Lock()
         self.last_rate_limit_time = 0
         self.adaptive_delay = 1.0
+        self.retry_attempts = {}  # 每张图片已重试的次数
         
         self.setup_logging()
 
@@ -413,170 +546,137 @@ class UltraFastImageFilter:
             with self.stats_lock:
                 self.stats['rate_limit_errors'] += 1
             
-            # 自适应调整并发数和延迟
+            # 并发数由自适应限制器调整，这里只调整重试延迟
             if self.rate_limit_count % 5 == 0:  # 每5次限流错误调整一次
-                # 减少并发数
-                new_workers = max(1, self.current_workers // 2)
-                if new_workers != self.current_workers:
-                    self.current_workers = new_workers
-                    self.logger.warning(f"🔧 检测到频繁限流，自动调整并发数至: {self.current_workers}")
+                self.logger.warning(f"🔧 检测到频繁限流，当前并发上限: {self.endpoints.describe_live()}")
                 
                 # 增加延迟
                 self.adaptive_delay = min(10.0, self.adaptive_delay * 1.5)
                 self.logger.warning(f"🔧 调整API调用延迟至: {self.adaptive_delay:.1f}秒")
 
-    def retry_with_backoff(self, image_path: str, worker_id: str, temp_path: str = None):
-        """无限重试机制 - 确保100%审查覆盖率"""
-        attempt = 0
+    def schedule_retry(self, image_path: str, worker_id: str, retry_after: float = None) -> RetryLater:
+        """无限重试机制 - 确保100%审查覆盖率
+
+        按指数退避计算等待时间（服务端给出Retry-After时以其为准），由流水线的定时器到期后
+        带着已编码的图片数据重新审查，等待期间不占用API线程
+        """
         max_backoff_delay = 300  # 最大退避延迟5分钟
+        with self.stats_lock:
+            self.stats['retries'] += 1
+            attempt = self.retry_attempts.get(image_path, 0) + 1
+            self.retry_attempts[image_path] = attempt
         
-        while True:
-            attempt += 1
-            try:
-                with self.stats_lock:
-                    self.stats['retries'] += 1
-                
-                # 指数退避延迟，但有最大限制
-                backoff_delay = min(max_backoff_delay, self.adaptive_delay * (1.5 ** min(attempt-1, 10)))
-                self.logger.info(f"[{worker_id}] 第 {attempt} 次重试，等待 {backoff_delay:.1f}秒")
-                time.sleep(backoff_delay)
-                
-                # 重新调用API检查
-                result, temp_path_result = self.check_image_safety(image_path, f"{worker_id}_retry_{attempt}")
-                
-                # 成功获得结果，返回
-                if result:
-                    self.logger.info(f"[{worker_id}] 重试成功 (第 {attempt} 次)")
-                    return result, temp_path_result
-                
-            except Exception as e:
-                error_str = str(e)
-                
-                # 如果是429错误，继续重试
-                if "429" in error_str or "Too Many Requests" in error_str:
-                    self.logger.warning(f"[{worker_id}] 第 {attempt} 次重试遇到429错误，将继续重试")
-                    self.handle_rate_limit_error()
-                    continue
-                
-                # 如果是网络错误，继续重试
-                elif any(keyword in error_str.lower() for keyword in [
-                    'connection', 'timeout', 'network', 'dns', 'unreachable', 'refused'
-                ]):
-                    self.logger.warning(f"[{worker_id}] 第 {attempt} 次重试遇到网络错误: {e}，将继续重试")
-                    continue
-                
-                # 如果是其他错误，记录但继续重试
-                else:
-                    self.logger.warning(f"[{worker_id}] 第 {attempt} 次重试失败: {e}，将继续重试")
-                    continue
-
-    def auto_adjust_concurrency(self):
-        """自动调整并发数"""
-        with self.rate_limit_lock:
-            # 如果最近1分钟内限流错误过多，降低并发数
-            recent_time = time.time() - 60
-            if self.last_rate_limit_time > recent_time and self.rate_limit_count > 10:
-                new_workers = max(1, self.current_workers - 2)
-                if new_workers != self.current_workers:
-                    self.current_workers = new_workers
-                    self.logger.warning(f"🔧 自动降低并发数至: {self.current_workers}")
-            else:
-                # 如果长时间没有限流错误，逐渐恢复并发数
-                if time.time() - self.last_rate_limit_time > 300:  # 5分钟没有限流
-                    if self.current_workers < self.original_max_workers:
-                        self.current_workers = min(self.original_max_workers, self.current_workers + 1)
-                        self.logger.info(f"🔧 恢复并发数至: {self.current_workers}")
-                        self.adaptive_delay = max(1.0, self.adaptive_delay * 0.9)
+        # 指数退避延迟，但有最大限制
+        backoff_delay = min(max_backoff_delay, self.adaptive_delay * (1.5 ** min(attempt-1, 10)))
+        if retry_after is not None:
+            backoff_delay = min(max_backoff_delay, retry_after)
+        self.logger.info(f"[{worker_id}] 第 {attempt} 次重试，{backoff_delay:.1f}秒后重新排队")
+        return RetryLater(backoff_delay)
+
+    def finish_retries(self, image_path: str, worker_id: str):
+        """审查成功后清除重试计数"""
+        with self.stats_lock:
+            attempt = self.retry_attempts.pop(image_path, 0)
+        if attempt:
+            self.logger.info(f"[{worker_id}] 重试成功 (第 {attempt} 次)")
 
     def check_filename_for_adult_content(self, filename: str) -> bool:
         """检查文件名是否包含成人内容标识符 - 已禁用"""
         # 根据用户要求，不再依据文件名判断
         return False
 
-    def get_all_images(self):
-        """获取所有图片文件"""
-        image_extensions = {'.webp', '.jpg', '.jpeg', '.png', '.gif', '.bmp'}
-        images = []
-
-        for root, dirs, files in os.walk('.'):
-            if self.config['target_folder'] in root:
-                continue
-
-            for file in files:
-                if Path(file).suffix.lower() in image_extensions:
-                    if "_审查已经通过" in file:
-                        continue
-                    file_path = os.path.join(root, file)
-                    images.append(file_path)
-
-        return images
-
-    def validate_and_resize_image(self, image_path: str) -> str:
-        """验证并自适应压缩图片"""
+    def discover_images(self):
+        """边扫描边产出未审查的图片，已发现数量实时计入统计"""
         try:
-            with Image.open(image_path) as img:
-                # 转换为RGB模式
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                
-                # 自适应压缩策略
-                # 1. 先尝试压缩尺寸
-                max_dimension = 1024  # 最大边长
-                if img.width > max_dimension or img.height > max_dimension:
-                    ratio = min(max_dimension / img.width, max_dimension / img.height)
-                    new_width = int(img.width * ratio)
-                    new_height = int(img.height * ratio)
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # 2. 保存为JPEG并尝试不同质量等级
-                temp_fd, temp_path = tempfile.mkstemp(suffix='.jpg')
-                os.close(temp_fd)
-                
-                # 尝试不同的压缩质量，确保文件大小合适
-                for quality in [85, 70, 55, 40]:
-                    img.save(temp_path, 'JPEG', quality=quality, optimize=True)
-                    
-                    # 检查压缩后的文件大小
-                    with open(temp_path, 'rb') as f:
-                        data = f.read()
-                        base64_size_mb = len(base64.b64encode(data)) / (1024 * 1024)
-                    
-                    # 如果小于8MB，使用这个质量
-                    if base64_size_mb < 8:
-                        return temp_path
-                
-                # 如果仍然太大，进一步缩小尺寸
-                max_dimension = 512
-                ratio = min(max_dimension / img.width, max_dimension / img.height)
-                new_width = int(img.width * ratio)
-                new_height = int(img.height * ratio)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                img.save(temp_path, 'JPEG', quality=40, optimize=True)
-                
-                return temp_path
-
-        except Exception as e:
-            self.logger.warning(f"图片处理失败: {e}")
-            return image_path
-
-    def check_image_safety(self, image_path: str, worker_id: str):
-        """检查图片安全性"""
-        temp_path = None
-
+            for image_path in self.scan_manifest.scan('.', self.config['target_folder'], include_approved=False):
+                with self.stats_lock:
+                    self.stats['total'] += 1
+                yield image_path
+        finally:
+            self.scan_done = True
+
+    def validate_and_resize_image(self, image_path: str) -> PreparedImage:
+        """验证并自适应压缩图片，编码结果保存在内存中"""
+        prepared = prepare_image(image_path, self.config.get('payload_budget_mb', DEFAULT_PAYLOAD_BUDGET_MB),
+                                 profile=self.payload_profile,
+                                 min_dimension=self.config.get('min_image_dimension', DEFAULT_MIN_DIMENSION),
+                                 upload_format=self.upload_format, **self.passthrough_options())
+        if prepared.error:
+            self.logger.warning(f"图片处理失败: {prepared.error}")
+        return prepared
+
+    def call_endpoint(self, endpoint, prompt: str, images: List[PreparedImage], model_name: str = None) -> str:
+        """向指定端点发送一次审查请求（一张或按顺序排列的多张图片），返回模型输出的文本
+
+        model_name为空时使用端点配置的模型
+        """
+        model_name = model_name or endpoint.model_name
+        if not endpoint.uses_sdk:
+            # 使用OpenAI兼容的代理服务器
+            response = endpoint.client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": prepared.to_data_url()
+                                }
+                            }
+                            for prepared in images
+                        ] + [
+                            {
+                                "type": "text",
+                                "text": prompt
+                            }
+                        ]
+                    }
+                ],
+                timeout=self.config['timeout']
+            )
+            # 处理不同类型的响应
+            if hasattr(response, 'choices') and response.choices:
+                return response.choices[0].message.content
+            elif hasattr(response, 'content'):
+                return response.content
+            # 处理字符串响应的情况
+            content = str(response)
+            # 尝试解析JSON字符串
+            try:
+                import json as json_module
+                if content.startswith('{') and content.endswith('}'):
+                    parsed = json_module.loads(content)
+                    if 'choices' in parsed and parsed['choices']:
+                        content = parsed['choices'][0]['message']['content']
+            except:
+                pass
+            return content
+        # 使用官方Gemini API
+        # 直接以内联数据发送已编码的字节
+        model = endpoint.client if model_name == endpoint.model_name else genai.GenerativeModel(model_name)
+        # retry=None 关闭SDK对503的内置重试（默认最长重试600秒），错误交给引擎的重试机制
+        response = model.generate_content([prompt] + [prepared.to_inline_blob() for prepared in images],
+                                          request_options={'retry': None})
+        return response.text
+
+    def check_image_safety(self, image_path: str, worker_id: str, prepared: PreparedImage = None,
+                           model_name: str = None, escalate_malformed: bool = False):
+        """检查图片安全性，model_name为空时使用端点配置的模型
+
+        escalate_malformed为True时（低分辨率审查），回复格式异常不重试而是返回None，由调用方改用原图审查
+        """
+        endpoint = None
         try:
-            # 1. 验证图片格式并自适应压缩
-            processed_path = self.validate_and_resize_image(image_path)
-            if processed_path != image_path:
-                temp_path = processed_path
-
-            # 2. 读取图片并转换为Base64
-            with open(processed_path, 'rb') as img_file:
-                img_data = img_file.read()
-
-            img_base64 = base64.b64encode(img_data).decode('utf-8')
-
-            # 检查文件大小
-            base64_size_mb = len(img_base64) / (1024 * 1024)
+            # 1. 验证图片格式并自适应压缩（已预处理则直接使用）
+            if prepared is None:
+                prepared = self.validate_and_resize_image(image_path)
+            if prepared.data is None:
+                raise ValueError(f"无法读取图片: {prepared.error}")
+
+            # 2. 检查编码后的数据大小（按Base64长度计算，无需真正编码）
+            base64_size_mb = prepared.base64_size / (1024 * 1024)
             if base64_size_mb > 10:
                 # 图片过大不应该跳过，而是拒绝（更安全的做法）
                 self.logger.warning(f"[{worker_id}] 图片过大 ({base64_size_mb:.2f}MB)，出于安全考虑拒绝: {image_path}")
@@ -584,77 +684,30 @@ class UltraFastImageFilter:
                     "suitable_for_teens": False,
                     "reason": f"图片过大({base64_size_mb:.2f}MB)，出于安全考虑拒绝",
                     "confidence": 1.0
-                }, temp_path
+                }
 
             # 3. 调用API
-            prompt = """
-请仔细审查这张图片是否适合16岁及以上青少年查看。
-
-重点检查：
-1. 是否包含性暗示、性行为或裸体内容
-2. 是否有过度暴露的服装（如比基尼、情趣内衣等）
-3. 是否有挑逗性姿势或表情
-4. 是否对未成年外观的角色进行性化描绘
-5. 整体是否存在不适宜青少年的内容
-
-请以JSON格式返回结果：
-{
-    "suitable_for_teens": true/false,
-    "reason": "详细的判断理由",
-    "confidence": 0.0-1.0
-}
-
-如果有任何疑虑，请判定为不适合。
-"""
-
-            if self.use_proxy:
-                # 使用OpenAI兼容的代理服务器
-                response = self.client.chat.completions.create(
-                    model=self.config['model_name'],
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{img_base64}"
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
-                    timeout=self.config['timeout']
-                )
-                # 处理不同类型的响应
-                if hasattr(response, 'choices') and response.choices:
-                    content = response.choices[0].message.content
-                elif hasattr(response, 'content'):
-                    content = response.content
-                else:
-                    # 处理字符串响应的情况
-                    content = str(response)
-                    # 尝试解析JSON字符串
-                    try:
-                        import json as json_module
-                        if content.startswith('{') and content.endswith('}'):
-                            parsed = json_module.loads(content)
-                            if 'choices' in parsed and parsed['choices']:
-                                content = parsed['choices'][0]['message']['content']
-                    except:
-                        pass
-            else:
-                # 使用官方Gemini API
-                import io
-                img_data_bytes = base64.b64decode(img_base64)
-                pil_image = Image.open(io.BytesIO(img_data_bytes))
-                
-                response = self.model.generate_content([prompt, pil_image])
-                content = response.text
+            prompt = REVIEW_PROMPT
+
+            # 选择最健康的端点；所有端点都熔断或被要求暂停时不发送请求，到期后由调度器重新排队
+            endpoint, pause = self.endpoints.choose()
+            if endpoint is None:
+                raise RetryLater(pause)
+
+            # 该端点的RPM/TPM配额不足时不在线程中等待，交给重试调度器到期后重新审查（可能换到其他端点）
+            tokens = estimate_tokens(prompt, len(prepared.data), image_tokens=prepared.image_tokens)
+            delay = endpoint.rate_limiter.try_acquire(tokens)
+            if delay > 0:
+                endpoint.abandon()
+                raise RetryLater(delay)
+
+            # 调用结果计入端点的错误率和熔断状态
+            with endpoint.track():
+                # 每次调用都要取得该端点的自适应并发名额，限流时自动收缩
+                with endpoint.limiter.slot():
+                    started = time.monotonic()
+                    content = self.call_endpoint(endpoint, prompt, [prepared], model_name)
+                    self.usage.record(model_name or endpoint.model_name, time.monotonic() - started, tokens)
 
             # 解析JSON结果
             try:
@@ -663,23 +716,35 @@ class UltraFastImageFilter:
                     end = content.rfind('}') + 1
                     json_str = content[start:end]
                     result = json.loads(json_str)
-                    return result, temp_path
+                    if escalate_malformed and not isinstance(result.get('suitable_for_teens'), bool):
+                        return None
+                    return result
+                elif escalate_malformed:
+                    return None
                 else:
                     # 关键词判断
                     if any(word in content.lower() for word in ['不适合', 'false', '不建议']):
-                        return {"suitable_for_teens": False, "reason": "AI判断不适合", "confidence": 0.8}, temp_path
+                        return {"suitable_for_teens": False, "reason": "AI判断不适合", "confidence": 0.8}
                     else:
-                        return {"suitable_for_teens": True, "reason": "AI判断适合", "confidence": 0.8}, temp_path
+                        return {"suitable_for_teens": True, "reason": "AI判断适合", "confidence": 0.8}
             except Exception as parse_error:
+                if escalate_malformed:
+                    return None
                 # JSON解析失败也不应该默认通过，而是重试
                 self.logger.warning(f"[{worker_id}] JSON解析失败，将重试: {parse_error}")
-                return self.retry_with_backoff(image_path, worker_id, temp_path)
+                raise self.schedule_retry(image_path, worker_id)
 
+        except RetryLater:
+            raise
         except Exception as e:
-            error_str = str(e)
-            if ("SAFETY" in error_str or "BLOCKED" in error_str or
-                "安全" in error_str or "blocked" in error_str.lower() or
-                "safety" in error_str.lower()):
+            # 按结构化的状态码和响应头分类，服务端给出Retry-After时按其等待
+            error = classify_api_error(e)
+            retry_after = error.retry_after
+            # 该密钥被限流或端点故障时，还有其他可用端点则立即换端点重试
+            if self.endpoints.can_fail_over(endpoint, error, self.retry_attempts.get(image_path, 0)):
+                self.logger.info(f"[{worker_id}] 端点 {endpoint.name} 暂不可用，换其他端点重试")
+                retry_after = 0
+            if error.kind == SAFETY:
                 self.logger.info(f"[{worker_id}] Gemini安全过滤器检测到不适合内容: {image_path}")
                 with self.stats_lock:
                     self.stats['ai_reject'] += 1
@@ -687,19 +752,52 @@ class UltraFastImageFilter:
                     "suitable_for_teens": False,
                     "reason": "Gemini安全过滤器检测到不适合16岁及以上青少年的内容",
                     "confidence": 1.0
-                }, temp_path
-            elif "429" in error_str or "Too Many Requests" in error_str:
+                }
+            elif error.kind == RATE_LIMITED:
                 # 429错误处理
                 self.handle_rate_limit_error()
                 self.logger.warning(f"[{worker_id}] API限流，将无限重试直到成功: {image_path}")
                 # 无限重试逻辑
-                return self.retry_with_backoff(image_path, worker_id, temp_path)
+                raise self.schedule_retry(image_path, worker_id, retry_after)
             else:
                 # 对于非429错误也进行重试，确保100%覆盖率
                 self.logger.warning(f"[{worker_id}] Gemini API调用失败，将重试: {e}")
-                return self.retry_with_backoff(image_path, worker_id, temp_path)
+                raise self.schedule_retry(image_path, worker_id, retry_after)
+
+    def check_image_batch(self, items) -> dict:
+        """一次请求审查多张图片，items为 (图片路径, 工作线程ID, 预处理结果) 列表
+
+        返回 {序号: 结论}，没有有效结论的序号由调用方逐张审查
+        """
+        images = [prepared for _, _, prepared in items]
+        prompt = build_batch_prompt(len(images))
+        # 级联模式下批量请求只用于初审
+        model_name = self.cascade.screening_model if self.cascade else None
+        endpoint, pause = self.endpoints.choose()
+        if endpoint is None:
+            return {}
+        try:
+            with endpoint.track():
+                tokens = estimate_tokens(prompt, sum(len(p.data) for p in images), len(images),
+                                         sum(p.image_tokens for p in images))
+                # 一个批量请求包含多张图片，由发送线程预约配额并等待（等待期间占用该线程）
+                endpoint.rate_limiter.wait(tokens)
+                with endpoint.limiter.slot():
+                    started = time.monotonic()
+                    content = self.call_endpoint(endpoint, prompt, images, model_name)
+                    self.usage.record(model_name or endpoint.model_name, time.monotonic() - started, tokens,
+                                      len(images))
+        except Exception as e:
+            # 整批只是一次请求，限流只计一次；错误交给批处理器决定整批重试还是逐张审查
+            if classify_api_error(e).kind == RATE_LIMITED:
+                self.handle_rate_limit_error()
+            raise
+        verdicts = parse_batch_verdicts(content, len(images))
+        if len(verdicts) < len(images):
+            self.logger.warning(f"批量审查只返回了 {len(verdicts)}/{len(images)} 张图片的有效结论，其余逐张审查")
+        return verdicts
 
-    def move_inappropriate_image(self, image_path: str, reason: str, temp_path: str = None):
+    def move_inappropriate_image(self, image_path: str, reason: str):
         """移动不适合的图片"""
         try:
             path_obj = Path(image_path)
@@ -720,9 +818,6 @@ class UltraFastImageFilter:
             
             shutil.move(str(path_obj), str(target_path))
             
-            if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                os.unlink(temp_path)
-            
             return True
             
         except Exception as e:
@@ -752,48 +847,260 @@ class UltraFastImageFilter:
             self.logger.error(f"重命名失败: {e}")
             return False
 
-    def process_single_image(self, image_path: str, worker_id: str):
-        """处理单张图片"""
+    def lookup_cached_verdict(self, image_path: str, worker_id: str):
+        """按内容哈希查询审查缓存，返回(缓存结论, 内容哈希)"""
+        content_hash = None
+        cached = None
+        if self.verdict_cache:
+            try:
+                content_hash = hash_file(image_path)
+                cached = self.verdict_cache.get(content_hash, self.verdict_model, self.prompt_version)
+            except Exception as e:
+                self.logger.warning(f"[{worker_id}] 读取审查缓存失败: {e}")
+            if cached:
+                self.logger.info(f"[{worker_id}] 命中审查缓存: {image_path}")
+                with self.stats_lock:
+                    self.stats['cache_hits'] += 1
+        return cached, content_hash
+
+    def passthrough_options(self) -> dict:
+        """快速路径的预处理参数：所有端点都接受的格式才直接发送，未启用相似图片索引时不解码"""
+        return {
+            'passthrough_kb': self.config.get('passthrough_max_kb', DEFAULT_PASSTHROUGH_KB),
+            'passthrough_formats': self.endpoints.image_formats,
+            'need_phash': self.perceptual_index is not None,
+        }
+
+    def record_encode(self, worker_id: str, prepared: PreparedImage):
+        """记录单张图片的编码质量与耗时"""
+        if prepared.passthrough:
+            self.logger.info(f"[{worker_id}] 直接发送原文件: {prepared.mime_type}, {len(prepared.data) / 1024:.0f}KB")
+            with self.stats_lock:
+                self.stats['passthrough'] += 1
+                self.stats['image_tokens'] += prepared.image_tokens
+            return
+        if not prepared.encode_count:
+            return
+        self.logger.info(
+            f"[{worker_id}] 编码: 质量 {prepared.quality}, {len(prepared.data) / 1024:.0f}KB, "
+            f"{prepared.encode_count} 次编码, 耗时 {prepared.encode_seconds * 1000:.0f}ms"
+            + (f", 估算 {prepared.image_tokens} tokens" if prepared.image_tokens else "")
+        )
+        with self.stats_lock:
+            self.stats['encoded'] += 1
+            self.stats['image_tokens'] += prepared.image_tokens
+            self.stats['encode_time'] += prepared.encode_seconds
+            self.stats['encode_time_max'] = max(self.stats['encode_time_max'], prepared.encode_seconds)
+
+    @property
+    def verdict_model(self) -> str:
+        """缓存和相似图片索引中记录结论所用的模型标识，启用级联或渐进分辨率时包含对应配置"""
+        model_name = self.endpoints.model_key
+        if self.cascade:
+            model_name = self.cascade.cache_key(model_name)
+        if self.progressive:
+            model_name = self.progressive.cache_key(model_name)
+        return model_name
+
+    def request_verdict(self, image_path: str, worker_id: str, prepared: PreparedImage,
+                        model_name: str = None, batch: bool = False, escalate_malformed: bool = False) -> dict:
+        """用指定模型审查一张图片，batch为True且启用批量模式时先与其他线程的图片合并为一个请求"""
+        if prepared.tiles:
+            result = self.review_tiles(image_path, worker_id, prepared, model_name)
+            self.finish_retries(image_path, worker_id)
+            return result
+        # 重试中的图片和过大的图片不参与批量审查
+        if (batch and self.batcher and image_path not in self.retry_attempts
+                and prepared.data is not None and fits_in_batch(prepared.base64_size, self.batcher.size)):
+            try:
+                result = self.batcher.review((image_path, worker_id, prepared))
+            except BatchRetry as e:
+                # 整批被限流或端点故障，逐张请求只会放大压力，按退避稍后重试
+                raise self.schedule_retry(image_path, worker_id, e.error.retry_after)
+            if result is not None:
+                return result
+        result = self.check_image_safety(image_path, worker_id, prepared, model_name, escalate_malformed)
+        self.finish_retries(image_path, worker_id)
+        return result
+
+    def review_tiles(self, image_path: str, worker_id: str, prepared: PreparedImage, model_name: str = None) -> dict:
+        """各分块并发调用API，任一块不适合即判定整张图片不适合；需要重试时抛出RetryLater，重试只发送没有结论的分块"""
+        tiles = prepared.tiles
+        pending = self.tiling.remaining(image_path, len(tiles))
+        if len(pending) == len(tiles):
+            self.logger.info(f"[{worker_id}] 分 {len(tiles)} 块审查: {image_path}")
+        futures = {
+            self.tile_executor.submit(
+                self.check_image_safety, image_path, f"{worker_id}#{index + 1}", tiles[index], model_name
+            ): index
+            for index in pending
+        }
+        retry = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                verdict = future.result()
+            except RetryLater as e:
+                retry = retry or e
+                continue
+            if self.tiling.record(image_path, futures[future], verdict):
+                # 已有分块不适合，尚未发送的分块不再审查
+                for other in futures:
+                    other.cancel()
+        if retry is not None and not self.tiling.decided(image_path, len(tiles)):
+            raise retry
+        return self.tiling.finish(image_path, len(tiles))
+
+    def review_progressively(self, image_path: str, worker_id: str, prepared: PreparedImage,
+                             model_name: str = None, batch: bool = False) -> dict:
+        """第一级审查；启用渐进分辨率时先发送低分辨率版本，置信度低或回复格式异常时再发送原图"""
+        if self.progressive is None or prepared.tiles:
+            return self.request_verdict(image_path, worker_id, prepared, model_name, batch)
+        if prepared.preview is None:
+            self.progressive.record_small()
+            return self.request_verdict(image_path, worker_id, prepared, model_name, batch)
+        # 原图审查需要重试时不再重复低分辨率审查
+        if not self.progressive.awaiting_full(image_path):
+            result = self.request_verdict(image_path, worker_id, prepared.preview, model_name, batch,
+                                          escalate_malformed=True)
+            if not self.progressive.escalate(image_path, result):
+                return result
+            reason = "回复格式异常" if result is None else f"置信度 {result.get('confidence')}"
+            self.logger.info(f"[{worker_id}] 低分辨率审查不确定 ({reason})，改用原图审查: {image_path}")
+        result = self.request_verdict(image_path, worker_id, prepared, model_name)
+        self.progressive.finish(image_path)
+        return result
+
+    def review_with_cascade(self, image_path: str, worker_id: str, prepared: PreparedImage,
+                            batch: bool = False) -> dict:
+        """调用API审查；启用级联时先用快速模型初审，置信度低或判定不适合的图片再用强模型复审"""
+        if self.cascade is None:
+            return self.review_progressively(image_path, worker_id, prepared, batch=batch)
+        # 复审需要重试时沿用之前的初审结论
+        if self.cascade.screening_result(image_path) is None:
+            screening = self.review_progressively(image_path, worker_id, prepared, self.cascade.screening_model, batch)
+            if not self.cascade.escalate(image_path, screening):
+                return screening
+            self.logger.info(f"[{worker_id}] 初审需要复审 (置信度 {screening.get('confidence')}): {image_path}")
+        result = self.request_verdict(image_path, worker_id, prepared)
+        self.cascade.finish(image_path, result)
+        return result
+
+    def review_prepared_image(self, image_path: str, worker_id: str, prepared: PreparedImage, content_hash,
+                              batch: bool = False):
+        """对已预处理的图片查找相似图片结论或调用API，并写入缓存
+
+        batch为True且启用批量模式时，先与其他线程的图片合并为一个请求
+        """
+        model_name = self.verdict_model
+        phash = prepared.phash
+        result = None
+        
+        # 1. 用感知哈希查找相似图片
+        if self.perceptual_index and phash is not None:
+            try:
+                match = self.perceptual_index.lookup(phash, model_name, self.prompt_version)
+            except Exception as e:
+                match = None
+                self.logger.warning(f"[{worker_id}] 查询相似图片索引失败: {e}")
+            if match:
+                result, distance = match
+                self.logger.info(f"[{worker_id}] 命中相似图片 (距离 {distance}): {image_path}")
+                with self.stats_lock:
+                    self.stats['phash_hits'] += 1
+        
+        # 2. 调用API
+        if result is None:
+            result = self.review_with_cascade(image_path, worker_id, prepared, batch)
+            if self.perceptual_index and phash is not None:
+                try:
+                    self.perceptual_index.add(phash, model_name, self.prompt_version, result)
+                except Exception as e:
+                    self.logger.warning(f"[{worker_id}] 写入相似图片索引失败: {e}")
+        
+        if content_hash:
+            try:
+                self.verdict_cache.put(content_hash, model_name, self.prompt_version, result)
+            except Exception as e:
+                self.logger.warning(f"[{worker_id}] 写入审查缓存失败: {e}")
+        
+        return result
+
+    def claim_image(self, image_path: str) -> bool:
+        """登记图片，已处理过则返回False"""
+        with self.processed_lock:
+            if image_path in self.processed_files:
+                return False
+            self.processed_files.add(image_path)
+            return True
+
+    def apply_verdict(self, image_path: str, worker_id: str, result: dict):
+        """根据审查结论移动或标记图片"""
+        if result.get("suitable_for_teens") is False:
+            self.logger.warning(f"[{worker_id}] 不适合: {image_path} - {result.get('reason')}")
+            if self.move_inappropriate_image(image_path, result.get('reason', '未知原因')):
+                with self.stats_lock:
+                    self.stats['moved'] += 1
+            else:
+                with self.stats_lock:
+                    self.stats['errors'] += 1
+        elif result.get("suitable_for_teens") is True:
+            self.logger.info(f"[{worker_id}] 通过: {image_path}")
+            if self.rename_approved_image(image_path):
+                with self.stats_lock:
+                    self.stats['approved'] += 1
+            else:
+                with self.stats_lock:
+                    self.stats['errors'] += 1
+        else:
+            self.logger.warning(f"[{worker_id}] 跳过: {image_path} - {result.get('reason')}")
+            with self.stats_lock:
+                self.stats['skipped'] += 1
+        
+        with self.stats_lock:
+            self.stats['processed'] += 1
+
+    def lookup_stage(self, index: int, image_path: str):
+        """流水线第一段：查缓存，命中则直接处理完毕，否则返回后续阶段的上下文"""
+        worker_id = f"worker_{index:03d}"
         try:
-            with self.processed_lock:
-                if image_path in self.processed_files:
-                    return
-                self.processed_files.add(image_path)
+            if not self.claim_image(image_path):
+                return None
 
             self.logger.info(f"[{worker_id}] 开始处理: {image_path}")
             
-            result, temp_path = self.check_image_safety(image_path, worker_id)
-            
-            if result.get("suitable_for_teens") is False:
-                self.logger.warning(f"[{worker_id}] 不适合: {image_path} - {result.get('reason')}")
-                if self.move_inappropriate_image(image_path, result.get('reason', '未知原因'), temp_path):
-                    with self.stats_lock:
-                        self.stats['moved'] += 1
-                else:
-                    with self.stats_lock:
-                        self.stats['errors'] += 1
-            elif result.get("suitable_for_teens") is True:
-                self.logger.info(f"[{worker_id}] 通过: {image_path}")
-                if self.rename_approved_image(image_path):
-                    with self.stats_lock:
-                        self.stats['approved'] += 1
-                else:
-                    with self.stats_lock:
-                        self.stats['errors'] += 1
-                
-                if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            else:
-                self.logger.warning(f"[{worker_id}] 跳过: {image_path} - {result.get('reason')}")
-                with self.stats_lock:
-                    self.stats['skipped'] += 1
-                
-                if temp_path and temp_path != image_path and os.path.exists(temp_path):
-                    os.unlink(temp_path)
+            cached, content_hash = self.lookup_cached_verdict(image_path, worker_id)
+            if cached:
+                self.apply_verdict(image_path, worker_id, cached)
+                return None
+            return worker_id, content_hash
             
+        except Exception as e:
+            self.logger.error(f"[{worker_id}] 处理图片出错: {image_path}, 错误: {e}")
             with self.stats_lock:
-                self.stats['processed'] += 1
+                self.stats['errors'] += 1
+            return None
+
+    def review_stage(self, index: int, image_path: str, context, prepared):
+        """流水线第三段：使用进程池的预处理结果审查图片"""
+        worker_id, content_hash = context
+        try:
+            if prepared is None or prepared.data is None:
+                # 预处理进程不可用或读取失败时在当前线程(重新)处理
+                prepared = self.validate_and_resize_image(image_path)
+            elif prepared.error:
+                self.logger.warning(f"图片处理失败: {prepared.error}")
+            if image_path not in self.retry_attempts:
+                # 重试时流水线带着同一份预处理结果重新进入审查阶段，编码统计只在第一次记录
+                self.record_encode(worker_id, prepared)
+            
+            result = self.review_prepared_image(image_path, worker_id, prepared, content_hash, batch=True)
+            self.apply_verdict(image_path, worker_id, result)
             
+        except RetryLater:
+            # 交给流水线稍后重试
+            raise
         except Exception as e:
             self.logger.error(f"[{worker_id}] 处理图片出错: {image_path}, 错误: {e}")
             with self.stats_lock:
@@ -809,18 +1116,24 @@ class UltraFastImageFilter:
             with self.stats_lock:
                 processed = self.stats['processed']
                 total = self.stats['total']
+            scanning = not self.scan_done
 
-            if processed >= total:
+            if not scanning and processed >= total:
                 self.progress_bar.stop()
                 break
 
             elapsed = time.time() - start_time
+            stage_info = self.pipeline.describe_queues() if self.pipeline else None
+            concurrency = self.endpoints.describe_live()
             if processed > 0:
                 avg_speed = processed / elapsed
-                eta = (total - processed) / avg_speed if avg_speed > 0 else 0
-                self.progress_bar.update(processed, total, avg_speed, eta/60)
+                # 扫描未结束时总数未知，不估算剩余时间
+                eta = (total - processed) / avg_speed / 60 if avg_speed > 0 and not scanning else None
+                self.progress_bar.update(processed, total, avg_speed, eta, scanning=scanning,
+                                         stage_info=stage_info, concurrency=concurrency)
             else:
-                self.progress_bar.update(processed, total)
+                self.progress_bar.update(processed, total, scanning=scanning,
+                                         stage_info=stage_info, concurrency=concurrency)
 
     def run(self):
         """运行过滤器"""
@@ -828,18 +1141,28 @@ class UltraFastImageFilter:
         print(f"📁 不适合的图片将移动到 {self.config['target_folder']} 文件夹")
         print("✅ 通过的图片将添加 _审查已经通过 标记")
         print("🔍 新增：文件名成人内容检查")
-        print(f"⚡ 并发数: {self.config['max_concurrent']} 个线程")
+        print(f"⚡ 并发数: {self.endpoints.max_concurrency} 个线程，端点: {len(self.endpoints)} 个")
         print()
         
-        images = self.get_all_images()
-        self.stats['total'] = len(images)
+        # 预处理在进程池中按CPU核数并行，API调用在线程池中按各端点并发数之和并行
+        io_workers = self.endpoints.max_concurrency
+        cpu_workers = self.config.get('preprocess_workers') or os.cpu_count() or 1
+        # 有界窗口，在途图片数有上限，内存占用与图片总数无关
+        max_pending = self.config.get('max_pending') or io_workers * 2 + cpu_workers
+        prepare = partial(prepare_image, budget_mb=self.config.get('payload_budget_mb', DEFAULT_PAYLOAD_BUDGET_MB),
+                          preview_dimension=self.config.get('progressive_dimension', 0),
+                          tile_size=self.config.get('tile_size', 0),
+                          tile_min_aspect=self.config.get('tile_min_aspect', 0),
+                          profile=self.payload_profile,
+                          min_dimension=self.config.get('min_image_dimension', DEFAULT_MIN_DIMENSION),
+                          upload_format=self.upload_format, **self.passthrough_options())
+        self.pipeline = ImagePipeline(
+            self.lookup_stage, prepare, self.review_stage,
+            io_workers, cpu_workers, max_pending, self.logger
+        )
         
-        if not images:
-            print("✅ 没有需要处理的图片")
-            return
-
-        print(f"找到 {len(images)} 张图片需要处理")
-        print(f"预计处理时间：{len(images) / (self.config['max_concurrent'] * 10):.1f} 分钟")
+        print("🔎 边扫描边审查：发现的图片立即进入处理队列")
+        print(f"⚙️ 预处理进程: {cpu_workers} 个，API线程: {io_workers} 个")
         print()
         
         start_time = time.time()
@@ -848,23 +1171,16 @@ class UltraFastImageFilter:
         progress_thread.daemon = True
         progress_thread.start()
         
-        with ThreadPoolExecutor(max_workers=self.config['max_concurrent']) as executor:
-            future_to_image = {
-                executor.submit(self.process_single_image, image_path, f"worker_{i:03d}"): image_path
-                for i, image_path in enumerate(images)
-            }
-            
-            for future in as_completed(future_to_image):
-                image_path = future_to_image[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    self.logger.error(f"任务执行失败: {image_path}, 错误: {e}")
+        self.pipeline.run(iter_in_background(self.discover_images()))
         
         elapsed_time = time.time() - start_time
 
         # 确保进度条停止
         self.progress_bar.stop()
+        
+        if self.stats['total'] == 0:
+            print("✅ 没有需要处理的图片")
+            return
 
         print("📊 处理完成:")
         print(f"   总共: {self.stats['total']} 张")
@@ -876,10 +1192,34 @@ class UltraFastImageFilter:
         print(f"   错误: {self.stats['errors']} 张")
         print(f"   限流错误: {self.stats['rate_limit_errors']} 次")
         print(f"   重试次数: {self.stats['retries']} 次")
+        print(f"   缓存命中: {self.stats['cache_hits']} 张")
+        print(f"   相似图片命中: {self.stats['phash_hits']} 张")
+        if self.stats['encoded']:
+            avg_encode_ms = self.stats['encode_time'] / self.stats['encoded'] * 1000
+            print(f"   编码耗时: 平均 {avg_encode_ms:.0f} ms/张，最长 {self.stats['encode_time_max'] * 1000:.0f} ms")
+        prepared_count = self.stats['encoded'] + self.stats['passthrough']
+        if prepared_count and self.config.get('passthrough_max_kb', DEFAULT_PASSTHROUGH_KB) > 0:
+            print(f"   直接发送原文件: {self.stats['passthrough']} 张"
+                  f"（占 {self.stats['passthrough'] / prepared_count:.0%}，未解码和重新编码）")
+        if prepared_count and self.payload_profile:
+            print(f"   图片token估算: 平均 {self.stats['image_tokens'] / prepared_count:.0f} tokens/张 "
+                  f"({self.payload_profile.name} 计费规则)")
+        print(f"   流水线: {self.pipeline.describe_summary()}")
         print(f"   耗时: {elapsed_time:.1f} 秒 ({elapsed_time/60:.1f} 分钟)")
         if elapsed_time > 0 and self.stats['processed'] > 0:
             print(f"   平均速度: {self.stats['processed'] / elapsed_time:.2f} 张/秒")
-        print(f"   最终并发数: {self.current_workers}")
+        for line in self.endpoints.describe():
+            print(f"   {line}")
+        if self.batcher:
+            print(f"   批量审查: {self.batcher.describe()}")
+        if self.cascade:
+            print(f"   级联审查: {self.cascade.describe()}")
+        if self.progressive:
+            print(f"   渐进分辨率: {self.progressive.describe()}")
+        if self.tiling:
+            print(f"   超长/超宽图片: {self.tiling.describe()}")
+        for line in self.usage.describe():
+            print(f"   模型 {line}")
 
 # ==================== 标记清除功能 ====================
 
@@ -987,12 +1327,15 @@ def remove_approval_tags(config):
 def main_menu():
     """主菜单"""
     config = load_config()
+    manifest = open_manifest(config.get('manifest_path', DEFAULT_MANIFEST_PATH))
+    needs_refresh = True
     while True:
         clear_screen()
         print_banner()
         
-        # 统计信息
-        total, unprocessed, approved = count_images(config)
+        # 统计信息 - 仅在文件可能变化后增量刷新清单，其余重绘直接读取清单
+        total, unprocessed, approved = count_images(config, manifest, refresh=needs_refresh)
+        needs_refresh = False
         print("📊 当前状态:")
         print(f"   总图片数: {total}")
         print(f"   未处理: {unprocessed}")
@@ -1013,6 +1356,7 @@ def main_menu():
             clear_screen()
             print_banner()
             config = interactive_config(config)
+            needs_refresh = True
             if config:
                 input("\n按回车键继续...")
         
@@ -1022,7 +1366,7 @@ def main_menu():
                 input("按回车键继续...")
                 continue
                 
-            if not config['api_key']:
+            if not config['api_key'] and not config.get('endpoints'):
                 print("❌ 请先配置API密钥")
                 input("按回车键继续...")
                 continue
@@ -1034,6 +1378,7 @@ def main_menu():
             confirm = input("确认开始? [y/N]: ").strip().lower()
             if confirm in ['y', 'yes']:
                 run_image_filter(config)
+                needs_refresh = True
                 input("\n处理完成，按回车键继续...")
         
         elif choice == '3':
@@ -1048,6 +1393,7 @@ def main_menu():
             confirm = input("确认清除? [y/N]: ").strip().lower()
             if confirm in ['y', 'yes']:
                 remove_approval_tags(config)
+                needs_refresh = True
                 input("\n清除完成，按回车键继续...")
         
         elif choice == '4':
@@ -1087,6 +1433,8 @@ def main_menu():
             time.sleep(1)
 
 if __name__ == "__main__":
+    # 打包为exe后预处理进程池需要
+    multiprocessing.freeze_support()
     try:
         main_menu()
     except KeyboardInterrupt:
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片预处理
+解码、缩放、编码都是CPU密集操作，这里的函数只依赖PIL，可以直接放到进程池中执行，
+不与网络线程争抢GIL
+编码结果只保存在内存中，直接交给请求构造，不产生任何临时文件
+"""
+
+import io
+import os
+import math
+import time
+import base64
+import mimetypes
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image, features
+
+from payload_profiles import DEFAULT_MIN_DIMENSION, PayloadProfile
+from perceptual_index import dhash
+
+DEFAULT_PAYLOAD_BUDGET_MB = 8  # 请求中图片Base64数据的上限
+MAX_ENCODES = 4  # 单个尺寸下最多编码次数
+MAX_DIMENSION = 1024  # 送审图片的最大边长
+REDUCE_GAP = 2  # 整数倍缩小后至少保留目标尺寸的2倍，再由LANCZOS完成最终缩放
+DEFAULT_TILE_SIZE = 768  # 未指定计费规则时的分块边长，与Gemini计费的图片块(768x768)一致
+TILE_OVERLAP = 0.15  # 相邻分块的重叠比例，避免内容恰好被切在边界上
+MAX_TILES = 16  # 单张图片最多分块数，超出时整体再缩小
+
+# 上传格式 -> (Pillow格式, MIME类型, Pillow特性名, 编码参数)
+UPLOAD_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg', {'optimize': True}),
+    'webp': ('WEBP', 'image/webp', 'webp', {}),
+    'avif': ('AVIF', 'image/avif', 'avif', {}),
+}
+DEFAULT_UPLOAD_FORMAT = 'jpeg'
+
+# 各上传格式的(最高质量, 最低质量)：同一质量数值在不同编码器下的画质和体积相差很大，
+# WebP/AVIF取与JPEG质量85/40画质相当（PSNR接近）的数值，否则AVIF按85编码反而比JPEG大
+QUALITY_RANGES = {
+    'jpeg': (85, 40),
+    'webp': (80, 35),
+    'avif': (60, 35),
+}
+
+# 可以直接发送原文件的格式：Pillow格式 -> (格式名, MIME类型)，还需要端点的 image_formats 包含该格式名
+PASSTHROUGH_FORMATS = {
+    'JPEG': ('jpeg', 'image/jpeg'),
+    'PNG': ('png', 'image/png'),
+    'WEBP': ('webp', 'image/webp'),
+    'AVIF': ('avif', 'image/avif'),
+}
+PASSTHROUGH_MODES = ('RGB', 'RGBA', 'L', 'LA', 'P')  # CMYK、16位等模式仍需转换
+DEFAULT_PASSTHROUGH_KB = 512  # 原文件不超过该大小时才直接发送
+
+# 各格式不同质量相对于其最高质量的典型体积比例（照片、截图和插画的实测平均），用于由一次实测结果预测目标质量
+_RELATIVE_SIZE = {
+    'jpeg': [
+        (85, 1.0), (80, 0.88), (75, 0.80), (70, 0.74), (65, 0.68),
+        (60, 0.64), (55, 0.60), (50, 0.57), (45, 0.54), (40, 0.50),
+    ],
+    'webp': [
+        (80, 1.0), (75, 0.85), (70, 0.81), (65, 0.77), (60, 0.74),
+        (55, 0.71), (50, 0.67), (45, 0.64), (40, 0.60), (35, 0.56),
+    ],
+    'avif': [
+        (60, 1.0), (55, 0.89), (50, 0.81), (45, 0.73), (40, 0.64), (35, 0.58),
+    ],
+}
+
+
+@dataclass
+class PreparedImage:
+    """预处理结果（编码后的图片数据）"""
+    image_path: str
+    data: Optional[bytes] = None
+    mime_type: str = 'image/jpeg'
+    phash: Optional[int] = None
+    error: Optional[str] = None
+    quality: Optional[int] = None
+    encode_seconds: float = 0.0
+    encode_count: int = 0
+    image_tokens: int = 0  # 按模型计费规则估算的图片token数，0表示未知（按数据大小估算）
+    passthrough: bool = False  # 未解码、直接发送原文件
+    preview: Optional['PreparedImage'] = None  # 渐进分辨率模式下先送审的低分辨率版本，原图已足够小时为None
+    tiles: Optional[List['PreparedImage']] = None  # 超长/超宽图片的分块（按顺序排列），不分块时为None
+
+    def to_base64(self) -> str:
+        """转换为Base64字符串"""
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def to_data_url(self) -> str:
+        """转换为OpenAI兼容接口使用的data URL"""
+        return f"data:{self.mime_type};base64,{self.to_base64()}"
+
+    def to_inline_blob(self) -> dict:
+        """转换为官方Gemini SDK的内联数据，直接发送已编码的字节，不再经过Base64和PIL"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    @property
+    def base64_size(self) -> int:
+        """Base64编码后的大小（字节）"""
+        return base64_length(len(self.data)) if self.data else 0
+
+
+def load_original(image_path: str, error: str = None) -> PreparedImage:
+    """无法预处理时直接读取原文件数据"""
+    mime_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    try:
+        with open(image_path, 'rb') as f:
+            return PreparedImage(image_path, f.read(), mime_type, None, error)
+    except OSError as e:
+        return PreparedImage(image_path, None, mime_type, None, error or str(e))
+
+
+def upload_format_available(upload_format: str) -> bool:
+    """当前Pillow能否编码该上传格式（AVIF需要Pillow 11.2以上且编译了libavif）"""
+    if upload_format not in UPLOAD_FORMATS:
+        return False
+    try:
+        return bool(features.check(UPLOAD_FORMATS[upload_format][2]))
+    except ValueError:
+        # 旧版Pillow不认识该特性名
+        return False
+
+
+def resolve_upload_format(requested: str, endpoint_formats: Dict[str, Sequence[str]]) -> Tuple[str, Optional[str]]:
+    """确定实际使用的上传格式，返回 (格式, 改用JPEG的原因)
+
+    endpoint_formats为 {端点名称: 该端点接受的格式}，请求的格式需要Pillow能够编码、且所有端点都接受，否则改用JPEG
+    """
+    requested = (requested or DEFAULT_UPLOAD_FORMAT).lower()
+    if requested == DEFAULT_UPLOAD_FORMAT:
+        return requested, None
+    if requested not in UPLOAD_FORMATS:
+        return DEFAULT_UPLOAD_FORMAT, f"不支持的上传格式 {requested}（可选 {'/'.join(UPLOAD_FORMATS)}）"
+    if not upload_format_available(requested):
+        return DEFAULT_UPLOAD_FORMAT, f"当前Pillow不支持编码 {requested}"
+    rejected = [name for name, formats in endpoint_formats.items() if requested not in formats]
+    if rejected:
+        return DEFAULT_UPLOAD_FORMAT, f"端点 {', '.join(rejected)} 不接受 {requested}（见端点的 image_formats）"
+    return requested, None
+
+
+def downscale(img: Image.Image, max_dimension: int = MAX_DIMENSION) -> Image.Image:
+    """解码并缩小到最大边长以内，同时转换为RGB模式
+
+    JPEG在解码阶段直接按1/2、1/4、1/8缩放（draft），其他格式先用reduce()做整数倍缩小，
+    最后再做一次高质量的LANCZOS缩放，大图不再以原始分辨率完整参与重采样
+    """
+    target = None
+    if img.width > max_dimension or img.height > max_dimension:
+        ratio = min(max_dimension / img.width, max_dimension / img.height)
+        target = (int(img.width * ratio), int(img.height * ratio))
+    return resize_to(img, target)
+
+
+def resize_to(img: Image.Image, target: Optional[Tuple[int, int]]) -> Image.Image:
+    """缩小到目标尺寸（为None时只转换模式），同时转换为RGB模式"""
+    if target is not None and img.format == 'JPEG':
+        # 必须在加载像素之前调用，实际尺寸不小于请求的尺寸
+        img.draft('RGB', target)
+
+    # 转换为RGB模式
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+
+    if target is not None:
+        factor = min(img.width // target[0], img.height // target[1]) // REDUCE_GAP
+        if factor >= 2 and img.mode in ('RGB', 'L'):
+            img = img.reduce(factor)
+        if img.size != target:
+            img = img.resize(target, Image.Resampling.LANCZOS)
+    return img
+
+
+def base64_length(size: int) -> int:
+    """Base64编码后的长度，无需真正编码"""
+    return (size + 2) // 3 * 4
+
+
+def _relative_size(quality: int, upload_format: str = DEFAULT_UPLOAD_FORMAT) -> float:
+    """按该格式的比例表线性插值"""
+    table = _RELATIVE_SIZE[upload_format]
+    for (q_hi, r_hi), (q_lo, r_lo) in zip(table, table[1:]):
+        if q_lo <= quality <= q_hi:
+            return r_lo + (r_hi - r_lo) * (quality - q_lo) / (q_hi - q_lo)
+    return table[-1][1]
+
+
+def encode_to_budget(img: Image.Image, budget: int, buffer: io.BytesIO, upload_format: str = DEFAULT_UPLOAD_FORMAT):
+    """以尽量少的编码次数找到Base64长度不超过预算的最高质量（按upload_format编码）
+
+    先按该格式的最高质量编码，大多数图片一次即可；超出预算时用实测体积校准该格式的比例表，
+    直接预测满足预算的质量，预测偏大时以新的实测结果再次校准
+    返回(质量, 编码次数)，最低质量仍超出预算时质量为None；buffer中保留最后一次编码结果
+    """
+    encodes = 0
+    pil_format, _, _, params = UPLOAD_FORMATS[upload_format]
+    max_quality, min_quality = QUALITY_RANGES[upload_format]
+
+    def encode(quality):
+        nonlocal encodes
+        buffer.seek(0)
+        buffer.truncate()
+        img.save(buffer, pil_format, quality=quality, **params)
+        encodes += 1
+        return base64_length(buffer.tell())
+
+    size = encode(max_quality)
+    if size <= budget:
+        return max_quality, encodes
+
+    upper, upper_size = max_quality, size
+    while upper > min_quality:
+        if encodes >= MAX_ENCODES - 1:
+            quality = min_quality
+        else:
+            scale = upper_size / _relative_size(upper, upload_format)
+            quality = next(
+                (q for q in range(upper - 1, min_quality - 1, -1)
+                 if scale * _relative_size(q, upload_format) <= budget),
+                min_quality
+            )
+        size = encode(quality)
+        if size <= budget:
+            return quality, encodes
+        upper, upper_size = quality, size
+    return None, encodes
+
+
+def encode_rendition(img: Image.Image, image_path: str, phash: Optional[int], budget: int,
+                     profile: Optional[PayloadProfile] = None,
+                     upload_format: str = DEFAULT_UPLOAD_FORMAT) -> PreparedImage:
+    """把低分辨率版本或分块编码为一个独立的送审图片（尺寸较小，一般一次编码即可）"""
+    buffer = io.BytesIO()
+    quality, encodes = encode_to_budget(img, budget, buffer, upload_format)
+    rendition = PreparedImage(image_path, buffer.getvalue(), UPLOAD_FORMATS[upload_format][1], phash)
+    rendition.quality = quality or QUALITY_RANGES[upload_format][1]
+    rendition.encode_count = encodes
+    if profile is not None:
+        rendition.image_tokens = profile.image_tokens(*img.size)
+    return rendition
+
+
+def encode_preview(img: Image.Image, image_path: str, phash: Optional[int], dimension: int,
+                   budget: int, profile: Optional[PayloadProfile] = None,
+                   upload_format: str = DEFAULT_UPLOAD_FORMAT) -> Optional[PreparedImage]:
+    """由已缩小的图片生成最大边长为dimension的低分辨率版本，图片本身不大于该尺寸时返回None"""
+    if max(img.size) <= dimension:
+        return None
+    ratio = dimension / max(img.size)
+    small = img.resize((max(1, int(img.width * ratio)), max(1, int(img.height * ratio))), Image.Resampling.LANCZOS)
+    return encode_rendition(small, image_path, phash, budget, profile, upload_format)
+
+
+def passthrough_mime(img: Image.Image, formats: Sequence[str], preview_dimension: int = 0,
+                     profile: Optional[PayloadProfile] = None,
+                     min_dimension: int = DEFAULT_MIN_DIMENSION) -> Optional[str]:
+    """只根据文件头判断能否直接发送原文件，可以时返回MIME类型
+
+    需要是端点接受的格式、非动图、尺寸不超过MAX_DIMENSION（也就不需要分块），不需要生成低分辨率版本，
+    且按计费规则不会比缩小后的尺寸多计token
+    """
+    source = PASSTHROUGH_FORMATS.get(img.format)
+    if source is None or source[0] not in formats:
+        return None
+    if getattr(img, 'is_animated', False) or img.mode not in PASSTHROUGH_MODES:
+        return None
+    if max(img.size) > MAX_DIMENSION or 0 < preview_dimension < max(img.size):
+        return None
+    if profile is not None:
+        size = profile.choose_size(img.width, img.height, MAX_DIMENSION, min_dimension)
+        if profile.image_tokens(*img.size) > profile.image_tokens(*size):
+            return None
+    return source[1]
+
+
+def needs_tiles(size: Tuple[int, int], min_aspect: float) -> bool:
+    """长短边之比不小于min_aspect、且整体缩小到MAX_DIMENSION会损失细节的图片需要分块"""
+    long_edge, short_edge = max(size), max(1, min(size))
+    return min_aspect > 0 and long_edge / short_edge >= min_aspect and long_edge > MAX_DIMENSION
+
+
+def tile_layout(width: int, height: int, tile_size: int = DEFAULT_TILE_SIZE, overlap: float = TILE_OVERLAP,
+                max_tiles: int = MAX_TILES) -> Tuple[Tuple[int, int], List[Tuple[int, int, int, int]]]:
+    """计算分块方案，返回 (缩放后的尺寸, 各分块的裁剪框)
+
+    短边缩小到不超过tile_size，沿长边切成边长为tile_size、相互重叠的块，块数超出上限时整体再缩小
+    """
+    long_edge, short_edge = max(width, height), max(1, min(width, height))
+    stride = tile_size * (1 - overlap)
+    scale = min(1.0, tile_size / short_edge, (tile_size + stride * (max_tiles - 1)) / long_edge)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    length = max(size)
+    count = 1 if length <= tile_size else min(max_tiles, math.ceil((length - tile_size) / stride) + 1)
+    boxes = []
+    for index in range(count):
+        # 各块均匀分布，首尾两块与图片边缘对齐
+        offset = round(index * (length - tile_size) / (count - 1)) if count > 1 else 0
+        end = min(length, offset + tile_size)
+        boxes.append((offset, 0, end, size[1]) if size[0] >= size[1] else (0, offset, size[0], end))
+    return size, boxes
+
+
+def read_passthrough(img: Image.Image, image_path: str, mime_type: str,
+                     profile: Optional[PayloadProfile] = None, need_phash: bool = True) -> PreparedImage:
+    """直接读取原文件作为送审数据"""
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    prepared = PreparedImage(image_path, data, mime_type)
+    prepared.passthrough = True
+    if profile is not None:
+        prepared.image_tokens = profile.image_tokens(*img.size)
+    if need_phash and img.format == 'JPEG':
+        # 只有JPEG能以1/8尺寸直接解码为灰度图（draft会改变img.size，放在计算token之后）；
+        # PNG/WebP的draft不起作用，计算感知哈希就要完整解码，这些小图只按内容哈希缓存
+        img.draft('L', (max(1, img.width // 8), max(1, img.height // 8)))
+        prepared.phash = dhash(img)
+    return prepared
+
+
+def prepare_image(image_path: str, budget_mb: float = DEFAULT_PAYLOAD_BUDGET_MB,
+                  preview_dimension: int = 0, tile_size: int = 0, tile_min_aspect: float = 0,
+                  profile: Optional[PayloadProfile] = None,
+                  min_dimension: int = DEFAULT_MIN_DIMENSION,
+                  upload_format: str = DEFAULT_UPLOAD_FORMAT, passthrough_kb: int = 0,
+                  passthrough_formats: Sequence[str] = (), need_phash: bool = True) -> PreparedImage:
+    """验证并按预算压缩图片（可在子进程中执行）
+
+    preview_dimension大于0时同时生成该尺寸的低分辨率版本，与原图共用一次解码
+    tile_min_aspect大于0时，长短边之比达到该值的超长/超宽图片额外切成边长为tile_size的分块，
+    tile_size为0时使用计费规则的块尺寸
+    指定计费规则(profile)时，在长边不低于min_dimension的前提下选择计费token最少的尺寸，并记录估算的token数
+    upload_format为编码格式（jpeg/webp/avif），需要先用 resolve_upload_format 确认Pillow和各端点都支持
+    passthrough_kb大于0时，不超过该大小、且 passthrough_mime 判断可以直接发送的图片只读取文件头，
+    不解码、不重新编码，直接发送原文件（need_phash为True时JPEG另外以1/8分辨率解码计算感知哈希，其他格式不计算）
+    """
+    budget = int(budget_mb * 1024 * 1024)
+    tile_size = tile_size or (profile.tile_size if profile else DEFAULT_TILE_SIZE)
+    try:
+        with Image.open(image_path) as img:
+            # 快速路径：Image.open只读取了文件头
+            if passthrough_kb > 0:
+                file_size = os.path.getsize(image_path)
+                mime_type = None
+                if file_size <= passthrough_kb * 1024 and base64_length(file_size) <= budget:
+                    mime_type = passthrough_mime(img, passthrough_formats, preview_dimension, profile, min_dimension)
+                if mime_type is not None:
+                    return read_passthrough(img, image_path, mime_type, profile, need_phash)
+
+            # 0. 需要分块的图片按分块尺寸解码，整图再从中缩小
+            tiled, boxes = None, None
+            if needs_tiles(img.size, tile_min_aspect):
+                size, boxes = tile_layout(img.width, img.height, tile_size)
+                tiled = img = resize_to(img, size if size != img.size else None)
+                # 原尺寸的JPEG此时尚未解码，先加载像素，避免整图缩小时的draft影响分块
+                tiled.load()
+
+            # 1. 先压缩尺寸
+            if profile is not None:
+                size = profile.choose_size(img.width, img.height, MAX_DIMENSION, min_dimension)
+                img = resize_to(img, size if size != img.size else None)
+            else:
+                img = downscale(img)
+
+            # 基于已缩小的图片计算感知哈希
+            phash = dhash(img)
+
+            # 2. 按上传格式编码，选择不超过预算的最高质量
+            start = time.perf_counter()
+            buffer = io.BytesIO()
+            quality, encodes = encode_to_budget(img, budget, buffer, upload_format)
+
+            # 最低质量仍超出预算时，按体积比例缩小尺寸
+            while quality is None and min(img.size) > 16:
+                ratio = math.sqrt(budget / base64_length(buffer.tell())) * 0.9
+                new_width = max(1, int(img.width * ratio))
+                new_height = max(1, int(img.height * ratio))
+                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                quality, count = encode_to_budget(img, budget, buffer, upload_format)
+                encodes += count
+
+            prepared = PreparedImage(image_path, buffer.getvalue(), UPLOAD_FORMATS[upload_format][1], phash)
+            prepared.quality = quality or QUALITY_RANGES[upload_format][1]
+            if profile is not None:
+                prepared.image_tokens = profile.image_tokens(*img.size)
+            if boxes is not None:
+                prepared.tiles = [encode_rendition(tiled.crop(box), image_path, None, budget, profile, upload_format)
+                                  for box in boxes]
+                encodes += sum(tile.encode_count for tile in prepared.tiles)
+            elif preview_dimension > 0:
+                prepared.preview = encode_preview(img, image_path, phash, preview_dimension, budget, profile,
+                                                  upload_format)
+                if prepared.preview is not None:
+                    encodes += prepared.preview.encode_count
+            prepared.encode_seconds = time.perf_counter() - start
+            prepared.encode_count = encodes
+            return prepared
+
+    except Exception as e:
+        return load_original(image_path, str(e))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按模型的图片计费规则选择送审尺寸
+各服务商把图片切成固定大小的块(tile)计费，边长稍微超过块的整数倍就会多出一整行/列块：
+- Gemini：两边都不超过384px时按258 token计费，否则按768x768的块计费，每块258 token
+- OpenAI兼容模型（高清模式）：先缩放到2048x2048以内，再把短边缩小到768px，按512x512的块计费，
+  每块170 token，另加85 token基础费用
+在不低于最小边长（保真度下限）的前提下，选择计费token最少的尺寸，相同token数时选择最大的尺寸；
+服务端会再缩小的部分不再上传
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+DEFAULT_MIN_DIMENSION = 768  # 送审图片长边的下限（保真度下限）
+
+
+@dataclass(frozen=True)
+class PayloadProfile:
+    """单个服务商的图片计费规则（可传给预处理进程）"""
+    name: str
+    tile_size: int
+    tokens_per_tile: int
+    base_tokens: int = 0
+    small_size: int = 0  # 两边都不超过该值时按一块计费
+    max_side: int = 0  # 服务端先把图片缩放到该尺寸以内，0表示不缩放
+    short_side: int = 0  # 服务端再把短边缩小到该值，0表示不缩放
+
+    def billed_size(self, width: int, height: int) -> Tuple[int, int]:
+        """服务端实际用于计费的尺寸"""
+        scale = 1.0
+        if self.max_side:
+            scale = min(scale, self.max_side / max(width, height))
+        if self.short_side:
+            scale = min(scale, self.short_side / min(width, height))
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def image_tokens(self, width: int, height: int) -> int:
+        """按计费规则估算单张图片的token数"""
+        width, height = self.billed_size(width, height)
+        if max(width, height) <= self.small_size:
+            tiles = 1
+        else:
+            tiles = math.ceil(width / self.tile_size) * math.ceil(height / self.tile_size)
+        return self.base_tokens + tiles * self.tokens_per_tile
+
+    def choose_size(self, width: int, height: int, max_dimension: int,
+                    min_dimension: int = DEFAULT_MIN_DIMENSION) -> Tuple[int, int]:
+        """在长边 [min_dimension, max_dimension] 范围内选择计费token最少的送审尺寸（不放大）"""
+        long_edge = max(width, height)
+        best, best_tokens = None, None
+        for target in range(min(max_dimension, long_edge), min(min_dimension, long_edge) - 1, -1):
+            ratio = target / long_edge
+            size = self.billed_size(max(1, int(width * ratio)), max(1, int(height * ratio)))
+            tokens = self.image_tokens(*size)
+            if best_tokens is None or tokens < best_tokens:
+                best, best_tokens = size, tokens
+        return best or (width, height)
+
+
+GEMINI = PayloadProfile('gemini', tile_size=768, tokens_per_tile=258, small_size=384)
+OPENAI = PayloadProfile('openai', tile_size=512, tokens_per_tile=170, base_tokens=85, max_side=2048, short_side=768)
+PROFILES = {profile.name: profile for profile in (GEMINI, OPENAI)}
+
+
+def profile_for_model(model_name: str, name: str = 'auto') -> Optional[PayloadProfile]:
+    """按配置或模型名称选择计费规则，'auto' 时按模型名称判断，无法判断或为 'none' 时返回None（按固定尺寸送审）"""
+    if name != 'auto':
+        return PROFILES.get(name)
+    model = (model_name or '').lower()
+    if 'gemini' in model:
+        return GEMINI
+    if model.startswith(('gpt-', 'chatgpt-', 'o1', 'o3', 'o4')):
+        return OPENAI
+    return None
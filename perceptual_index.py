@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+感知哈希近似重复索引
+同一作品的PNG/WebP/重新压缩的JPEG或不同分辨率版本，直接继承已有审查结论
+采用多段索引的汉明距离查找：64位哈希拆成4段16位，每段建索引，百万级条目下仍可快速查询
+"""
+
+import time
+import sqlite3
+import threading
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+HASH_BITS = 64
+CHUNK_COUNT = 4
+CHUNK_BITS = HASH_BITS // CHUNK_COUNT
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+MAX_SUPPORTED_DISTANCE = 11  # 每段最多枚举2位差异，超过后候选过多
+
+# 信息量过低的哈希（纯色、近乎空白的图片）不参与相似匹配，避免误继承结论
+MIN_SET_BITS = 8
+
+
+def dhash(img: Image.Image) -> int:
+    """计算差值哈希(dHash) - 传入已缩小的图片即可，计算量很小"""
+    small = img.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """计算两个哈希的汉明距离"""
+    return bin(a ^ b).count('1')
+
+
+def is_informative(phash: int) -> bool:
+    """判断哈希是否有足够信息量用于相似匹配"""
+    set_bits = bin(phash).count('1')
+    return MIN_SET_BITS <= set_bits <= HASH_BITS - MIN_SET_BITS
+
+
+def _split_chunks(phash: int) -> List[int]:
+    """把64位哈希拆成若干段"""
+    return [(phash >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNK_COUNT)]
+
+
+def _to_signed(value: int) -> int:
+    """SQLite整数是有符号64位，存储前转换"""
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def _chunk_variants(chunk: int, max_flips: int) -> List[int]:
+    """枚举与某段相差不超过max_flips位的所有取值"""
+    variants = [chunk]
+    for flips in range(1, max_flips + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            value = chunk
+            for bit in bits:
+                value ^= 1 << bit
+            variants.append(value)
+    return variants
+
+
+class PerceptualIndex:
+    """持久化的感知哈希索引（与审查缓存共用数据库文件）"""
+
+    def __init__(self, db_path: str, max_distance: int = 4):
+        self.db_path = db_path
+        self.max_distance = max(0, min(int(max_distance), MAX_SUPPORTED_DISTANCE))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS phash_verdicts (
+                    phash INTEGER NOT NULL,
+                    c0 INTEGER NOT NULL,
+                    c1 INTEGER NOT NULL,
+                    c2 INTEGER NOT NULL,
+                    c3 INTEGER NOT NULL,
+                    model_name TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    suitable INTEGER NOT NULL,
+                    reason TEXT,
+                    confidence REAL,
+                    created_at REAL,
+                    PRIMARY KEY (phash, model_name, prompt_version)
+                )
+            ''')
+            for i in range(CHUNK_COUNT):
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_phash_c{i} ON phash_verdicts (c{i})'
+                )
+            self.conn.commit()
+
+    def lookup(self, phash: int, model_name: str, prompt_version: str) -> Optional[Tuple[Dict, int]]:
+        """查找距离阈值内最相近的已审查图片，返回(结论, 距离)，未找到返回None"""
+        if phash is None or not is_informative(phash):
+            return None
+
+        # 鸽巢原理：距离不超过d时，至少有一段的差异不超过 d // 段数
+        max_flips = self.max_distance // CHUNK_COUNT
+        best = None
+        with self.lock:
+            for i, chunk in enumerate(_split_chunks(phash)):
+                variants = _chunk_variants(chunk, max_flips)
+                placeholders = ','.join('?' * len(variants))
+                rows = self.conn.execute(
+                    f'SELECT phash, suitable, reason, confidence FROM phash_verdicts '
+                    f'WHERE c{i} IN ({placeholders}) AND model_name = ? AND prompt_version = ?',
+                    (*variants, model_name, prompt_version)
+                ).fetchall()
+                for stored, suitable, reason, confidence in rows:
+                    distance = hamming_distance(phash, _to_unsigned(stored))
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = ({
+                            "suitable_for_teens": bool(suitable),
+                            "reason": reason or "",
+                            "confidence": confidence if confidence is not None else 1.0
+                        }, distance)
+                if best is not None and best[1] == 0:
+                    break
+        return best
+
+    def add(self, phash: int, model_name: str, prompt_version: str, result: Dict):
+        """记录图片哈希与审查结论"""
+        suitable = result.get("suitable_for_teens")
+        if phash is None or not isinstance(suitable, bool) or not is_informative(phash):
+            return
+        try:
+            confidence = float(result.get("confidence", 1.0))
+        except (TypeError, ValueError):
+            confidence = None
+        chunks = _split_chunks(phash)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO phash_verdicts '
+                '(phash, c0, c1, c2, c3, model_name, prompt_version, suitable, reason, confidence, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (_to_signed(phash), *chunks, model_name, prompt_version, int(suitable),
+                 str(result.get("reason", "")), confidence, time.time())
+            )
+            self.conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
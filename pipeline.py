@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+有界流水线工具
+任务按固定窗口逐步提交，在途任务数有上限，内存占用与图片总数无关
+"""
+
+import time
+import heapq
+import queue
+import asyncio
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator
+
+_END = object()
+
+
+class _Failure:
+    """后台线程中的异常，转交给消费方重新抛出"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class RetryLater(Exception):
+    """任务需要在delay秒后重试
+
+    由任务函数抛出，调度器到期后重新执行任务（已预处理的数据保留），等待期间不占用工作线程/协程
+    resume 为重试时调用的无参函数，不提供时重新执行原任务
+    """
+
+    def __init__(self, delay: float, resume: Callable = None):
+        super().__init__(f"retry in {delay:.1f}s")
+        self.delay = delay
+        self.resume = resume
+
+
+class RetryScheduler:
+    """延迟重试调度器
+
+    一个后台线程维护按到期时间排序的小顶堆，到期后执行回调（通常是把任务重新提交给线程池）
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.scheduled = 0
+        self.thread = threading.Thread(target=self._run, name="retry", daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self) -> int:
+        """等待到期的任务数"""
+        with self.cond:
+            return len(self.heap)
+
+    def schedule(self, delay: float, callback: Callable, *args):
+        with self.cond:
+            if self.closed:
+                return
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), callback, args))
+            self.scheduled += 1
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+                _, _, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"重试任务提交失败: {e}")
+
+    def close(self):
+        """停止调度，尚未到期的任务直接丢弃"""
+        with self.cond:
+            self.closed = True
+            self.heap.clear()
+            self.cond.notify()
+        self.thread.join()
+
+
+def iter_in_background(iterable: Iterable, buffer_size: int = 10000) -> Iterator:
+    """在后台线程中迭代（如目录扫描），通过有界缓冲区边产出边消费"""
+    buffer = queue.Queue(maxsize=max(1, buffer_size))
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except BaseException as e:
+            buffer.put(_Failure(e))
+        finally:
+            buffer.put(_END)
+
+    threading.Thread(target=produce, name="discovery", daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+async def aiter_in_background(iterable: Iterable, buffer_size: int = 10000) -> AsyncIterator:
+    """iter_in_background 的异步版本，扫描不会阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    buffer = asyncio.Queue(maxsize=max(1, buffer_size))
+
+    def produce():
+        def put(item):
+            asyncio.run_coroutine_threadsafe(buffer.put(item), loop).result()
+        try:
+            for item in iterable:
+                put(item)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            put(_END)
+
+    threading.Thread(target=produce, name="discovery", daemon=True).start()
+    while True:
+        item = await buffer.get()
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+async def run_bounded_async(func: Callable[[int, Any], Awaitable], items: Iterable,
+                            workers: int, max_pending: int, logger=None):
+    """生产者/消费者模式执行协程任务
+
+    固定数量的工作协程从有界队列取任务，队列满时生产者等待，不会一次性创建所有协程
+    items 可以是普通可迭代对象，也可以是异步迭代器（如后台扫描）
+    任务抛出 RetryLater 时由事件循环的定时器到期后重新入队，等待期间不占用工作协程
+    """
+    task_queue = asyncio.Queue(maxsize=max(1, max_pending))
+    delayed = set()
+
+    async def requeue(entry, delay):
+        await asyncio.sleep(delay)
+        await task_queue.put(entry)
+
+    async def worker():
+        while True:
+            entry = await task_queue.get()
+            try:
+                if entry is None:
+                    return
+                index, item, resume = entry
+                try:
+                    await (resume() if resume else func(index, item))
+                except RetryLater as retry:
+                    # 在task_done之前登记，join返回时所有待重试任务都已在delayed中
+                    task = asyncio.create_task(requeue((index, item, retry.resume or resume), retry.delay))
+                    delayed.add(task)
+                    task.add_done_callback(delayed.discard)
+                except Exception as e:
+                    if logger:
+                        logger.error(f"任务执行失败: {item}, 错误: {e}")
+            finally:
+                task_queue.task_done()
+
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(max(1, workers))]
+    try:
+        if hasattr(items, '__aiter__'):
+            index = 0
+            async for item in items:
+                await task_queue.put((index, item, None))
+                index += 1
+        else:
+            for index, item in enumerate(items):
+                await task_queue.put((index, item, None))
+        # 等待队列清空且没有待重试的任务
+        while True:
+            await task_queue.join()
+            if not delayed:
+                break
+            await asyncio.wait(set(delayed))
+        for _ in worker_tasks:
+            await task_queue.put(None)
+        await asyncio.gather(*worker_tasks)
+    finally:
+        for task in worker_tasks + list(delayed):
+            if not task.done():
+                task.cancel()
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+
+    定时器实际唤醒时间比预期晚多少，事件循环就被阻塞了多久；超过阈值时记录一次卡顿
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, logger=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.logger = logger
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    async def run(self):
+        """持续监控，直到任务被取消"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                if self.logger:
+                    self.logger.warning(f"⚠️ 事件循环阻塞 {lag * 1000:.0f}ms")
+
+    def describe(self) -> str:
+        return f"卡顿 {self.stalls} 次 (阈值 {self.threshold * 1000:.0f}ms)，最长延迟 {self.max_lag * 1000:.0f}ms"
+
+
+class StageMetrics:
+    """流水线单个阶段的队列深度统计"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.lock = threading.Lock()
+        self.pending = 0  # 已进入本阶段但尚未完成
+        self.completed = 0
+        self.peak_waiting = 0
+
+    def enter(self):
+        with self.lock:
+            self.pending += 1
+            self.peak_waiting = max(self.peak_waiting, self.pending - self.workers)
+
+    def leave(self, completed: bool = True):
+        with self.lock:
+            self.pending -= 1
+            if completed:
+                self.completed += 1
+
+    @property
+    def waiting(self) -> int:
+        """排队等待的任务数（线程池/进程池按先进先出调度）"""
+        with self.lock:
+            return max(0, self.pending - self.workers)
+
+    @property
+    def running(self) -> int:
+        with self.lock:
+            return min(self.pending, self.workers)
+
+
+def create_process_pool(workers: int) -> ProcessPoolExecutor:
+    """创建预处理进程池，统一使用spawn方式，避免在多线程进程中fork"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+class ImagePipeline:
+    """三段式图片审查流水线
+
+    查缓存(线程池) -> 解码/缩放/编码(进程池，按CPU核数) -> 调用API(线程池，按API并发数)
+    每个阶段独立排队，通过有界窗口限制在途图片数
+
+    lookup(index, item)              返回None表示已处理完（如命中缓存），否则返回传给后续阶段的上下文
+    prepare(item)                    可pickle的模块级函数，在子进程中执行
+    review(index, item, ctx, result) 预处理失败时result为None，由review自行回退；
+                                     抛出 RetryLater 时到期后带着同一份预处理结果重新审查
+    """
+
+    def __init__(self, lookup: Callable, prepare: Callable, review: Callable,
+                 io_workers: int, cpu_workers: int, max_pending: int, logger=None):
+        self.lookup = lookup
+        self.prepare = prepare
+        self.review = review
+        self.io_workers = max(1, io_workers)
+        self.cpu_workers = max(1, cpu_workers)
+        self.lookup_workers = self.cpu_workers
+        self.logger = logger
+        self.window = threading.BoundedSemaphore(max(1, max_pending))
+        self.outstanding = 0
+        self.outstanding_cond = threading.Condition()
+        self.metrics = {
+            'lookup': StageMetrics('查缓存', self.lookup_workers),
+            'prepare': StageMetrics('预处理', self.cpu_workers),
+            'review': StageMetrics('审查', self.io_workers),
+        }
+        self.lookup_pool = None
+        self.cpu_pool = None
+        self.io_pool = None
+        self.retries = None
+
+    def describe_queues(self) -> str:
+        """各阶段排队深度，用于进度条显示"""
+        queues = ' '.join(f"{m.name}:{m.waiting}" for m in self.metrics.values())
+        if self.retries:
+            queues += f" 待重试:{self.retries.pending}"
+        return queues
+
+    def describe_summary(self) -> str:
+        """各阶段处理数与峰值排队深度，用于最终统计"""
+        summary = ', '.join(f"{m.name} {m.completed} 张(峰值排队 {m.peak_waiting})" for m in self.metrics.values())
+        if self.retries:
+            summary += f", 延迟重试 {self.retries.scheduled} 次"
+        return summary
+
+    def _log_error(self, item, error):
+        if self.logger:
+            self.logger.error(f"任务执行失败: {item}, 错误: {error}")
+
+    def _finish(self):
+        self.window.release()
+        with self.outstanding_cond:
+            self.outstanding -= 1
+            self.outstanding_cond.notify_all()
+
+    def _lookup_task(self, index, item):
+        try:
+            ctx = self.lookup(index, item)
+        except Exception as e:
+            self._log_error(item, e)
+            ctx = None
+        finally:
+            self.metrics['lookup'].leave()
+
+        if ctx is None:
+            self._finish()
+            return
+
+        self.metrics['prepare'].enter()
+        try:
+            future = self.cpu_pool.submit(self.prepare, item)
+        except Exception as e:
+            # 进程池不可用时，交给审查阶段在线程内预处理
+            if self.logger:
+                self.logger.warning(f"预处理进程池不可用，改为线程内处理: {e}")
+            self._on_prepared(index, item, ctx, None)
+            return
+        future.add_done_callback(lambda f: self._on_prepared(index, item, ctx, f))
+
+    def _on_prepared(self, index, item, ctx, future):
+        self.metrics['prepare'].leave()
+        prepared = None
+        if future is not None:
+            try:
+                prepared = future.result()
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning(f"预处理进程失败，改为线程内处理: {item}, {e}")
+        self._submit_review(index, item, ctx, prepared)
+
+    def _submit_review(self, index, item, ctx, prepared):
+        self.metrics['review'].enter()
+        self.io_pool.submit(self._review_task, index, item, ctx, prepared)
+
+    def _review_task(self, index, item, ctx, prepared):
+        retry = None
+        try:
+            self.review(index, item, ctx, prepared)
+        except RetryLater as e:
+            retry = e
+        except Exception as e:
+            self._log_error(item, e)
+        finally:
+            self.metrics['review'].leave(completed=retry is None)
+
+        if retry is not None:
+            # 到期后重新进入审查阶段，等待期间不占用API线程，图片仍计入在途窗口
+            self.retries.schedule(retry.delay, self._submit_review, index, item, ctx, prepared)
+            return
+        self._finish()
+
+    def run(self, items: Iterable):
+        """逐个提交任务，窗口满时等待，全部完成后返回
+
+        中断（Ctrl+C）或 items 迭代出错时不再等待在途图片：停止提交、丢弃待重试任务、
+        取消各阶段排队中的任务后重新抛出异常（正在执行的调用仍会各自结束）
+        """
+        lookup_pool = ThreadPoolExecutor(max_workers=self.lookup_workers, thread_name_prefix='lookup')
+        cpu_pool = create_process_pool(self.cpu_workers)
+        io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='io')
+        self.lookup_pool, self.cpu_pool, self.io_pool = lookup_pool, cpu_pool, io_pool
+        self.retries = RetryScheduler(self.logger)
+        completed = False
+        try:
+            for index, item in enumerate(items):
+                self.window.acquire()
+                with self.outstanding_cond:
+                    self.outstanding += 1
+                self.metrics['lookup'].enter()
+                lookup_pool.submit(self._lookup_task, index, item)
+            # 等待所有在途图片走完全部阶段
+            with self.outstanding_cond:
+                self.outstanding_cond.wait_for(lambda: self.outstanding == 0)
+            completed = True
+        finally:
+            self.retries.close()
+            for pool in (lookup_pool, cpu_pool, io_pool):
+                pool.shutdown(wait=completed, cancel_futures=not completed)
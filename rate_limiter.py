@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RPM/TPM速率限制
+所有工作线程/协程共用一组令牌桶，按服务商的每分钟请求数(RPM)和每分钟token数(TPM)配额发送请求
+协程和批量请求采用预约方式：先从桶中扣除本次请求的消耗（余额可以为负），再等待余额补回所需的时间，
+请求按到达顺序依次放行，无需轮询；线程中的单张请求用 try_acquire，配额不足时不扣除也不等待，
+由调用方交给重试调度器到期后再试，等待期间不占用线程
+"""
+
+import time
+import asyncio
+import threading
+
+BURST_SECONDS = 5  # 桶容量相当于多少秒的配额，限制启动时的突发量
+RESPONSE_TOKENS = 100  # 审查结论(JSON)的输出token估算
+IMAGE_MIN_TOKENS = 258  # 单张图片的最低计费token数
+IMAGE_BYTES_PER_TOKEN = 750  # 按编码后图片大小估算图片token数
+
+
+def estimate_tokens(prompt: str, payload_bytes: int, images: int = 1, image_tokens: int = 0) -> int:
+    """按请求大小估算本次调用消耗的token数
+
+    提示词按每个字符一个token计算（中文偏保守），图片优先使用按模型计费规则估算的token数(image_tokens)，
+    未知时按编码后大小折算，再加上输出部分；批量请求时payload_bytes和image_tokens为所有图片之和，每张图片各有一份输出
+    """
+    if not image_tokens:
+        image_tokens = max(IMAGE_MIN_TOKENS * images, payload_bytes // IMAGE_BYTES_PER_TOKEN)
+    return len(prompt) + image_tokens + RESPONSE_TOKENS * images
+
+
+class TokenBucket:
+    """单个令牌桶（调用方持有锁）"""
+
+    def __init__(self, per_minute: float, burst_seconds: float = BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def available(self, now: float) -> float:
+        """当前可用余额（不扣除）"""
+        return max(0.0, min(self.capacity, self.tokens + (now - self.updated) * self.rate))
+
+    def reserve(self, amount: float, now: float) -> float:
+        """扣除amount，返回需要等待的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # 单次消耗超过桶容量时按容量计算，避免永远等不到
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def shortfall(self, amount: float, now: float) -> float:
+        """余额补足amount（最多按容量计算）还需要的秒数，不扣除"""
+        return max(0.0, (min(amount, self.capacity) - self.available(now)) / self.rate)
+
+
+class RateLimiter:
+    """RPM + TPM 双令牌桶，配额为0表示不限制"""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.waited = 0.0
+        self.estimated_tokens = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def reserve(self, tokens: int) -> float:
+        """预约一次请求，返回需要等待的秒数"""
+        if not self.enabled:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            self.estimated_tokens += tokens
+            if delay > 0:
+                self.throttled += 1
+                self.waited += delay
+        return delay
+
+    def try_acquire(self, tokens: int) -> float:
+        """不等待地取得一次请求的配额：余额足够时扣除并返回0，否则不扣除，返回需要等待的秒数"""
+        if not self.enabled:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            buckets = [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens))
+                       if bucket is not None]
+            delay = max(bucket.shortfall(amount, now) for bucket, amount in buckets)
+            if delay > 0:
+                self.throttled += 1
+                self.waited += delay
+                return delay
+            for bucket, amount in buckets:
+                bucket.reserve(amount, now)
+            self.estimated_tokens += tokens
+        return 0.0
+
+    def headroom(self) -> float:
+        """剩余配额占桶容量的比例(0~1)，不限制时为1"""
+        if not self.enabled:
+            return 1.0
+        with self.lock:
+            now = time.monotonic()
+            return min(bucket.available(now) / bucket.capacity
+                       for bucket in (self.requests, self.tokens) if bucket is not None)
+
+    def wait(self, tokens: int):
+        """线程中等待配额"""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, tokens: int):
+        """协程中等待配额"""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def describe(self) -> str:
+        rpm = f"{self.rpm:g}" if self.rpm > 0 else "不限"
+        tpm = f"{self.tpm:g}" if self.tpm > 0 else "不限"
+        return (f"RPM {rpm}, TPM {tpm}，限速等待 {self.throttled} 次共 {self.waited:.1f} 秒，"
+                f"估算消耗 {self.estimated_tokens} tokens")
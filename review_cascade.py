@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+级联审查与模型用量统计
+- 两级模型：先用快速模型（如 flash）初审所有图片，只有置信度低于阈值或判定为不适合的图片才交给强模型（如 pro）复审，
+  大部分明显安全的图片不会用到强模型
+- 渐进分辨率：先发送低分辨率版本（如 512px），只有置信度低于阈值或回复格式异常时才发送完整尺寸的图片，
+  大部分图片只消耗低分辨率的图片token和上传时间
+后一级需要重试时保留前一级的结论，重试只重新发送后一级的请求
+"""
+
+import threading
+from typing import Dict, List, Mapping, Optional
+
+
+def verdict_confidence(verdict: dict) -> float:
+    try:
+        return float(verdict.get('confidence', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class _Usage:
+    __slots__ = ('requests', 'images', 'latency', 'tokens')
+
+    def __init__(self):
+        self.requests = 0
+        self.images = 0
+        self.latency = 0.0
+        self.tokens = 0
+
+
+class ModelUsage:
+    """按模型统计请求数、图片数、调用耗时和估算token数；配置了价格时估算费用"""
+
+    def __init__(self, prices: Optional[Mapping[str, float]] = None):
+        self.prices = dict(prices or {})  # 模型 -> 每百万输入token的价格
+        self.lock = threading.Lock()
+        self.models: Dict[str, _Usage] = {}
+
+    def record(self, model_name: str, latency: float, tokens: int, images: int = 1):
+        """记录一次成功的API调用"""
+        with self.lock:
+            usage = self.models.setdefault(model_name, _Usage())
+            usage.requests += 1
+            usage.images += images
+            usage.latency += latency
+            usage.tokens += tokens
+
+    def describe(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for model_name, usage in self.models.items():
+                line = (f"{model_name}: 请求 {usage.requests} 次，图片 {usage.images} 张，"
+                        f"平均耗时 {usage.latency / usage.requests * 1000:.0f} ms，估算 {usage.tokens} tokens")
+                if model_name in self.prices:
+                    line += f"，约 {usage.tokens / 1e6 * self.prices[model_name]:.4f}"
+                lines.append(line)
+        return lines
+
+
+class ReviewCascade:
+    """级联策略和各级的图片数统计"""
+
+    def __init__(self, screening_model: str, confidence_threshold: float = 0.8):
+        self.screening_model = screening_model
+        self.threshold = confidence_threshold
+        self.lock = threading.Lock()
+        self.pending: Dict[str, dict] = {}  # 已初审、等待复审的图片及其初审结论
+        self.screened = 0
+        self.escalated_unsuitable = 0
+        self.escalated_uncertain = 0
+        self.overturned = 0  # 复审结论与初审不同
+
+    def cache_key(self, review_model: str) -> str:
+        """缓存中记录结论所用的模型标识，级联配置变化后不沿用旧结论"""
+        return f"{self.screening_model}>{review_model}@{self.threshold:g}"
+
+    def screening_result(self, image_path: str) -> Optional[dict]:
+        """复审重试时返回之前的初审结论"""
+        with self.lock:
+            return self.pending.get(image_path)
+
+    def escalate(self, image_path: str, verdict: dict) -> bool:
+        """记录初审结论，返回是否需要强模型复审"""
+        unsuitable = verdict.get('suitable_for_teens') is not True
+        uncertain = verdict_confidence(verdict) < self.threshold
+        with self.lock:
+            self.screened += 1
+            if unsuitable:
+                self.escalated_unsuitable += 1
+            elif uncertain:
+                self.escalated_uncertain += 1
+            else:
+                return False
+            self.pending[image_path] = verdict
+        return True
+
+    def finish(self, image_path: str, verdict: dict):
+        """复审完成"""
+        with self.lock:
+            screening = self.pending.pop(image_path, None)
+            if screening is not None and screening.get('suitable_for_teens') != verdict.get('suitable_for_teens'):
+                self.overturned += 1
+
+    def describe(self) -> str:
+        escalated = self.escalated_unsuitable + self.escalated_uncertain
+        return (f"{self.screening_model} 初审 {self.screened} 张，直接通过 {self.screened - escalated} 张；"
+                f"复审 {escalated} 张（判定不适合 {self.escalated_unsuitable} 张，"
+                f"置信度低于 {self.threshold:g} {self.escalated_uncertain} 张），复审改判 {self.overturned} 张")
+
+
+class ProgressiveReview:
+    """渐进分辨率策略和升级统计"""
+
+    def __init__(self, dimension: int, confidence_threshold: float = 0.8):
+        self.dimension = dimension
+        self.threshold = confidence_threshold
+        self.lock = threading.Lock()
+        self.pending = set()  # 低分辨率审查不确定、等待原图审查的图片
+        self.previewed = 0
+        self.escalated_uncertain = 0
+        self.escalated_malformed = 0
+        self.small = 0  # 原图不大于低分辨率尺寸，直接审查
+
+    def cache_key(self, model: str) -> str:
+        """缓存中记录结论所用的模型标识，低分辨率得出的结论不与只用原图审查的结论混用"""
+        return f"{model}@{self.dimension}px"
+
+    def awaiting_full(self, image_path: str) -> bool:
+        """原图审查重试时不再重复低分辨率审查"""
+        with self.lock:
+            return image_path in self.pending
+
+    def record_small(self):
+        with self.lock:
+            self.small += 1
+
+    def escalate(self, image_path: str, verdict: Optional[dict]) -> bool:
+        """记录低分辨率审查结论（None表示回复格式异常），返回是否需要发送原图"""
+        with self.lock:
+            self.previewed += 1
+            if verdict is None:
+                self.escalated_malformed += 1
+            elif verdict_confidence(verdict) < self.threshold:
+                self.escalated_uncertain += 1
+            else:
+                return False
+            self.pending.add(image_path)
+        return True
+
+    def finish(self, image_path: str):
+        """原图审查完成"""
+        with self.lock:
+            self.pending.discard(image_path)
+
+    def describe(self) -> str:
+        escalated = self.escalated_uncertain + self.escalated_malformed
+        rate = escalated / self.previewed if self.previewed else 0
+        return (f"先以 {self.dimension}px 审查 {self.previewed} 张，改用原图 {escalated} 张（{rate:.0%}，"
+                f"置信度低于 {self.threshold:g} {self.escalated_uncertain} 张，回复格式异常 {self.escalated_malformed} 张），"
+                f"原图较小直接审查 {self.small} 张")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+增量扫描清单
+持久化记录每个目录的修改时间、子目录和图片文件名
+目录未变化时直接复用清单内容，不再重新列目录，大型网络共享目录也能秒级完成扫描
+只有增删、重命名会改变目录的修改时间，原地覆盖文件内容不会被发现；清单只决定扫描出哪些文件名，
+内容是否变化由审查缓存的内容哈希负责
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+DEFAULT_MANIFEST_PATH = '.picexam_manifest.db'
+IMAGE_EXTENSIONS = {'.webp', '.jpg', '.jpeg', '.png', '.gif', '.bmp'}
+APPROVED_TAG = "_审查已经通过"
+
+# 目录修改时间距扫描时刻过近时不可信（同一时间粒度内可能还有变化），下次强制重新扫描
+MTIME_SETTLE_SECONDS = 2.0
+
+
+class ScanManifest:
+    """基于SQLite的目录扫描清单"""
+
+    def __init__(self, db_path: str = DEFAULT_MANIFEST_PATH):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.last_scan = {'dirs_scanned': 0, 'dirs_reused': 0}
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    subdirs TEXT NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    dir TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    approved INTEGER NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_files_dir ON files (dir)')
+            self.conn.commit()
+
+    def _rescan_dir(self, dir_path: str, dir_mtime_ns: int) -> Tuple[List[str], List[Tuple[str, bool]]]:
+        """重新列出目录内容并写入清单"""
+        subdirs = []
+        rows = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS:
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    rows.append((
+                        os.path.join(dir_path, entry.name), dir_path, entry.name, int(APPROVED_TAG in entry.name)
+                    ))
+        except OSError:
+            return [], []
+
+        if time.time() - dir_mtime_ns / 1e9 < MTIME_SETTLE_SECONDS:
+            dir_mtime_ns = -1
+
+        subdirs.sort()
+        rows.sort(key=lambda row: row[2])
+        with self.lock:
+            self.conn.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO files (path, dir, name, approved) VALUES (?, ?, ?, ?)', rows
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO dirs (path, mtime_ns, subdirs) VALUES (?, ?, ?)',
+                (dir_path, dir_mtime_ns, json.dumps(subdirs, ensure_ascii=False))
+            )
+            self.conn.commit()
+        return subdirs, [(row[2], bool(row[3])) for row in rows]
+
+    def _load_dir(self, dir_path: str, dir_mtime_ns: int) -> Optional[Tuple[List[str], List[Tuple[str, bool]]]]:
+        """目录未变化时从清单读取内容，否则返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT mtime_ns, subdirs FROM dirs WHERE path = ?', (dir_path,)
+            ).fetchone()
+            if row is None or row[0] != dir_mtime_ns:
+                return None
+            files = self.conn.execute(
+                'SELECT name, approved FROM files WHERE dir = ? ORDER BY name', (dir_path,)
+            ).fetchall()
+        return json.loads(row[1]), [(name, bool(approved)) for name, approved in files]
+
+    def _prune(self, seen_dirs: set):
+        """删除已不存在（或已被排除）的目录记录"""
+        with self.lock:
+            known = [row[0] for row in self.conn.execute('SELECT path FROM dirs')]
+            stale = [(path,) for path in known if path not in seen_dirs]
+            if stale:
+                self.conn.executemany('DELETE FROM files WHERE dir = ?', stale)
+                self.conn.executemany('DELETE FROM dirs WHERE path = ?', stale)
+                self.conn.commit()
+
+    def scan(self, root: str = '.', exclude_folder: str = None, include_approved: bool = True) -> Iterator[str]:
+        """增量扫描目录树，边扫描边产出图片路径"""
+        seen_dirs = set()
+        dirs_scanned = 0
+        dirs_reused = 0
+        stack = [root]
+
+        while stack:
+            dir_path = stack.pop()
+            if exclude_folder and exclude_folder in dir_path:
+                continue
+            try:
+                dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            seen_dirs.add(dir_path)
+
+            listing = self._load_dir(dir_path, dir_mtime_ns)
+            if listing is None:
+                listing = self._rescan_dir(dir_path, dir_mtime_ns)
+                dirs_scanned += 1
+            else:
+                dirs_reused += 1
+            subdirs, files = listing
+
+            for name, approved in files:
+                if include_approved or not approved:
+                    yield os.path.join(dir_path, name)
+
+            stack.extend(os.path.join(dir_path, name) for name in reversed(subdirs))
+
+        self._prune(seen_dirs)
+        self.last_scan = {'dirs_scanned': dirs_scanned, 'dirs_reused': dirs_reused}
+
+    def refresh(self, root: str = '.', exclude_folder: str = None):
+        """只更新清单，不返回文件列表"""
+        for _ in self.scan(root, exclude_folder):
+            pass
+        return self.last_scan
+
+    def counts(self) -> Tuple[int, int, int]:
+        """从清单统计 (总图片数, 未处理数, 已审查数)"""
+        with self.lock:
+            total, approved = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(approved), 0) FROM files'
+            ).fetchone()
+        return total, total - approved, approved
+
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
+
+
+def open_manifest(db_path: str = DEFAULT_MANIFEST_PATH) -> ScanManifest:
+    """打开扫描清单，数据库不可用时退回到内存清单"""
+    try:
+        return ScanManifest(db_path)
+    except Exception as e:
+        print(f"⚠️ 扫描清单不可用，本次使用内存清单: {e}")
+        return ScanManifest(':memory:')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""自适应并发上限的调整规则"""
+
+import random
+import unittest
+from unittest import mock
+
+import adaptive_limiter
+from adaptive_limiter import OK, RATE_LIMITED, _AdaptiveLimit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0  # 与真实的 monotonic 一样远大于0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(adaptive_limiter.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def feed(self, limit, latencies, outcome=OK):
+        for latency in latencies:
+            # 上限个请求并发执行，每次完成间隔约为 延迟/并发数
+            self.clock.now += latency / limit.current
+            limit._update(latency, outcome)
+
+    def test_noisy_latency_without_contention_keeps_max_limit(self):
+        rng = random.Random(7)
+        limit = _AdaptiveLimit(20)
+        # 长尾的对数正态分布延迟（中位数约3秒），与并发数无关
+        self.feed(limit, [rng.lognormvariate(1.1, 0.8) for _ in range(5000)])
+        self.assertEqual(limit.current, 20)
+        self.assertEqual(limit.latency_decreases, 0)
+
+    def test_single_fast_outlier_does_not_pin_baseline(self):
+        limit = _AdaptiveLimit(20)
+        self.feed(limit, [0.05] + [3.0] * 500)
+        self.assertEqual(limit.current, 20)
+
+    def test_sustained_latency_rise_decreases_limit(self):
+        limit = _AdaptiveLimit(20)
+        self.feed(limit, [1.0] * 200 + [10.0] * 20)
+        self.assertLess(limit.current, 20)
+        self.assertGreater(limit.latency_decreases, 0)
+
+    def test_rate_limit_backs_off_once_per_round(self):
+        limit = _AdaptiveLimit(20)
+        self.feed(limit, [1.0] * 10)
+        for _ in range(5):
+            limit._update(1.0, RATE_LIMITED)
+        self.assertEqual(limit.current, 10)
+        self.assertEqual(limit.rate_limit_decreases, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""API错误分类：安全拦截只认结构化原因，关键字匹配只用于没有状态码的旧式异常"""
+
+import types
+import unittest
+
+from api_errors import OTHER, RATE_LIMITED, SAFETY, UNAVAILABLE, classify_api_error
+from async_transport import APIStatusError
+
+
+class StopCandidateException(Exception):
+    pass
+
+
+class BlockedPromptException(Exception):
+    pass
+
+
+class StatusError(Exception):
+    def __init__(self, message, status_code, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+class ClassifyApiErrorTest(unittest.TestCase):
+    def test_gateway_block_with_status_is_not_safety(self):
+        info = classify_api_error(StatusError("403 Forbidden: request blocked by gateway", 403))
+        self.assertEqual(info.kind, OTHER)
+        self.assertEqual(info.status, 403)
+
+    def test_transport_error_mentioning_blocked_is_not_safety(self):
+        error = APIStatusError(403, 'Forbidden', '{"error": {"message": "IP blocked"}}')
+        self.assertEqual(classify_api_error(error).kind, OTHER)
+
+    def test_content_filter_code_is_safety(self):
+        self.assertEqual(classify_api_error(StatusError("filtered", 400, code='content_filter')).kind, SAFETY)
+        error = APIStatusError(400, 'Bad Request', '{"error": {"code": "content_policy_violation"}}')
+        self.assertEqual(classify_api_error(error).kind, SAFETY)
+
+    def test_gemini_block_and_finish_reasons(self):
+        self.assertEqual(classify_api_error(BlockedPromptException("block_reason: OTHER")).kind, SAFETY)
+        safety = types.SimpleNamespace(finish_reason=types.SimpleNamespace(name='SAFETY'))
+        self.assertEqual(classify_api_error(StopCandidateException(safety)).kind, SAFETY)
+        recitation = types.SimpleNamespace(finish_reason=types.SimpleNamespace(name='RECITATION'))
+        self.assertEqual(classify_api_error(StopCandidateException(recitation)).kind, OTHER)
+
+    def test_keyword_fallback_only_without_status(self):
+        self.assertEqual(classify_api_error(Exception("Response blocked due to SAFETY")).kind, SAFETY)
+        self.assertEqual(classify_api_error(StatusError("safety system unavailable", 503)).kind, UNAVAILABLE)
+        self.assertEqual(classify_api_error(StatusError("Too Many Requests", 429)).kind, RATE_LIMITED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""批量审查：只有回复无法解析等错误才逐张回退，限流和端点故障整批交回重试"""
+
+import asyncio
+import threading
+import unittest
+
+from api_errors import RATE_LIMITED, UNAVAILABLE
+from batch_review import AsyncReviewBatcher, BatchRetry, ReviewBatcher
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def review_all(batcher, items):
+    """多个线程同时提交，返回 {序号: 结论或异常}"""
+    outcomes = {}
+
+    def worker(item):
+        try:
+            outcomes[item] = batcher.review(item)
+        except Exception as e:
+            outcomes[item] = e
+
+    threads = [threading.Thread(target=worker, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+class ReviewBatcherTest(unittest.TestCase):
+    def make_batcher(self, error):
+        def send(items):
+            raise error
+        return ReviewBatcher(3, 5.0, send)
+
+    def test_rate_limited_batch_is_retried_whole(self):
+        batcher = self.make_batcher(StatusError(429))
+        outcomes = review_all(batcher, [0, 1, 2])
+        self.assertEqual(len(outcomes), 3)
+        for outcome in outcomes.values():
+            self.assertIsInstance(outcome, BatchRetry)
+            self.assertEqual(outcome.error.kind, RATE_LIMITED)
+        self.assertEqual((batcher.retried, batcher.fallbacks), (3, 0))
+
+    def test_endpoint_failure_is_retried_whole(self):
+        outcomes = review_all(self.make_batcher(StatusError(503)), [0, 1, 2])
+        self.assertTrue(all(isinstance(o, BatchRetry) and o.error.kind == UNAVAILABLE for o in outcomes.values()))
+
+    def test_parse_error_falls_back_to_single(self):
+        batcher = self.make_batcher(ValueError("unexpected reply shape"))
+        outcomes = review_all(batcher, [0, 1, 2])
+        self.assertEqual(outcomes, {0: None, 1: None, 2: None})
+        self.assertEqual((batcher.retried, batcher.fallbacks), (0, 3))
+
+    def test_missing_indices_fall_back(self):
+        batcher = ReviewBatcher(2, 5.0, lambda items: {0: {'suitable_for_teens': True}})
+        outcomes = review_all(batcher, ['a', 'b'])
+        self.assertEqual(sorted(outcomes.values(), key=repr), [None, {'suitable_for_teens': True}])
+
+
+class AsyncReviewBatcherTest(unittest.TestCase):
+    def run_batch(self, error):
+        async def send(items):
+            raise error
+
+        async def main():
+            batcher = AsyncReviewBatcher(2, 5.0, send)
+            outcomes = await asyncio.gather(batcher.review('a'), batcher.review('b'), return_exceptions=True)
+            return batcher, outcomes
+
+        return asyncio.run(main())
+
+    def test_rate_limited_batch_is_retried_whole(self):
+        batcher, outcomes = self.run_batch(StatusError(429))
+        self.assertTrue(all(isinstance(o, BatchRetry) and o.error.kind == RATE_LIMITED for o in outcomes))
+        self.assertEqual(batcher.retried, 2)
+
+    def test_parse_error_falls_back_to_single(self):
+        batcher, outcomes = self.run_batch(ValueError("bad json"))
+        self.assertEqual(outcomes, [None, None])
+        self.assertEqual(batcher.fallbacks, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
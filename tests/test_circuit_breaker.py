@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""熔断器：被取消的探测请求不能让端点永远停在半开状态"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import circuit_breaker
+from api_errors import APIErrorInfo, TIMEOUT
+from circuit_breaker import CLOSED, HALF_OPEN, PROBE_WAIT, CircuitBreaker
+from endpoint_pool import Endpoint
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CancelledProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(circuit_breaker.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_endpoint(self) -> Endpoint:
+        endpoint = Endpoint('test', 'http://127.0.0.1:9/v1', 'key', 'model',
+                            circuit_failure_threshold=1, circuit_cooldown=10, asynchronous=True)
+        endpoint.breaker.record_failure(APIErrorInfo(TIMEOUT))
+        self.clock.now += 11
+        return endpoint
+
+    def test_cancelled_probe_is_released(self):
+        endpoint = self.open_endpoint()
+        breaker = endpoint.breaker
+
+        async def probe():
+            self.assertIsNone(breaker.before_call())
+            endpoint.assigned += 1
+            async with endpoint.track():
+                await asyncio.sleep(3600)
+
+        async def cancel_probe():
+            task = asyncio.ensure_future(probe())
+            await asyncio.sleep(0)
+            self.assertEqual(breaker.state, HALF_OPEN)
+            self.assertEqual(breaker.before_call(), PROBE_WAIT)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_probe())
+        self.assertEqual(endpoint.assigned, 0)
+        self.assertFalse(breaker.probing)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.available())
+        # 下一个请求重新探测，成功后恢复
+        self.assertIsNone(breaker.before_call())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_abort_probe_counts_neither_success_nor_failure(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, cooldown=10)
+        breaker.record_failure(APIErrorInfo(TIMEOUT))
+        self.clock.now += 11
+        self.assertIsNone(breaker.before_call())
+        with self.assertRaises(KeyboardInterrupt):
+            with breaker.track():
+                raise KeyboardInterrupt
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(breaker.cooldown, 10)
+        self.assertEqual(breaker.trips, 1)
+        self.assertFalse(breaker.probing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""异步引擎直接传入配置对象（不经过load_config）时的模型解析"""
+
+import os
+import logging
+import tempfile
+import unittest
+
+from fast_concurrent_filter import FastConcurrentImageFilter, FilterConfig
+from payload_profiles import OPENAI
+
+
+class ConfigObjectTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(temp_dir.name)  # 日志文件写在临时目录
+        self.addCleanup(os.chdir, cwd)
+        self.addCleanup(logging.getLogger().handlers.clear)
+
+    def make_filter(self, **options) -> FastConcurrentImageFilter:
+        config = FilterConfig(verdict_cache=False, phash_index=False, manifest_path='manifest.db', **options)
+        return FastConcurrentImageFilter(config)
+
+    def test_verdict_model_from_endpoints(self):
+        filter_system = self.make_filter(
+            endpoints=[{'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'test', 'model_name': 'gpt-4o'}],
+            progressive_dimension=512)
+        self.assertEqual(filter_system.model_name, 'gpt-4o')
+        self.assertTrue(filter_system.verdict_model.startswith('gpt-4o'))
+        self.assertIs(filter_system.payload_profile, OPENAI)
+
+    def test_verdict_model_with_cascade(self):
+        filter_system = self.make_filter(
+            endpoints=[{'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'test', 'model_name': 'gpt-4o'}],
+            cascade_model='gpt-4o-mini')
+        self.assertEqual(filter_system.verdict_model, filter_system.cascade.cache_key('gpt-4o'))
+
+    def test_mixed_endpoint_models_do_not_share_single_model_key(self):
+        filter_system = self.make_filter(endpoints=[
+            {'name': 'a', 'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'a', 'model_name': 'gpt-4o'},
+            {'name': 'b', 'base_url': 'http://127.0.0.1:9/v1', 'api_key': 'b', 'model_name': 'gemini-2.5-flash'},
+        ])
+        self.assertEqual(filter_system.verdict_model, 'gemini-2.5-flash+gpt-4o')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""各上传格式按自己的质量范围和体积比例表编码"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image, ImageFile
+
+from image_payload import (QUALITY_RANGES, UPLOAD_FORMATS, base64_length, encode_to_budget, prepare_image,
+                           upload_format_available)
+
+
+def sample_image() -> Image.Image:
+    """渐变叠加噪声，接近照片的压缩难度"""
+    return Image.merge('RGB', [
+        Image.linear_gradient('L').resize((768, 576)),
+        Image.radial_gradient('L').resize((768, 576)),
+        Image.effect_noise((768, 576), 30),
+    ])
+
+
+class EncodeToBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.img = sample_image()
+        self.formats = [fmt for fmt in UPLOAD_FORMATS if upload_format_available(fmt)]
+
+    def test_starts_at_format_max_quality(self):
+        for fmt in self.formats:
+            quality, encodes = encode_to_budget(self.img, 10 * 1024 * 1024, io.BytesIO(), fmt)
+            self.assertEqual((quality, encodes), (QUALITY_RANGES[fmt][0], 1), fmt)
+
+    def test_tight_budget_stays_in_format_range(self):
+        for fmt in self.formats:
+            buffer = io.BytesIO()
+            encode_to_budget(self.img, 10 * 1024 * 1024, buffer, fmt)
+            budget = base64_length(buffer.tell()) * 3 // 4
+            quality, _ = encode_to_budget(self.img, budget, buffer, fmt)
+            max_quality, min_quality = QUALITY_RANGES[fmt]
+            self.assertIsNotNone(quality, fmt)
+            self.assertTrue(min_quality <= quality < max_quality, (fmt, quality))
+            self.assertLessEqual(base64_length(buffer.tell()), budget)
+
+    def test_modern_formats_smaller_than_jpeg(self):
+        sizes = {}
+        for fmt in self.formats:
+            buffer = io.BytesIO()
+            encode_to_budget(self.img, 10 * 1024 * 1024, buffer, fmt)
+            sizes[fmt] = buffer.tell()
+        for fmt in ('webp', 'avif'):
+            if fmt in sizes:
+                self.assertLess(sizes[fmt], sizes['jpeg'], fmt)
+
+
+class PassthroughTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.folder = temp_dir.name
+
+    def prepare(self, name: str):
+        path = os.path.join(self.folder, name)
+        sample_image().resize((320, 240)).save(path)
+        with mock.patch.object(ImageFile.ImageFile, 'load', autospec=True,
+                               side_effect=ImageFile.ImageFile.load) as load:
+            prepared = prepare_image(path, passthrough_kb=512, passthrough_formats=('jpeg', 'png'))
+        self.assertTrue(prepared.passthrough)
+        with open(path, 'rb') as f:
+            self.assertEqual(prepared.data, f.read())
+        return prepared, load
+
+    def test_png_passthrough_is_not_decoded(self):
+        prepared, load = self.prepare('icon.png')
+        self.assertIsNone(prepared.phash)
+        load.assert_not_called()
+
+    def test_jpeg_passthrough_hashes_draft(self):
+        prepared, load = self.prepare('photo.jpg')
+        self.assertIsNotNone(prepared.phash)
+        load.assert_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
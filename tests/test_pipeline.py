@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""流水线：正常结束时等待所有在途图片，中断或扫描出错时不等待待重试的图片"""
+
+import time
+import threading
+import unittest
+
+from pipeline import ImagePipeline, RetryLater
+
+
+class ScanError(Exception):
+    pass
+
+
+class ImagePipelineTest(unittest.TestCase):
+    def make_pipeline(self, review):
+        # str 可以pickle，作为子进程中执行的预处理函数
+        return ImagePipeline(lambda index, item: item, str, review, io_workers=2, cpu_workers=1, max_pending=4)
+
+    def test_drains_on_normal_completion(self):
+        reviewed = []
+        attempts = {}
+
+        def review(index, item, ctx, prepared):
+            attempts[item] = attempts.get(item, 0) + 1
+            if attempts[item] == 1:
+                raise RetryLater(0.2)
+            reviewed.append(prepared)
+
+        self.make_pipeline(review).run(['a', 'b', 'c'])
+        self.assertEqual(sorted(reviewed), ['a', 'b', 'c'])
+
+    def test_scan_error_does_not_wait_for_parked_retries(self):
+        parked = threading.Event()
+        reviewed = []
+
+        def review(index, item, ctx, prepared):
+            if item == 'slow':
+                parked.set()
+                raise RetryLater(60)
+            reviewed.append(item)
+
+        def items():
+            yield 'slow'
+            parked.wait(10)
+            raise ScanError("扫描失败")
+
+        pipeline = self.make_pipeline(review)
+        started = time.monotonic()
+        with self.assertRaises(ScanError):
+            pipeline.run(items())
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(pipeline.retries.pending, 0)
+        self.assertEqual(reviewed, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
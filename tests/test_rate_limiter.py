@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""RPM/TPM令牌桶：try_acquire配额不足时不扣除、不等待"""
+
+import unittest
+from unittest import mock
+
+import rate_limiter
+from rate_limiter import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TryAcquireTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(rate_limiter.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rpm_shortfall_is_not_deducted(self):
+        limiter = RateLimiter(rpm=60)  # 每秒1次，桶容量5次
+        for _ in range(5):
+            self.assertEqual(limiter.try_acquire(100), 0.0)
+        self.assertAlmostEqual(limiter.try_acquire(100), 1.0)
+        # 不足时没有扣除，再问一次等待时间不变
+        self.assertAlmostEqual(limiter.try_acquire(100), 1.0)
+        self.clock.now += 1.0
+        self.assertEqual(limiter.try_acquire(100), 0.0)
+        self.assertEqual(limiter.estimated_tokens, 600)
+        self.assertEqual(limiter.throttled, 2)
+
+    def test_tpm_uses_larger_shortfall(self):
+        limiter = RateLimiter(rpm=600, tpm=6000)  # 每秒100 token，桶容量500
+        self.assertEqual(limiter.try_acquire(400), 0.0)
+        self.assertAlmostEqual(limiter.try_acquire(400), 3.0)
+
+    def test_unlimited(self):
+        self.assertEqual(RateLimiter().try_acquire(10 ** 6), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
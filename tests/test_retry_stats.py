@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""重试的图片只记录一次编码统计"""
+
+import os
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import image_filter_main
+from image_payload import prepare_image
+from pipeline import RetryLater
+
+
+class RetryStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir.name)  # 日志文件写在临时目录
+        self.addCleanup(os.chdir, cwd)
+        self.addCleanup(logging.getLogger().handlers.clear)
+
+        config = dict(image_filter_main.load_config())
+        config.update(api_base_url='http://127.0.0.1:9/v1', api_key='test', verdict_cache=False,
+                      phash_index=False, cache_path='cache.db', manifest_path='manifest.db')
+        self.filter = image_filter_main.UltraFastImageFilter(config)
+        self.image_path = os.path.join(self.temp_dir.name, 'photo.png')
+        Image.new('RGB', (2000, 1500), (30, 120, 200)).save(self.image_path)
+
+    def test_retried_image_is_counted_once(self):
+        prepared = prepare_image(self.image_path)
+        self.assertGreater(prepared.encode_count, 0)
+        calls = []
+
+        def review(image_path, worker_id, *args, **kwargs):
+            # 前两次遇到429等需要重试的错误，第三次得出结论
+            calls.append(image_path)
+            if len(calls) <= 2:
+                raise self.filter.schedule_retry(image_path, worker_id)
+            self.filter.finish_retries(image_path, worker_id)
+            return {'suitable_for_teens': True, 'reason': 'ok', 'confidence': 0.9}
+
+        with mock.patch.object(self.filter, 'review_prepared_image', side_effect=review), \
+                mock.patch.object(self.filter, 'apply_verdict'):
+            for _ in range(2):
+                with self.assertRaises(RetryLater):
+                    self.filter.review_stage(0, self.image_path, ('w', None), prepared)
+            self.filter.review_stage(0, self.image_path, ('w', None), prepared)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.filter.stats['encoded'], 1)
+        self.assertAlmostEqual(self.filter.stats['encode_time'], prepared.encode_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
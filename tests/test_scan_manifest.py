@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""增量扫描清单：未变化的目录复用清单，增删文件后重新列目录"""
+
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from scan_manifest import ScanManifest
+
+
+class ScanManifestTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = os.path.join(temp_dir.name, 'images')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        self.db_path = os.path.join(temp_dir.name, 'manifest.db')
+        for name in ('a.jpg', 'b_审查已经通过.png', 'notes.txt', os.path.join('sub', 'c.webp')):
+            open(os.path.join(self.root, name), 'wb').close()
+        self.settle()
+
+    def settle(self):
+        """把目录修改时间调到过去，避免刚修改的目录被强制重新扫描"""
+        past = time.time() - 60
+        for dir_path in (self.root, os.path.join(self.root, 'sub')):
+            os.utime(dir_path, (past, past))
+
+    def scan(self, manifest, **kwargs):
+        return sorted(os.path.relpath(path, self.root) for path in manifest.scan(self.root, **kwargs))
+
+    def test_unchanged_dirs_are_reused(self):
+        manifest = ScanManifest(self.db_path)
+        self.addCleanup(manifest.close)
+        expected = ['a.jpg', 'b_审查已经通过.png', os.path.join('sub', 'c.webp')]
+        self.assertEqual(self.scan(manifest), expected)
+        self.assertEqual(manifest.last_scan, {'dirs_scanned': 2, 'dirs_reused': 0})
+        self.assertEqual(self.scan(manifest, include_approved=False), ['a.jpg', os.path.join('sub', 'c.webp')])
+        self.assertEqual(manifest.last_scan, {'dirs_scanned': 0, 'dirs_reused': 2})
+
+        open(os.path.join(self.root, 'sub', 'd.jpg'), 'wb').close()
+        self.settle()
+        self.assertIn(os.path.join('sub', 'd.jpg'), self.scan(manifest))
+        self.assertEqual(manifest.last_scan, {'dirs_scanned': 2, 'dirs_reused': 0})
+
+    def test_existing_manifest_with_stat_columns(self):
+        # 旧版本的清单还带有 size/mtime_ns/inode 列，可以继续使用
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE files (path TEXT PRIMARY KEY, dir TEXT NOT NULL, name TEXT NOT NULL, '
+                     'size INTEGER, mtime_ns INTEGER, inode INTEGER, approved INTEGER NOT NULL)')
+        conn.commit()
+        conn.close()
+        manifest = ScanManifest(self.db_path)
+        self.addCleanup(manifest.close)
+        self.assertEqual(len(self.scan(manifest)), 3)
+        self.assertEqual(manifest.counts(), (3, 2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
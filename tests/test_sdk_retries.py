@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""多线程引擎的等待都交给重试调度器：SDK不自行重试429，RPM配额不足时也不在线程中等待"""
+
+import os
+import json
+import logging
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+import image_filter_main
+import ultra_fast_filter
+from image_payload import prepare_image
+from pipeline import RetryLater
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    calls = 0
+
+    def do_POST(self):
+        RateLimitedHandler.calls += 1
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"error": {"message": "Too Many Requests", "type": "rate_limit"}}'
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SdkRetriesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir.name)  # 日志文件写在临时目录
+        self.addCleanup(os.chdir, cwd)
+        self.addCleanup(logging.getLogger().handlers.clear)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/v1"
+        RateLimitedHandler.calls = 0
+
+        image_path = os.path.join(self.temp_dir.name, 'photo.png')
+        Image.new('RGB', (640, 480), (30, 120, 200)).save(image_path)
+        self.image_path = image_path
+        self.prepared = prepare_image(image_path)
+
+    def assert_rate_limited_once(self, filter_system, stats):
+        with self.assertRaises(RetryLater) as raised:
+            filter_system.check_image_safety(self.image_path, 'w', self.prepared)
+        self.assertEqual(raised.exception.delay, 1)
+        self.assertEqual(RateLimitedHandler.calls, 1)  # SDK没有自行重试
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['rate_limit_errors'], 1)
+        endpoint = next(iter(filter_system.endpoints))
+        self.assertEqual(endpoint.breaker.pauses, 1)
+        self.assertFalse(endpoint.breaker.available())
+
+    def test_main_engine(self):
+        config = dict(image_filter_main.load_config())
+        config.update(api_base_url=self.base_url, api_key='test', verdict_cache=False,
+                      phash_index=False, cache_path='cache.db', manifest_path='manifest.db')
+        filter_system = image_filter_main.UltraFastImageFilter(config)
+        self.assert_rate_limited_once(filter_system, filter_system.stats)
+
+    def test_rpm_shortfall_reschedules_without_waiting(self):
+        config = dict(image_filter_main.load_config())
+        config.update(api_base_url=self.base_url, api_key='test', verdict_cache=False, rpm_limit=1,
+                      phash_index=False, cache_path='cache.db', manifest_path='manifest.db')
+        filter_system = image_filter_main.UltraFastImageFilter(config)
+        endpoint = next(iter(filter_system.endpoints))
+        endpoint.breaker.pause = lambda seconds: None  # 忽略429的Retry-After，只看配额
+        with self.assertRaises(RetryLater):
+            filter_system.check_image_safety(self.image_path, 'w', self.prepared)
+        with self.assertRaises(RetryLater) as raised:
+            filter_system.check_image_safety(self.image_path, 'w', self.prepared)
+        self.assertGreater(raised.exception.delay, 50)
+        self.assertEqual(RateLimitedHandler.calls, 1)  # 配额不足的请求没有发出
+        self.assertEqual(filter_system.stats['retries'], 1)  # 等待配额不计为重试
+        self.assertEqual(endpoint.assigned, 0)
+
+    def test_ultra_engine(self):
+        with open('filter_config.json', 'w', encoding='utf-8') as f:
+            json.dump({'use_proxy': True, 'base_url': self.base_url, 'api_key': 'test', 'model_name': 'gpt-4o',
+                       'verdict_cache': False, 'phash_index': False, 'manifest_path': 'manifest.db'}, f)
+        filter_system = ultra_fast_filter.UltraFastImageFilter(max_workers=2)
+        self.assert_rate_limited_once(filter_system, filter_system.stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
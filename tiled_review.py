@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+超长/超宽图片分块审查
+面板截图、长条漫画等图片整体缩小到1024px后内容难以辨认，保持原尺寸又会超出请求大小上限，
+因此沿长边切成与模型图片块(tile)尺寸一致、相互重叠的分块（见 image_payload.tile_layout），各块并发审查：
+任一块不适合即判定整张图片不适合，全部适合才算适合
+已得出结论的分块在重试时不再重复发送；已有分块不适合时，尚未发送的分块直接跳过
+"""
+
+import threading
+from typing import Dict, List
+
+from review_cascade import verdict_confidence
+
+
+def combine_tile_verdicts(verdicts: Dict[int, dict], count: int) -> dict:
+    """合并各分块的结论，verdicts为 {分块序号: 结论}"""
+    unsuitable = sorted(index for index, verdict in verdicts.items() if verdict.get('suitable_for_teens') is not True)
+    if unsuitable:
+        index = max(unsuitable, key=lambda i: verdict_confidence(verdicts[i]))
+        verdict = dict(verdicts[index])
+        # 移动图片时以理由作为文件名，分块位置放在理由之后
+        verdict['reason'] = f"{verdict.get('reason', '')}（第 {index + 1}/{count} 块）"
+        return verdict
+    return {
+        "suitable_for_teens": True,
+        "reason": f"全部 {count} 块均适合",
+        "confidence": min((verdict_confidence(verdict) for verdict in verdicts.values()), default=0.0)
+    }
+
+
+class TiledReview:
+    """各图片的分块结论和分块审查统计"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Dict[int, dict]] = {}  # 图片 -> 已得出结论的分块
+        self.images = 0
+        self.tiles = 0
+        self.requests = 0
+        self.stopped_early = 0  # 已有分块不适合、未审查全部分块的图片
+
+    def remaining(self, image_path: str, count: int) -> List[int]:
+        """还需要审查的分块序号，已有分块不适合时返回空列表"""
+        with self.lock:
+            done = self.pending.setdefault(image_path, {})
+            if self._decided(done):
+                return []
+            return [index for index in range(count) if index not in done]
+
+    def record(self, image_path: str, index: int, verdict: dict) -> bool:
+        """记录一个分块的结论，返回整张图片是否已可判定为不适合"""
+        with self.lock:
+            self.requests += 1
+            done = self.pending.get(image_path)
+            if done is None:
+                return True
+            done[index] = verdict
+            return self._decided(done)
+
+    def decided(self, image_path: str, count: int) -> bool:
+        """全部分块都有结论，或已有分块不适合"""
+        with self.lock:
+            done = self.pending.get(image_path, {})
+            return len(done) >= count or self._decided(done)
+
+    def finish(self, image_path: str, count: int) -> dict:
+        """合并结论并清除该图片的分块状态"""
+        with self.lock:
+            done = self.pending.pop(image_path, {})
+            self.images += 1
+            self.tiles += count
+            if len(done) < count:
+                self.stopped_early += 1
+        return combine_tile_verdicts(done, count)
+
+    @staticmethod
+    def _decided(done: Dict[int, dict]) -> bool:
+        return any(verdict.get('suitable_for_teens') is not True for verdict in done.values())
+
+    def describe(self) -> str:
+        return (f"分块审查 {self.images} 张，共 {self.tiles} 块，发送 {self.requests} 次请求，"
+                f"因已有分块不适合提前结束 {self.stopped_early} 张")
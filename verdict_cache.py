@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+审查结果缓存
+以文件内容哈希为键持久化保存审查结论，重复文件、复制到新位置或清除标记后重新审查时不再重复调用API
+"""
+
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Optional
+
+DEFAULT_CACHE_PATH = '.picexam_cache.db'
+
+
+def compute_prompt_version(prompt: str) -> str:
+    """根据提示词内容生成版本号，提示词变化后旧缓存自动失效"""
+    return hashlib.sha1(prompt.strip().encode('utf-8')).hexdigest()[:12]
+
+
+def hash_file(image_path: str) -> str:
+    """计算文件内容哈希 - 使用mmap读取，大文件不做整块拷贝"""
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(image_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0:
+            # hashlib处理大缓冲区时会释放GIL，多个工作线程可以真正并行计算
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hasher.update(mm)
+    return hasher.hexdigest()
+
+
+class VerdictCache:
+    """基于SQLite的审查结论存储"""
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS verdicts (
+                    content_hash TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    suitable INTEGER NOT NULL,
+                    reason TEXT,
+                    confidence REAL,
+                    created_at REAL,
+                    PRIMARY KEY (content_hash, model_name, prompt_version)
+                )
+            ''')
+            self.conn.commit()
+
+    def get(self, content_hash: str, model_name: str, prompt_version: str) -> Optional[Dict]:
+        """查询缓存的审查结论，未命中返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT suitable, reason, confidence FROM verdicts '
+                'WHERE content_hash = ? AND model_name = ? AND prompt_version = ?',
+                (content_hash, model_name, prompt_version)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "suitable_for_teens": bool(row[0]),
+            "reason": row[1] or "",
+            "confidence": row[2] if row[2] is not None else 1.0
+        }
+
+    def put(self, content_hash: str, model_name: str, prompt_version: str, result: Dict):
+        """保存审查结论 - 只保存明确的通过/不通过结论"""
+        suitable = result.get("suitable_for_teens")
+        if not isinstance(suitable, bool):
+            return
+        try:
+            confidence = float(result.get("confidence", 1.0))
+        except (TypeError, ValueError):
+            confidence = None
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO verdicts '
+                '(content_hash, model_name, prompt_version, suitable, reason, confidence, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (content_hash, model_name, prompt_version, int(suitable),
+                 str(result.get("reason", "")), confidence, time.time())
+            )
+            self.conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()